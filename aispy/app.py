@@ -1,17 +1,19 @@
 import numpy as np
 from streams import Stream
 from settings import UserSettings, Settings
-from utils import mainlogger
+from utils import mainlogger, start_log_listener
 from db_driver import DBDriver
 from telegrambot import Telegrambot
 from watchdog import Watchdog
 import multiprocessing as mp
-from memory_managers import SharedFrameDeque
+from memory_managers import SharedFrameRing, SharedCompressedRing, SharedMotionBoxes
 
 
 class FractalApp:
 
 	def __init__(self):
+		# Every process started from here on logs through the listener
+		self.loglistener = start_log_listener()
 		mainlogger.info(f'Fractal Initializing')
 		self.db = DBDriver(Settings.db_file)
 		self.streams = {}
@@ -25,7 +27,6 @@ class FractalApp:
 	def init_shared_state_objects(self):
 		self.fileinferencequeue = mp.Queue()
 		self.dbupdatequeue = mp.Queue()
-		self.motionmanager = mp.Manager()
 		# TODO use these in the process
 		self.process_outputs['detector'] = {}
 		self.process_outputs['detector']['updatetime'] = mp.Value('d', 0.0)
@@ -38,12 +39,39 @@ class FractalApp:
 				continue
 			# self.recordflags[streamid] = mp.Value('i', 0)
 			self.streaminfos[streamid]['recordflag'] = mp.Value('i', 0)
-			self.streaminfos[streamid]['framebuffer'] = SharedFrameDeque(
-				max_items=int(UserSettings.pre_record_time.total_seconds() * UserSettings.record_fps),
+			self.streaminfos[streamid].setdefault('record_mode', getattr(UserSettings, 'record_mode', 'reencode'))
+			prerecord_items = int(UserSettings.pre_record_time.total_seconds() * UserSettings.record_fps)
+			prerecord_buffer = getattr(UserSettings, 'prerecord_buffer', 'raw')
+			# Passthrough recording keeps the pre record time as compressed segments and a jpeg pre record buffer
+			# keeps it compressed in its own arena, the raw frames then only feed detection and snapshots
+			if self.streaminfos[streamid]['record_mode'] == 'passthrough' or prerecord_buffer == 'jpeg':
+				max_items = getattr(UserSettings, 'detect_buffer_size', 10)
+			else:
+				max_items = prerecord_items
+			self.streaminfos[streamid]['framebuffer'] = SharedFrameRing(
+				max_items=max_items,
 				itemshape=(self.streaminfos[streamid]['dimensions'][1], self.streaminfos[streamid]['dimensions'][0], 3),
 				datatype=np.uint8
 			)
-			self.streaminfos[streamid]['motionlist'] = self.motionmanager.list([None])
+			if self.streaminfos[streamid]['record_mode'] != 'passthrough' and prerecord_buffer == 'jpeg':
+				self.streaminfos[streamid]['recordbuffer'] = SharedCompressedRing(
+					max_items=prerecord_items,
+					arenasize=prerecord_items * getattr(UserSettings, 'prerecord_frame_bytes', 400_000),
+					quality=getattr(UserSettings, 'prerecord_jpeg_quality', 80)
+				)
+			else:
+				self.streaminfos[streamid]['recordbuffer'] = self.streaminfos[streamid]['framebuffer']
+			# Detection reads from a low resolution substream when one is configured, otherwise from the main stream
+			if self.streaminfos[streamid].get('detect_url'):
+				self.streaminfos[streamid]['detectbuffer'] = SharedFrameRing(
+					max_items=getattr(UserSettings, 'detect_buffer_size', 10),
+					itemshape=(self.streaminfos[streamid]['detect_dimensions'][1], self.streaminfos[streamid]['detect_dimensions'][0], 3),
+					datatype=np.uint8
+				)
+			else:
+				self.streaminfos[streamid]['detectbuffer'] = self.streaminfos[streamid]['framebuffer']
+			self.streaminfos[streamid].setdefault('motion_gating', getattr(UserSettings, 'motion_gating', False))
+			self.streaminfos[streamid]['motionboxes'] = SharedMotionBoxes()
 
 	def dbupdater(self):
 		while True:
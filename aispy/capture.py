@@ -0,0 +1,181 @@
+import shutil
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+
+import cv2
+import numpy as np
+
+
+class CaptureBackend(ABC):
+	"""
+	Decodes a video source to raw frames.
+
+	Args:
+	url: Any source the backend can open, a camera stream url or a local file
+	dimensions: (width, height) of the returned frames, None keeps the source resolution
+	pixel_format: Pixel format of the returned frames, bgr24, gray or nv12
+	hwaccel: Hardware decoder to use if the backend supports it, None decodes in software
+	double_width: Repeat every column of the source, for cameras that send their lite stream at half the width
+	"""
+	type_key: str
+
+	def __init__(self, url, dimensions: tuple | None = None, pixel_format: str = 'bgr24', hwaccel: str | None = None,
+				 double_width: bool = False):
+		self.url = url
+		self.dimensions = dimensions
+		self.pixel_format = pixel_format
+		self.hwaccel = hwaccel
+		self.double_width = double_width
+
+	@abstractmethod
+	def open(self) -> None:
+		pass
+
+	@abstractmethod
+	def read(self) -> tuple[bool, np.ndarray | None]:
+		pass
+
+	@abstractmethod
+	def release(self) -> None:
+		pass
+
+	def frameshape(self, dimensions) -> tuple:
+		width, height = dimensions
+		if self.pixel_format == 'bgr24':
+			return (height, width, 3)
+		elif self.pixel_format == 'gray':
+			return (height, width)
+		elif self.pixel_format == 'nv12':
+			return (height * 3 // 2, width)
+		raise ValueError(f'Unsupported pixel format {self.pixel_format}')
+
+
+class OpenCVCapture(CaptureBackend):
+	type_key = 'opencv'
+
+	def __init__(self, url, dimensions: tuple | None = None, pixel_format: str = 'bgr24', hwaccel: str | None = None,
+				 double_width: bool = False):
+		super().__init__(url, dimensions, pixel_format, hwaccel, double_width)
+		if pixel_format not in ('bgr24', 'gray'):
+			raise ValueError(f'Unsupported pixel format {pixel_format} for the opencv backend')
+		self.video: cv2.VideoCapture | None = None
+
+	def open(self) -> None:
+		self.video = cv2.VideoCapture(self.url)
+
+	def read(self) -> tuple[bool, np.ndarray | None]:
+		check, frame = self.video.read()
+		if not check:
+			return False, None
+		if self.double_width:
+			frame = frame.repeat(2, 1)
+		if self.dimensions is not None and frame.shape[1::-1] != tuple(self.dimensions):
+			frame = cv2.resize(frame, self.dimensions, interpolation=cv2.INTER_LINEAR)
+		if self.pixel_format == 'gray':
+			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		return True, frame
+
+	def release(self) -> None:
+		if self.video is not None:
+			self.video.release()
+			self.video = None
+
+
+class FFmpegCapture(CaptureBackend):
+	"""
+	Decodes in an ffmpeg subprocess that scales and converts the frames and writes them raw to a pipe.
+
+	The returned frame is a buffer that is reused by the next read, copy it if it has to outlive that.
+	"""
+	type_key = 'ffmpeg'
+
+	def __init__(self, url, dimensions: tuple | None = None, pixel_format: str = 'bgr24', hwaccel: str | None = None,
+				 double_width: bool = False):
+		super().__init__(url, dimensions, pixel_format, hwaccel, double_width)
+		if dimensions is None:
+			width, height = self.probe_dimensions(url)
+			dimensions = (width * 2 if double_width else width, height)
+		self.dimensions = tuple(dimensions)
+		self.frame = np.empty(self.frameshape(self.dimensions), dtype=np.uint8)
+		self.framememory = memoryview(self.frame).cast('B')
+		self.process: subprocess.Popen | None = None
+
+	@staticmethod
+	def probe_dimensions(url) -> tuple:
+		video = cv2.VideoCapture(url)
+		dimensions = (int(video.get(cv2.CAP_PROP_FRAME_WIDTH)), int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+		video.release()
+		if not all(dimensions):
+			raise ValueError(f'Could not determine the dimensions of {url}')
+		return dimensions
+
+	def command(self) -> list[str]:
+		ffmpeg = shutil.which('ffmpeg') or 'ffmpeg'
+		cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin']
+		if self.hwaccel:
+			cmd += ['-hwaccel', self.hwaccel]
+		if str(self.url).startswith('rtsp://'):
+			cmd += ['-rtsp_transport', 'tcp']
+		cmd += ['-i', str(self.url), '-an', '-sn']
+		scale = f'scale={self.dimensions[0]}:{self.dimensions[1]}'
+		if self.double_width:
+			# Repeat the columns like the opencv backend does before scaling to the frame size
+			scale = f'scale=iw*2:ih:flags=neighbor,{scale}'
+		cmd += ['-vf', scale]
+		cmd += ['-f', 'rawvideo', '-pix_fmt', self.pixel_format, 'pipe:1']
+		return cmd
+
+	def open(self) -> None:
+		self.process = subprocess.Popen(
+			self.command(), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=self.frame.nbytes
+		)
+
+	def read(self) -> tuple[bool, np.ndarray | None]:
+		# Fill the reused frame buffer straight from the pipe
+		received = 0
+		while received < self.frame.nbytes:
+			n = self.process.stdout.readinto(self.framememory[received:])
+			if not n:
+				return False, None
+			received += n
+		return True, self.frame
+
+	def release(self) -> None:
+		if self.process is not None:
+			self.process.kill()
+			self.process.stdout.close()
+			self.process.wait()
+			self.process = None
+
+
+capture_types = {backend.type_key: backend for backend in CaptureBackend.__subclasses__()}
+
+
+def create_capture(type_key, url, dimensions=None, pixel_format='bgr24', hwaccel=None, double_width=False) -> CaptureBackend:
+	backend = capture_types.get(type_key)
+	if not backend:
+		raise ValueError(type_key)
+	return backend(url, dimensions=dimensions, pixel_format=pixel_format, hwaccel=hwaccel, double_width=double_width)
+
+
+if __name__ == '__main__':
+	# Decode a local file with every backend, e.g. python capture.py video.mp4 640 360
+	path = sys.argv[1]
+	dimensions = (int(sys.argv[2]), int(sys.argv[3])) if len(sys.argv) > 3 else None
+	for type_key in capture_types:
+		capture = create_capture(type_key, path, dimensions)
+		capture.open()
+		frames = 0
+		shape = None
+		start = time.time()
+		while True:
+			check, frame = capture.read()
+			if not check:
+				break
+			shape = frame.shape
+			frames += 1
+		capture.release()
+		elapsed = time.time() - start
+		print(f'{type_key}: {frames} frames of shape {shape} at {frames / elapsed:0.1f} fps')
@@ -0,0 +1,177 @@
+from settings import UserSettings, Settings
+from utils import mainlogger
+
+# Priority classes, lower runs first
+RECHECK = 0
+LIVE = 1
+BACKLOG = 2
+
+# Activity levels of a stream, each has its own detection interval
+IDLE = 'idle'
+NORMAL = 'normal'
+ACTIVE = 'active'
+
+
+class DetectionScheduler:
+	"""
+	Decides what the object detector infers next, based on deadlines and measured inference costs.
+
+	Every stream is due once per detection interval, which adapts to its activity:
+	- ACTIVE, streams with an event, a nonzero recordcounter or motion in the last activity_hold, run at
+	  detect_interval_active
+	- NORMAL, run at detect_interval, the stream's own or UserSettings.check_detection_time
+	- IDLE, motion gated streams without motion or detections for idle_after, back off to detect_interval_idle.
+	  Streams without motion gating never go idle as nothing would wake them up again
+	When the intervals ask for more inference time than the detector has, all intervals are stretched by the same
+	factor, the detector budget is the share of the time not reserved for the backlog.
+
+	The work of one cycle is picked by priority class:
+	- RECHECK, streams whose recordcounter is rising but did not start an event yet, run as soon as they have a new frame
+	- LIVE, due armed streams, earliest deadline first
+	- BACKLOG, file annotation, fills the time until the next deadline
+
+	The length of a cycle is the shortest stream interval. When the due streams cost more than the live share of a
+	cycle, the streams with the latest deadlines wait until the work that was picked is done. Their deadlines move
+	together and stay ahead of the streams that ran, so they go first next time and every stream slows down by the same
+	amount instead of some starving. The backlog always gets backlog_share of a cycle, so annotation finishes even when
+	the live streams could use all of it.
+	"""
+
+	def __init__(self, streaminfos: dict, backlog_share: float | None = None):
+		self.streaminfos = streaminfos
+		self.backlog_share = getattr(UserSettings, 'backlog_share', 0.2) if backlog_share is None else backlog_share
+		self.activity_hold = getattr(UserSettings, 'activity_hold', UserSettings.check_detection_time * 10).total_seconds()
+		self.idle_after = getattr(UserSettings, 'idle_after', UserSettings.check_detection_time * 60).total_seconds()
+		self.streamids = [streamid for streamid in streaminfos.keys() if streamid != 0]
+		self.nextdue: dict[int, float] = {streamid: 0.0 for streamid in self.streamids}
+		self.lastrun: dict[int, float] = {streamid: 0.0 for streamid in self.streamids}
+		self.lastactive: dict[int, float] = {streamid: 0.0 for streamid in self.streamids}
+		self.level: dict[int, str] = {streamid: NORMAL for streamid in self.streamids}
+		self.intervals: dict[int, float] = {streamid: self.levelinterval(streamid, NORMAL) for streamid in self.streamids}
+		self.fps: dict[int, float] = {streamid: 0.0 for streamid in self.streamids}
+		# Streams to recheck with the earliest time the recheck may run
+		self.rechecks: dict[int, float] = {}
+		# Running average seconds of work per inference, per stream and for the backlog
+		self.cost: dict[int, float] = {streamid: Settings.avg_inference_time for streamid in self.streamids}
+		self.backlogcost: float = Settings.avg_inference_time
+		self.stretch: float = 1.0
+		self.shed: int = 0
+
+	def levelinterval(self, streamid, level) -> float:
+		streaminfo = self.streaminfos[streamid]
+		interval = streaminfo.get('detect_interval', UserSettings.check_detection_time)
+		if level == ACTIVE:
+			interval = streaminfo.get('detect_interval_active', getattr(UserSettings, 'detect_interval_active', interval / 2))
+		elif level == IDLE:
+			interval = streaminfo.get('detect_interval_idle', getattr(UserSettings, 'detect_interval_idle', interval * 4))
+		return interval.total_seconds()
+
+	def interval(self, streamid) -> float:
+		return self.intervals[streamid]
+
+	@property
+	def cycle(self) -> float:
+		return min(self.intervals.values(), default=UserSettings.check_detection_time.total_seconds())
+
+	def activity(self, streamid, now: float) -> str:
+		streaminfo = self.streaminfos[streamid]
+		# Streams start out normal and only go idle after a quiet idle_after
+		if not self.lastactive[streamid] or streaminfo['recordflag'].value == 1 or streaminfo['recordcounter']:
+			self.lastactive[streamid] = now
+		motionboxes = streaminfo.get('motionboxes')
+		gated = streaminfo.get('motion_gating') and motionboxes is not None
+		if gated:
+			self.lastactive[streamid] = max(self.lastactive[streamid], motionboxes.lastmotion)
+		quiet = now - self.lastactive[streamid]
+		if quiet < self.activity_hold:
+			return ACTIVE
+		if gated and quiet > self.idle_after:
+			return IDLE
+		return NORMAL
+
+	def updaterates(self, now: float, backlog: bool):
+		"""
+		Sets the interval of every stream from its activity. Intervals are stretched evenly when they ask for more than
+		the detector budget, a stream whose interval changes gets a deadline based on when it last ran.
+		"""
+		levels = {streamid: self.activity(streamid, now) for streamid in self.streamids}
+		intervals = {streamid: self.levelinterval(streamid, level) for streamid, level in levels.items()}
+		budget = 1 - self.backlog_share if backlog else 1.0
+		demand = sum(self.cost[streamid] / interval for streamid, interval in intervals.items())
+		self.stretch = max(1.0, demand / budget)
+		for streamid in self.streamids:
+			interval = intervals[streamid] * self.stretch
+			if levels[streamid] != self.level[streamid]:
+				mainlogger.info(f'Stream {streamid} is {levels[streamid]}, detecting every {interval:0.2f} seconds')
+				self.level[streamid] = levels[streamid]
+			if interval != self.intervals[streamid]:
+				self.intervals[streamid] = interval
+				self.nextdue[streamid] = self.lastrun[streamid] + interval
+
+	def stats(self) -> dict:
+		# Activity level, interval and measured detection rate of every stream
+		return {streamid: f'{self.level[streamid]} {self.intervals[streamid]:0.2f}s {self.fps[streamid]:0.2f}fps'
+				for streamid in self.streamids}
+
+	def recheck(self, streamid, after: float = 0.0):
+		# A recheck waiting for a new frame of its stream passes the time the frame is expected as after
+		self.rechecks[streamid] = after
+
+	def plan(self, now: float, backlog: bool = False) -> tuple[list[int], list[int]]:
+		"""
+		Picks the streams to infer now. Returns the stream ids to recheck and the due live stream ids, earliest deadline
+		first. Pass backlog=True when there is file annotation waiting so its share of the cycle is kept free.
+		"""
+		self.updaterates(now, backlog)
+		rechecks = sorted(streamid for streamid, after in self.rechecks.items() if after <= now)
+		for streamid in rechecks:
+			del self.rechecks[streamid]
+		budget = self.cycle * (1 - self.backlog_share if backlog else 1)
+		budget -= sum(self.cost[streamid] for streamid in rechecks)
+		due = sorted((streamid for streamid in self.streamids if self.nextdue[streamid] <= now and streamid not in rechecks),
+					 key=lambda streamid: self.nextdue[streamid])
+		live = []
+		for streamid in due:
+			# Always run the most overdue stream so the live streams keep moving even when the estimates are too high
+			if live and budget < self.cost[streamid]:
+				break
+			budget -= self.cost[streamid]
+			live.append(streamid)
+		for streamid in live + rechecks:
+			# Track the measured detection rate, then schedule the next run one interval from now. A stream that ran
+			# late is not made to catch up on the runs it missed
+			if self.lastrun[streamid]:
+				self.fps[streamid] = self.fps[streamid] * 0.9 + 0.1 / max(now - self.lastrun[streamid], 1e-3)
+			self.lastrun[streamid] = now
+			self.nextdue[streamid] = now + self.intervals[streamid]
+		postponed = due[len(live):]
+		if postponed:
+			# The streams that did not fit are due once the detector is free again, in the same order
+			busy = sum(self.cost[streamid] for streamid in live + rechecks)
+			delay = now + busy - self.nextdue[postponed[0]]
+			for streamid in postponed:
+				self.nextdue[streamid] += delay
+			self.shed += len(postponed)
+			mainlogger.debug(f'Detector overloaded, postponed {len(postponed)} streams')
+		return rechecks, live
+
+	def backlogitems(self, now: float) -> int:
+		# The number of file annotation inferences that fit before the next deadline, at least the backlog share
+		available = max(min(self.nextdue.values(), default=now) - now, self.cycle * self.backlog_share)
+		return int(available // self.backlogcost)
+
+	def idletime(self, now: float) -> float:
+		# Time until the next stream or recheck is due
+		return max(min([*self.nextdue.values(), *self.rechecks.values()], default=now + self.cycle) - now, 0.0)
+
+	def record(self, streamids, elapsed: float):
+		# The streams of a batch share its time equally
+		if not streamids:
+			return
+		cost = elapsed / len(streamids)
+		for streamid in streamids:
+			self.cost[streamid] = (self.cost[streamid] * 19 + cost) / 20
+
+	def recordbacklog(self, count: int, elapsed: float):
+		if count:
+			self.backlogcost = (self.backlogcost * 19 + elapsed / count) / 20
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
+import numpy as np
 import supervision as sv
+from detector.utils.ops import CachedLetterBox
 
 class DetectorAPI(ABC):
     type_key: str
@@ -10,4 +12,69 @@ class DetectorAPI(ABC):
 
     @abstractmethod
     def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
-        pass
\ No newline at end of file
+        pass
+
+    def detect_batch(self, images, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> list[sv.Detections]:
+        """
+        Detects objects in several images with one call, returns the detections of every image in the same order.
+        Detectors that can infer a whole batch at once override this, the default runs the images one by one.
+        """
+        return [self.detect(image, classes=classes, conf=conf, nms=nms, iou=iou, verbose=verbose) for image in images]
+
+    # Batch helpers for letterboxed yolov8 models. A detector using them sets model_height, model_width, batch_size
+    # (None for models with a dynamic batch dimension), postprocessor, letterboxes = {} and buffers = threading.local()
+    # and implements inference to run one chunk through its runtime
+
+    def inference(self, batch) -> list[np.ndarray]:
+        raise NotImplementedError
+
+    def letterbox(self, shape) -> CachedLetterBox:
+        shape = tuple(shape[:2])
+        if shape not in self.letterboxes:
+            self.letterboxes[shape] = CachedLetterBox(shape, (self.model_height, self.model_width))
+        return self.letterboxes[shape]
+
+    def inputbuffer(self, num_images, buffers) -> np.ndarray:
+        """
+        Model input buffer in buffers for exactly num_images, slots left from larger earlier batches are not part of
+        it so they are never inferred. Grows when needed and remembers the letterbox geometry of every slot.
+        """
+        batch = getattr(buffers, 'batch', None)
+        if batch is None or len(batch) < num_images:
+            buffers.batch = np.empty((num_images, self.model_height, self.model_width, 3), dtype=np.uint8)
+            buffers.geometry = [None] * num_images
+        return buffers.batch[:num_images]
+
+    def letterbox_batch(self, images, buffers=None) -> np.ndarray:
+        # Letterbox all images into a (batch, height, width, 3) uint8 input buffer, by default the one of this thread.
+        # The padding of a slot is only redrawn when its previous image had another shape
+        buffers = buffers or self.buffers
+        batch = self.inputbuffer(len(images), buffers)
+        for i, img in enumerate(images):
+            letterbox = self.letterbox(img.shape)
+            letterbox(img, out=batch[i], filled=buffers.geometry[i] is letterbox)
+            buffers.geometry[i] = letterbox
+        return batch
+
+    def inference_batch(self, batch) -> list[np.ndarray]:
+        """
+        Runs a preprocessed batch through the model in chunks of the batch size the model was built for, the last chunk
+        is padded with zeros and the outputs of the padding are dropped. Models with a dynamic batch size take the
+        whole batch at once. Returns the raw outputs of the model with len(batch) as their first dimension.
+        """
+        if self.batch_size is None or len(batch) == self.batch_size:
+            return self.inference(batch)
+        outputs = []
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            num_images = len(chunk)
+            if num_images < self.batch_size:
+                padding = np.zeros((self.batch_size - num_images, *chunk.shape[1:]), dtype=chunk.dtype)
+                chunk = np.concatenate((chunk, padding))
+            outputs.append([output[:num_images] for output in self.inference(chunk)])
+        return [np.concatenate(output) for output in zip(*outputs)]
+
+    def postprocess_batch(self, outputs, orig_image_sizes, classes, conf, nms, iou) -> list[sv.Detections]:
+        return [self.postprocessor(outputs, orig_image_size, conf, classes, nms, iou, index=i,
+                                   ratio_pad=self.letterbox(orig_image_size).ratio_pad)
+                for i, orig_image_size in enumerate(orig_image_sizes)]
@@ -24,6 +24,7 @@ class BaseModelConfig(BaseModel):
     path: Optional[str] = Field(None, title="Custom Object detection model path.")
     width: int = Field(default=320, title="Object detection model input width.")
     height: int = Field(default=320, title="Object detection model input height.")
+    batch_size: int = Field(default=1, ge=1, title="Batch size the object detection model was built for.")
     detection_model_type: ModelTypeEnum = Field(
         default=ModelTypeEnum.yolov8, title="Object Detection Model Type"
     )
@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import numpy as np
+import supervision as sv
+
+from .detector_api import DetectorAPI
+
+logger = logging.getLogger(__name__)
+
+
+class DetectorPipeline:
+    """
+    Runs the requests for one detector instance in three stages, each on its own thread, so the next request is
+    letterboxed while the current one is on the NPU and the previous one is postprocessed.
+
+    The preprocess stage takes requests from the shared request queue of a DetectorPool, but only when one of the depth
+    model input buffers is free, so the pool hands new work to the instance that can start on it first. The stages are
+    connected by queues of at most depth items. The detector has to implement preprocess_batch(images, buffers),
+    inference_batch(batch) and postprocess_batch(outputs, orig_image_sizes, classes, conf, nms, iou). Requests for
+    other detector methods are run as a whole on the preprocess thread.
+    """
+
+    stages = ('preprocess', 'inference', 'postprocess')
+
+    def __init__(self, detector: DetectorAPI, requests: queue.Queue, depth: int = 2):
+        self.detector = detector
+        self.requests = requests
+        self.free: queue.Queue = queue.Queue()
+        for i in range(depth):
+            self.free.put(SimpleNamespace())
+        self.inferencequeue: queue.Queue = queue.Queue(maxsize=depth)
+        self.postprocessqueue: queue.Queue = queue.Queue(maxsize=depth)
+        # Running average time in seconds every stage spends on a request
+        self.latency: dict[str, float] = {stage: 0.0 for stage in self.stages}
+        self.threads: list[threading.Thread] = []
+        for stage in self.stages:
+            thread = threading.Thread(target=getattr(self, f'_{stage}'), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @staticmethod
+    def supports(detector: DetectorAPI) -> bool:
+        return all(hasattr(detector, method) for method in ('preprocess_batch', 'inference_batch', 'postprocess_batch'))
+
+    def measure(self, stage, start):
+        self.latency[stage] = self.latency[stage] * 0.9 + (time.perf_counter() - start) * 0.1
+
+    def metrics(self) -> dict:
+        return {
+            'inference queue': self.inferencequeue.qsize(),
+            'postprocess queue': self.postprocessqueue.qsize(),
+            **{f'{stage} ms': latency * 1000 for stage, latency in self.latency.items()},
+        }
+
+    def _preprocess(self):
+        while True:
+            buffers = self.free.get()
+            request = self.requests.get()
+            if request is None:
+                self.inferencequeue.put(None)
+                return
+            future, method, args, kwargs = request
+            if not future.set_running_or_notify_cancel():
+                self.free.put(buffers)
+                continue
+            try:
+                if method not in ('detect', 'detect_batch') or not len(args[0]):
+                    future.set_result(getattr(self.detector, method)(*args, **kwargs))
+                    self.free.put(buffers)
+                    continue
+                start = time.perf_counter()
+                images = [args[0]] if method == 'detect' else args[0]
+                batch = self.detector.preprocess_batch(images, buffers)
+                orig_image_sizes = [image.shape[:2] for image in images]
+                self.measure('preprocess', start)
+            except BaseException as e:
+                future.set_exception(e)
+                self.free.put(buffers)
+                continue
+            self.inferencequeue.put((future, method, kwargs, buffers, batch, orig_image_sizes))
+
+    def _inference(self):
+        while True:
+            item = self.inferencequeue.get()
+            if item is None:
+                self.postprocessqueue.put(None)
+                return
+            future, method, kwargs, buffers, batch, orig_image_sizes = item
+            try:
+                start = time.perf_counter()
+                outputs = self.detector.inference_batch(batch)
+                self.measure('inference', start)
+            except BaseException as e:
+                future.set_exception(e)
+                continue
+            finally:
+                # The outputs do not refer to the input buffer, so it can take the next request
+                self.free.put(buffers)
+            self.postprocessqueue.put((future, method, kwargs, outputs, orig_image_sizes))
+
+    def _postprocess(self):
+        while True:
+            item = self.postprocessqueue.get()
+            if item is None:
+                return
+            future, method, kwargs, outputs, orig_image_sizes = item
+            try:
+                start = time.perf_counter()
+                results = self.detector.postprocess_batch(
+                    outputs, orig_image_sizes, kwargs.get('classes'), kwargs.get('conf', 0.2), kwargs.get('nms', True),
+                    kwargs.get('iou', 0.5)
+                )
+                self.measure('postprocess', start)
+                future.set_result(results[0] if method == 'detect' else results)
+            except BaseException as e:
+                future.set_exception(e)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+
+if __name__ == '__main__':
+    # Compare running the stages one after the other with the pipeline, using a stand-in detector whose stages take a
+    # fixed time like letterboxing, an NPU inference and postprocessing would
+    class StandInDetector(DetectorAPI):
+        type_key = 'standin'
+
+        def __init__(self, detector_config):
+            self.model_names = {0: 'person'}
+
+        def preprocess_batch(self, images, buffers=None):
+            time.sleep(0.004)
+            return np.stack(images)
+
+        def inference_batch(self, batch):
+            time.sleep(0.010)
+            return [batch]
+
+        def postprocess_batch(self, outputs, orig_image_sizes, classes, conf, nms, iou):
+            time.sleep(0.004)
+            return [sv.Detections(xyxy=np.array([[0, 0, image[0, 0], image[0, 0]]], dtype=np.float32))
+                    for image in outputs[0]]
+
+        def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
+            batch = self.preprocess_batch([image])
+            return self.postprocess_batch(self.inference_batch(batch), [image.shape[:2]], classes, conf, nms, iou)[0]
+
+    detector = StandInDetector(None)
+    images = [np.full((4, 4), i, dtype=np.float32) for i in range(100)]
+    start = time.time()
+    for image in images:
+        detector.detect(image)
+    print(f'sequential: {len(images) / (time.time() - start):0.0f} images/s')
+
+    requests = queue.Queue()
+    pipeline = DetectorPipeline(detector, requests)
+    start = time.time()
+    futures = []
+    for image in images:
+        future = Future()
+        requests.put((future, 'detect', (image,), {}))
+        futures.append(future)
+    results = [future.result() for future in futures]
+    print(f'pipelined: {len(images) / (time.time() - start):0.0f} images/s, {pipeline.metrics()}')
+    assert [int(detections.xyxy[0, 2]) for detections in results] == list(range(len(images)))
+    requests.put(None)
+    pipeline.join()
@@ -0,0 +1,126 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import supervision as sv
+
+from . import create_detector
+from .detector_api import DetectorAPI
+from .detector_pipeline import DetectorPipeline
+
+logger = logging.getLogger(__name__)
+
+
+class DetectorPool:
+    """
+    Owns one detector instance per NPU core (or core mask) and runs requests on them concurrently.
+
+    Requests go through one shared queue. Instances whose detector can be split in stages run them as a
+    DetectorPipeline with max_inflight + 1 requests in flight, so preprocessing and postprocessing overlap with the
+    inference. Other instances have one worker thread and run one request at a time, as their postprocessor and
+    letterbox buffers are not safe to share between threads. Results are returned in the order the requests were
+    made. The pool has the same detect, detect_batch and model_names interface as a single detector, so live streams,
+    the zoom in double checks and file annotation can all share it. The detectors release the GIL while inferring, so
+    threads are enough to keep all cores busy.
+    """
+
+    def __init__(self, detector_configs: list, max_inflight: int = 1, factory=create_detector):
+        if not detector_configs:
+            raise ValueError("A detector pool needs at least one detector configuration")
+        self.requests: queue.Queue = queue.Queue()
+        self.detectors: list[DetectorAPI] = [factory(config) for config in detector_configs]
+        self.model_names = self.detectors[0].model_names
+        self.workers: list[threading.Thread] = []
+        self.pipelines: list[DetectorPipeline] = []
+        for detector in self.detectors:
+            if DetectorPipeline.supports(detector):
+                self.pipelines.append(DetectorPipeline(detector, self.requests, depth=max_inflight + 1))
+                continue
+            worker = threading.Thread(target=self._worker, args=(detector,), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __len__(self):
+        return len(self.detectors)
+
+    def _worker(self, detector: DetectorAPI):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            future, method, args, kwargs = request
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(getattr(detector, method)(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        # Runs detector.method(*args, **kwargs) on the first free instance
+        future = Future()
+        self.requests.put((future, method, args, kwargs))
+        return future
+
+    def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
+        return self.submit('detect', image, classes=classes, conf=conf, nms=nms, iou=iou, verbose=verbose).result()
+
+    def detect_batch(self, images, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> list[sv.Detections]:
+        # Spread the batch over all instances and put the results back together in order. Pipelined instances get two
+        # chunks each so one can be letterboxed while the other is inferred
+        num_chunks = len(self.detectors) * (2 if self.pipelines else 1)
+        chunks = [chunk for chunk in np.array_split(np.arange(len(images)), num_chunks) if len(chunk)]
+        futures = [
+            self.submit('detect_batch', [images[i] for i in chunk], classes=classes, conf=conf, nms=nms, iou=iou,
+                        verbose=verbose)
+            for chunk in chunks
+        ]
+        return [detections for future in futures for detections in future.result()]
+
+    def map(self, images, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> list[sv.Detections]:
+        # Single image requests for images that cannot be batched, e.g. crops of different sizes
+        futures = [self.submit('detect', image, classes=classes, conf=conf, nms=nms, iou=iou, verbose=verbose)
+                   for image in images]
+        return [future.result() for future in futures]
+
+    def metrics(self) -> dict:
+        # Queue depths and average stage latencies of every pipelined instance
+        metrics = {'requests queue': self.requests.qsize()}
+        for i, pipeline in enumerate(self.pipelines):
+            metrics.update({f'{i} {name}': value for name, value in pipeline.metrics().items()})
+        return metrics
+
+    def close(self):
+        for i in range(len(self.workers) + len(self.pipelines)):
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+        for pipeline in self.pipelines:
+            pipeline.join()
+
+
+if __name__ == '__main__':
+    # Run the pool with a stand-in detector that takes a fixed time per image like an NPU core would
+    class StandInDetector(DetectorAPI):
+        type_key = 'standin'
+
+        def __init__(self, detector_config):
+            self.inference_time = detector_config
+            self.model_names = {0: 'person'}
+
+        def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
+            time.sleep(self.inference_time)
+            return sv.Detections(xyxy=np.array([[0, 0, image[0, 0], image[0, 0]]], dtype=np.float32))
+
+    images = [np.full((4, 4), i, dtype=np.float32) for i in range(30)]
+    for num_cores in (1, 2, 3):
+        pool = DetectorPool([0.01] * num_cores, factory=StandInDetector)
+        start = time.time()
+        results = pool.detect_batch(images)
+        elapsed = time.time() - start
+        assert [int(detections.xyxy[0, 2]) for detections in results] == list(range(len(images)))
+        print(f'{num_cores} cores: {len(images) / elapsed:0.0f} images/s')
+        pool.close()
@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+from typing import Literal
+
+import cv2
+import numpy as np
+import supervision as sv
+from pydantic import Field
+from detector.detector_config import BaseDetectorConfig
+from detector.detector_api import DetectorAPI
+from detector.utils.ops import CachedLetterBox
+from detector.models.yolov8 import YoloV8Postprocessor
+
+logger = logging.getLogger(__name__)
+
+DETECTOR_KEY = "cpu"
+
+default_model_path = "/models/cpu/yolov8n.onnx"
+
+
+class CpuDetectorConfig(BaseDetectorConfig):
+    type_key: Literal[DETECTOR_KEY]
+    num_threads: int = Field(default=0, ge=0, title="Inference threads, 0 uses all cores.")
+    runtime: Literal["auto", "onnxruntime", "opencv"] = Field(
+        default="auto", title="Inference runtime, auto uses onnxruntime when it is installed and opencv otherwise."
+    )
+
+
+class Cpu(DetectorAPI):
+    """
+    Runs an ONNX export of a yolov8 model on the CPU, for hosts without an NPU and for testing.
+
+    Uses onnxruntime when available and the OpenCV DNN module otherwise. fp32, fp16 and int8 (quantize-dequantize)
+    exports work, the input is converted to whatever type the model expects. Models exported with a dynamic batch
+    dimension infer a whole batch in one run, fixed batch models run in chunks of their batch size.
+    """
+    type_key = DETECTOR_KEY
+
+    def __init__(self, config: CpuDetectorConfig):
+        self.model_height = config.model.height
+        self.model_width = config.model.width
+        self.model_path = config.model.path or default_model_path
+        self.model_names = config.model.names
+        self.num_threads = config.num_threads or os.cpu_count()
+        self.postprocessor = YoloV8Postprocessor(self.model_height, self.model_width, len(self.model_names))
+        self.letterboxes: dict[tuple, CachedLetterBox] = {}
+        self.buffers = threading.local()
+
+        if not os.path.isfile(self.model_path):
+            logger.error(f"Model {self.model_path} not found, export one with: yolo export model=yolov8n.pt format=onnx")
+            raise FileNotFoundError(self.model_path)
+
+        runtime = config.runtime
+        if runtime == "auto":
+            try:
+                import onnxruntime  # noqa
+                runtime = "onnxruntime"
+            except ImportError:
+                runtime = "opencv"
+        self.runtime = runtime
+
+        if runtime == "onnxruntime":
+            # Import this on class instantiation to avoid errors on systems without onnxruntime
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.num_threads
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self.session = onnxruntime.InferenceSession(
+                self.model_path, sess_options=options, providers=["CPUExecutionProvider"]
+            )
+            model_input = self.session.get_inputs()[0]
+            self.input_name = model_input.name
+            self.input_type = np.float16 if model_input.type == "tensor(float16)" else np.float32
+            self.batch_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else None
+        else:
+            cv2.setNumThreads(self.num_threads)
+            self.net = cv2.dnn.readNetFromONNX(self.model_path)
+            self.input_type = np.float32
+            self.batch_size = 1
+        logger.info(f"Loaded {self.model_path} with {runtime} using {self.num_threads} threads")
+
+    def preprocess_batch(self, images, buffers=None) -> np.ndarray:
+        # Letterbox into a uint8 buffer, by default the one of this thread, then one conversion to a normalised RGB
+        # NCHW tensor
+        batch = self.letterbox_batch(images, buffers)
+        tensor = batch[..., ::-1].transpose(0, 3, 1, 2).astype(self.input_type)
+        tensor *= 1 / 255
+        return tensor
+
+    def inference(self, tensor) -> list[np.ndarray]:
+        if self.runtime == "onnxruntime":
+            return self.session.run(None, {self.input_name: tensor})
+        self.net.setInput(tensor)
+        return list(self.net.forward(self.net.getUnconnectedOutLayersNames()))
+
+    def detect_batch(self, images, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> list[sv.Detections]:
+        if not len(images):
+            return []
+        outputs = self.inference_batch(self.preprocess_batch(images))
+        return self.postprocess_batch(outputs, [image.shape[:2] for image in images], classes, conf, nms, iou)
+
+    def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
+        return self.detect_batch([image], classes=classes, conf=conf, nms=nms, iou=iou, verbose=verbose)[0]
@@ -2,6 +2,7 @@ import copy
 import logging
 import os
 import sys
+import threading
 import urllib
 from typing import Literal
 
@@ -11,7 +12,8 @@ import numpy as np
 from pydantic import Field
 from detector.detector_config import BaseDetectorConfig, BaseModelConfig
 from detector.detector_api import DetectorAPI
-from detector.utils.ops import xywh2xyxy, scale_boxes, LetterBox
+from detector.utils.ops import xywh2xyxy, scale_boxes, CachedLetterBox
+from detector.models.yolov8 import YoloV8Postprocessor
 
 try:
     from hide_warnings import hide_warnings  # noqa
@@ -76,8 +78,13 @@ class Rknn(DetectorAPI):
         self.core_mask = config.core_mask
         self.model_height = config.model.height
         self.model_width = config.model.width
+        self.batch_size = config.model.batch_size
         self.model_path = config.model.path or "default-yolov8n"
         self.model_names = config.model.names
+        self.postprocessor = YoloV8Postprocessor(self.model_height, self.model_width, len(self.model_names))
+        # Letterbox geometry per input shape and model input buffers per thread, see letterbox and inputbuffer
+        self.letterboxes: dict[tuple, CachedLetterBox] = {}
+        self.buffers = threading.local()
 
         if self.model_path in yolov8_suffix:
             if self.model_path == "default-yolov8n":
@@ -111,7 +118,7 @@ class Rknn(DetectorAPI):
     def preprocess(self, img):
 
         # Resize the image
-        return [np.stack(self.pre_transform(img))]
+        return self.preprocess_batch([img])
 
         # shape = img.shape[:2]  # current shape [height, width]
         # new_shape = (self.model_height, self.model_width)
@@ -122,21 +129,17 @@ class Rknn(DetectorAPI):
         # img = [np.stack([img])]
         # return img
 
-    def pre_transform(self, img):
-        same_shapes = False
-        new_shape = (self.model_height, self.model_width)
-        letterbox = LetterBox(new_shape, auto=same_shapes)
-        return [letterbox(image=img)]
-
     def inference(self, tensor_input):
-        inf_res = self.detector.inference(inputs=tensor_input)
+        # One chunk of batch_size images, the NPU takes the letterboxed uint8 NHWC buffer as it is
+        inf_res = self.detector.inference(inputs=[tensor_input])
         return inf_res
 
+    def preprocess_batch(self, images, buffers=None):
+        return self.letterbox_batch(images, buffers)
+
     def postprocess(self, inference_results, orig_image_size, classes, conf, nms, iou):
-        res = self.process_yolov8(inference_results, orig_image_size, conf, classes)
-        if nms:
-            res = res.with_nms(threshold=iou)
-        return res
+        return self.postprocessor(inference_results, orig_image_size, conf, classes, nms, iou,
+                                  ratio_pad=self.letterbox(orig_image_size).ratio_pad)
 
     def process_yolov8(self, prediction, orig_image_size, conf_thres=0.25, classes=[0]):
         """
@@ -180,10 +183,18 @@ class Rknn(DetectorAPI):
             class_id=prediction[:, 5].astype(int)
         )
 
+    def detect_batch(self, images, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> list[sv.Detections]:
+        if not len(images):
+            return []
+        batch = self.preprocess_batch(images)
+        orig_image_sizes = [image.shape[:2] for image in images]
+        outputs = self.inference_batch(batch)
+        return self.postprocess_batch(outputs, orig_image_sizes, classes, conf, nms, iou)
+
     def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
 
         pre_image = self.preprocess(image)
         orig_image_size = image.shape[:2]
-        inf_result = self.inference(pre_image)
+        inf_result = self.inference_batch(pre_image)
         post_processes = self.postprocess(inf_result, orig_image_size, classes, conf, nms, iou)
         return post_processes
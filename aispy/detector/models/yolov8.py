@@ -0,0 +1,202 @@
+import time
+
+import numpy as np
+import supervision as sv
+
+from detector.utils.ops import scale_boxes
+
+
+def class_aware_nms(boxes, scores, class_ids, iou_threshold=0.5) -> np.ndarray:
+    """
+    Class aware non maximum suppression.
+
+    Boxes of different classes are shifted apart so they never overlap and all classes are handled at once. Only
+    meant for the boxes that are left after the confidence filter, which are a few dozen at most, so the IoU of all
+    pairs is computed in one go and only the greedy pass over it is a Python loop.
+
+    Returns:
+    keep: indices of the boxes to keep, highest score first
+    """
+    if len(boxes) <= 1:
+        return np.arange(len(boxes))
+    order = scores.argsort()[::-1]
+    # The offset is the whole coordinate range, so boxes with negative coordinates are separated as well
+    shifted = boxes[order] + class_ids[order, None] * (boxes.max() - boxes.min() + 1)
+    x1, y1, x2, y2 = shifted.T
+    areas = (x2 - x1) * (y2 - y1)
+    w = np.clip(np.minimum(x2[:, None], x2) - np.maximum(x1[:, None], x1), 0, None)
+    h = np.clip(np.minimum(y2[:, None], y2) - np.maximum(y1[:, None], y1), 0, None)
+    intersection = w * h
+    iou = intersection / (areas[:, None] + areas - intersection + 1e-9)
+    suppresses = np.triu(iou > iou_threshold, 1)
+    keep = np.ones(len(order), dtype=bool)
+    for i in range(len(order)):
+        if keep[i]:
+            keep[suppresses[i]] = False
+    return order[keep]
+
+
+class YoloV8Postprocessor:
+    """
+    Turns the raw output of a yolov8 model into detections, with buffers that are allocated once per output shape.
+
+    Two output layouts are supported:
+    - The exported default, one array of shape (batch_size, 4 + num_classes, num_boxes) with xywh boxes.
+    - Split heads as emitted by RKNN optimised models, per stride a DFL box output of shape
+      (batch_size, 4 * reg_max, h, w), a class score output of shape (batch_size, num_classes, h, w) and optionally a
+      score sum output of shape (batch_size, 1, h, w). This layout needs no transpose at all.
+
+    Boxes are filtered on confidence before anything else is done with them, so only the few candidates left are
+    transposed, decoded and scaled.
+    """
+
+    def __init__(self, model_height, model_width, num_classes=80, strides=(8, 16, 32), reg_max=16):
+        self.model_height = model_height
+        self.model_width = model_width
+        self.num_classes = num_classes
+        self.strides = strides
+        self.reg_max = reg_max
+        self.dfl_weights = np.arange(reg_max, dtype=np.float32)
+        self.classmasks: dict[tuple | None, np.ndarray] = {}
+        self.buffers: dict[tuple, np.ndarray] = {}
+        self.anchors: dict[tuple, np.ndarray] = {}
+
+    def classmask(self, classes) -> np.ndarray:
+        # Boolean lookup of the wanted classes by class id
+        key = tuple(classes) if classes else None
+        if key not in self.classmasks:
+            mask = np.zeros(self.num_classes, dtype=bool)
+            mask[list(key) if key else slice(None)] = True
+            self.classmasks[key] = mask
+        return self.classmasks[key]
+
+    def buffer(self, shape, dtype) -> np.ndarray:
+        key = (shape, np.dtype(dtype))
+        if key not in self.buffers:
+            self.buffers[key] = np.empty(shape, dtype=dtype)
+        return self.buffers[key]
+
+    def grid(self, height, width) -> np.ndarray:
+        # Anchor centres of a feature map in grid cells, shape (2, height * width)
+        if (height, width) not in self.anchors:
+            y, x = np.mgrid[:height, :width].astype(np.float32) + 0.5
+            self.anchors[(height, width)] = np.stack((x.ravel(), y.ravel()))
+        return self.anchors[(height, width)]
+
+    def candidates(self, prediction, index, conf_thres, classmask) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # prediction has shape (batch_size, 4 + num_classes, num_boxes)
+        scores = prediction[index, 4:, :]
+        maxscores = np.max(scores, axis=0, out=self.buffer(scores.shape[1:], scores.dtype))
+        selected = np.flatnonzero(maxscores > conf_thres)
+        class_ids = scores[:, selected].argmax(0)
+        wanted = classmask[class_ids]
+        selected = selected[wanted]
+        class_ids = class_ids[wanted]
+        xywh = prediction[index, :4, selected].astype(np.float32)
+        boxes = np.empty_like(xywh)
+        boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+        boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+        return boxes, maxscores[selected].astype(np.float32), class_ids
+
+    def candidates_split(self, outputs, index, conf_thres, classmask) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        per_branch = 3 if len(outputs) % 3 == 0 and outputs[2].shape[1] == 1 else 2
+        all_boxes, all_scores, all_class_ids = [], [], []
+        for branch, stride in enumerate(self.strides):
+            box, scores = outputs[branch * per_branch], outputs[branch * per_branch + 1]
+            height, width = scores.shape[2:]
+            scores = scores[index].reshape(scores.shape[1], height * width)
+            if per_branch == 3:
+                # The score sum is at least the best class score, so it rules out most cells in one pass
+                scoresum = outputs[branch * per_branch + 2][index].reshape(height * width)
+                selected = np.flatnonzero(scoresum >= conf_thres)
+                maxscores = scores[:, selected].max(0)
+                keep = maxscores > conf_thres
+                selected = selected[keep]
+                maxscores = maxscores[keep]
+            else:
+                maxscores = np.max(scores, axis=0, out=self.buffer(scores.shape[1:], scores.dtype))
+                selected = np.flatnonzero(maxscores > conf_thres)
+                maxscores = maxscores[selected]
+            class_ids = scores[:, selected].argmax(0)
+            wanted = classmask[class_ids]
+            selected = selected[wanted]
+            if not len(selected):
+                continue
+            # Distribution focal loss decoding of the remaining cells only
+            dfl = box[index].reshape(4, self.reg_max, height * width)[:, :, selected].astype(np.float32)
+            dfl = np.exp(dfl - dfl.max(1, keepdims=True))
+            distances = (dfl / dfl.sum(1, keepdims=True)).transpose(0, 2, 1) @ self.dfl_weights
+            anchors = self.grid(height, width)[:, selected]
+            boxes = np.empty((len(selected), 4), dtype=np.float32)
+            boxes[:, :2] = (anchors - distances[:2]).T * stride
+            boxes[:, 2:] = (anchors + distances[2:]).T * stride
+            all_boxes.append(boxes)
+            all_scores.append(maxscores[wanted].astype(np.float32))
+            all_class_ids.append(class_ids[wanted])
+        if not all_boxes:
+            return np.empty((0, 4), dtype=np.float32), np.empty(0, dtype=np.float32), np.empty(0, dtype=int)
+        return np.concatenate(all_boxes), np.concatenate(all_scores), np.concatenate(all_class_ids)
+
+    def __call__(self, outputs, orig_image_size, conf_thres=0.25, classes=None, nms=True, iou=0.5, index=0,
+                 ratio_pad=None) -> sv.Detections:
+        """
+        Processes the output of one image of a batch.
+
+        Args:
+        outputs: list with the model outputs in one of the supported layouts
+        orig_image_size: (height, width) of the image before the letterbox
+        index: which image of the batch to process
+        ratio_pad: the letterbox geometry of the image, computed from orig_image_size when not given
+
+        Returns:
+        detection: a Supervision Detections object
+        """
+        assert 0 <= conf_thres <= 1, f"Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0"
+        classmask = self.classmask(classes)
+        if len(outputs) == 1:
+            boxes, scores, class_ids = self.candidates(outputs[0], index, conf_thres, classmask)
+        else:
+            boxes, scores, class_ids = self.candidates_split(outputs, index, conf_thres, classmask)
+        if nms and len(boxes) > 1:
+            keep = class_aware_nms(boxes, scores, class_ids, iou)
+            boxes, scores, class_ids = boxes[keep], scores[keep], class_ids[keep]
+        boxes = scale_boxes((self.model_height, self.model_width), boxes, orig_image_size, ratio_pad=ratio_pad)
+        return sv.Detections(
+            xyxy=boxes,
+            confidence=scores,
+            class_id=class_ids.astype(int)
+        )
+
+
+if __name__ == '__main__':
+    # Compare with the transpose everything postprocess of the rknn detector on a typical 320x320 output
+    from types import SimpleNamespace
+    from detector.detectors.rknn import Rknn
+
+    rng = np.random.default_rng(0)
+    num_classes, num_boxes = 80, 2100
+    prediction = np.zeros((1, 4 + num_classes, num_boxes), dtype=np.float32)
+    prediction[0, :2] = rng.uniform(20, 300, (2, num_boxes))
+    prediction[0, 2:4] = rng.uniform(10, 60, (2, num_boxes))
+    prediction[0, 4:] = rng.uniform(0, 0.05, (num_classes, num_boxes))
+    objects = rng.choice(num_boxes, 40, replace=False)
+    prediction[0, 4 + rng.integers(0, num_classes, len(objects)), objects] = rng.uniform(0.3, 0.9, len(objects))
+    orig_image_size = (1080, 1920)
+
+    reference = SimpleNamespace(model_height=320, model_width=320)
+    postprocessor = YoloV8Postprocessor(320, 320, num_classes)
+    results = []
+    for name, run in (
+        ('current', lambda: Rknn.process_yolov8(reference, prediction.copy(), orig_image_size, 0.25, None)
+         .with_nms(threshold=0.5)),
+        ('postprocessor', lambda: postprocessor([prediction], orig_image_size, 0.25, None, iou=0.5)),
+    ):
+        detections = run()
+        order = np.lexsort(detections.xyxy.T)
+        results.append((detections.xyxy[order], detections.class_id[order]))
+        start = time.perf_counter()
+        for i in range(1000):
+            run()
+        elapsed = (time.perf_counter() - start) / 1000
+        print(f'{name}: {elapsed * 1000:0.3f} ms, {len(detections)} detections')
+    assert np.allclose(results[0][0], results[1][0], atol=1e-3) and (results[0][1] == results[1][1]).all()
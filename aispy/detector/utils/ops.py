@@ -143,4 +143,41 @@ class LetterBox:
         labels["instances"].denormalize(*labels["img"].shape[:2][::-1])
         labels["instances"].scale(*ratio)
         labels["instances"].add_padding(padw, padh)
-        return labels
\ No newline at end of file
+        return labels
+
+class CachedLetterBox:
+    """
+    Letterbox for one input shape, the same geometry as LetterBox with its defaults but computed once.
+
+    Cameras and their substreams have fixed dimensions so one instance per input shape is kept and reused. The resize
+    writes straight into the image area of a model input buffer, the padding of which only has to be filled when the
+    buffer was last used for another geometry. ratio_pad can be passed to scale_boxes to undo the letterbox.
+    """
+
+    def __init__(self, input_shape, new_shape=(640, 640), color=114):
+        self.input_shape = tuple(input_shape[:2])
+        self.new_shape = tuple(new_shape)
+        self.color = color
+        shape = self.input_shape
+        r = min(new_shape[0] / shape[0], new_shape[1] / shape[1])
+        self.new_unpad = int(round(shape[1] * r)), int(round(shape[0] * r))
+        dw = (new_shape[1] - self.new_unpad[0]) / 2
+        dh = (new_shape[0] - self.new_unpad[1]) / 2
+        self.top, self.left = int(round(dh - 0.1)), int(round(dw - 0.1))
+        self.ratio_pad = ((r, r), (self.left, self.top))
+
+    def __call__(self, image, out=None, filled=False) -> np.ndarray:
+        """
+        Letterboxes image into out, a (new_height, new_width, 3) buffer, or into a new array when out is None. Pass
+        filled=True when out already holds the padding of this geometry.
+        """
+        if out is None:
+            out = np.empty((*self.new_shape, *image.shape[2:]), dtype=image.dtype)
+        if not filled:
+            out.fill(self.color)
+        area = out[self.top:self.top + self.new_unpad[1], self.left:self.left + self.new_unpad[0]]
+        if image.shape[:2] != area.shape[:2]:
+            cv2.resize(image, self.new_unpad, dst=area, interpolation=cv2.INTER_LINEAR)
+        else:
+            area[...] = image
+        return out
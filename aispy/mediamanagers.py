@@ -1,90 +1,300 @@
+import functools
+import itertools
 import pathlib
 import time
+from collections import deque
 from datetime import datetime
 import cv2
+import numpy as np
+import supervision as sv
+from supervision.draw.utils import draw_polygon
 import multiprocessing as mp
+from memory_managers import SharedFrameQueue, SharedFrameLease, SharedFrameRing
+from snapshot_encoder import SnapshotEncoder
 from settings import UserSettings, Settings
-from utils import mainlogger, send_photo_telegram
+from utils import mainlogger
+from telegram_delivery import send_photo_telegram
+
+def nodetections() -> sv.Detections:
+	return sv.Detections(
+		xyxy=np.empty((0, 4), dtype=np.float32),
+		confidence=np.empty(0, dtype=np.float32),
+		class_id=np.empty(0, dtype=int),
+		data={'class_name': np.empty(0, dtype=str)}
+	)
+
+
+def pair_detections(start: sv.Detections, end: sv.Detections) -> tuple[np.ndarray, np.ndarray]:
+	# Pairs boxes of the same class in two keyframes by IoU, highest first, returns the indices of the pairs in both
+	pairs: list[tuple[int, int]] = []
+	if len(start) and len(end):
+		iou = sv.box_iou_batch(start.xyxy, end.xyxy)
+		iou[start.class_id[:, None] != end.class_id[None, :]] = 0
+		for i, j in zip(*np.unravel_index(np.argsort(-iou, axis=None), iou.shape)):
+			if iou[i, j] <= 0:
+				break
+			if all(i != a and j != b for a, b in pairs):
+				pairs.append((i, j))
+	return np.array([i for i, j in pairs], dtype=int), np.array([j for i, j in pairs], dtype=int)
+
+
+def interpolate_detections(start: sv.Detections, end: sv.Detections, t: float, pairs=None) -> sv.Detections:
+	"""
+	Detections for a frame between two keyframes, t is where the frame lies between them from 0 to 1.
+
+	Paired boxes move linearly from one keyframe to the other. Boxes without a partner in the next keyframe are held
+	until halfway, new boxes show from halfway.
+	"""
+	startpaired, endpaired = pair_detections(start, end) if pairs is None else pairs
+	none = np.empty(0, dtype=int)
+	startonly = np.setdiff1d(np.arange(len(start)), startpaired) if t < 0.5 else none
+	endonly = np.setdiff1d(np.arange(len(end)), endpaired) if t >= 0.5 else none
+	moved = start[startpaired]
+	moved.xyxy = moved.xyxy * (1 - t) + end.xyxy[endpaired] * t
+	return sv.Detections.merge([moved, start[startonly], end[endonly]])
+
+
+def detection_track_path(clippath) -> pathlib.Path:
+	# The sidecar with the detections of a clip lives next to it
+	clippath = pathlib.Path(clippath)
+	return clippath.with_name(f'{clippath.stem}.detections.npz')
+
+
+def save_detection_track(clippath, rows: list[sv.Detections], frameindices: list[int], fps: float):
+	"""
+	Stores the detections of a clip as one compressed npz with a row per box: frame index, xyxy box, confidence,
+	class id, class name and track id. Written to a temporary file first so a reader never sees half a track.
+	"""
+	detections = sv.Detections.merge(rows) if rows else nodetections()
+	frame = np.repeat(np.array(frameindices, dtype=np.int32), [len(row) for row in rows])
+	trackpath = detection_track_path(clippath)
+	temppath = trackpath.with_name(f'{trackpath.name}.tmp')
+	with open(temppath, 'wb') as file:
+		np.savez_compressed(
+			file,
+			frame=frame,
+			xyxy=detections.xyxy.astype(np.float32),
+			confidence=detections.confidence.astype(np.float32),
+			class_id=detections.class_id.astype(np.int16),
+			class_name=detections.data['class_name'].astype(str),
+			tracker_id=(detections.tracker_id if detections.tracker_id is not None
+						else np.zeros(len(detections))).astype(np.int32),
+			fps=np.float32(fps)
+		)
+	temppath.replace(trackpath)
+
+
+def load_detection_track(clippath) -> dict[str, np.ndarray] | None:
+	trackpath = detection_track_path(clippath)
+	if not trackpath.is_file():
+		return None
+	with np.load(trackpath) as track:
+		return {name: track[name] for name in track.files}
+
+
+def annotate_frame(frame, detections: sv.Detections, detectarea, dimensions, boxannotator: sv.BoxAnnotator) -> np.ndarray:
+	# Draws the detect area and the boxes labelled with class, confidence and track id on the frame itself
+	zone = sv.PolygonZone(detectarea, dimensions)
+	frame = draw_polygon(frame, zone.polygon, color=sv.Color.GREEN)
+	labels = [f'#{tracker_id} {class_name} {conf: 0.2f}' for class_name, conf, tracker_id
+			  in zip(detections.data['class_name'], detections.confidence, detections.tracker_id)]
+	return boxannotator.annotate(frame, detections=detections, labels=labels)
+
+
+def render_annotated_clip(clippath, outpath, streaminfo) -> bool:
+	"""
+	Renders a copy of a clip with the boxes of its detection track burned in, for when a clip is viewed or sent.
+	Returns False when the clip has no detection track (yet).
+	"""
+	track = load_detection_track(clippath)
+	if track is None:
+		return False
+	boxannotator = sv.BoxAnnotator(thickness=2, text_thickness=2, text_scale=1, color=sv.Color.BLUE)
+	cap = cv2.VideoCapture(str(clippath))
+	out = None
+	# Rows are stored in frame order, so the rows of a frame are one slice
+	bounds = np.searchsorted(track['frame'], np.arange(track['frame'][-1] + 2 if len(track['frame']) else 1))
+	index = 0
+	try:
+		while True:
+			check, frame = cap.read()
+			if not check:
+				break
+			# The boxes are in the coordinates of the stream
+			if frame.shape[:2] != (streaminfo['dimensions'][1], streaminfo['dimensions'][0]):
+				frame = cv2.resize(frame, streaminfo['dimensions'])
+			if out is None:
+				out = cv2.VideoWriter(str(outpath), cv2.VideoWriter_fourcc(*'mp4v'), float(track['fps']),
+									  streaminfo['dimensions'])
+			rows = slice(bounds[index], bounds[index + 1]) if index + 1 < len(bounds) else slice(0, 0)
+			detections = sv.Detections(
+				xyxy=track['xyxy'][rows],
+				confidence=track['confidence'][rows],
+				class_id=track['class_id'][rows].astype(int),
+				tracker_id=track['tracker_id'][rows],
+				data={'class_name': track['class_name'][rows]}
+			)
+			out.write(annotate_frame(frame, detections, streaminfo['detectarea'], streaminfo['dimensions'], boxannotator))
+			index += 1
+	finally:
+		cap.release()
+		if out is not None:
+			out.release()
+	return out is not None
+
 
 class FileAnnotator(mp.Process):
+	"""
+	Finds the objects in recorded clips and stores them in a detection track next to the clip, overlays are only
+	rendered when a clip is viewed or sent, see render_annotated_clip.
+
+	Only every annotate_every-th frame of a clip is a keyframe that is decoded and goes to the detector, the other
+	frames are only grabbed to count them. Their boxes are interpolated from the keyframes around them and boxes that
+	pair up between keyframes keep their track id. Keyframes are passed in annotationbuffer, a shared memory ring of the
+	annotator that the detector reads, so the queues only carry sequence numbers and the detections. Clips are annotated
+	one at a time so a single ring in the dimensions of the largest stream serves all streams, keyframes of other streams
+	are resized to it and the detector scales their boxes back. At most as many keyframes as the ring holds are waiting
+	for the detector at any time, so none is overwritten before it was inferred.
+	"""
 	def __init__(self, sendqueue: mp.Queue, receivequeue: mp.Queue, ordersqueue: mp.Queue, streaminfos):
 		super().__init__()
 		self.sendqueue = sendqueue
 		self.receivequeue = receivequeue
 		self.ordersqueue = ordersqueue
 		self.streaminfos = streaminfos
+		self.annotate_every = max(int(getattr(UserSettings, 'annotate_every', 5)), 1)
+		# Every clip is a job, results of an earlier job that failed halfway are dropped
+		self.jobs = itertools.count()
+		self.trackids = itertools.count(1)
+		width, height = max((streaminfo['dimensions'] for streamid, streaminfo in streaminfos.items() if streamid != 0),
+							key=lambda dimensions: dimensions[0] * dimensions[1], default=(1, 1))
+		self.annotationbuffer = SharedFrameRing(
+			max_items=getattr(UserSettings, 'annotation_buffer_size', 4),
+			itemshape=(height, width, 3),
+			datatype=np.uint8
+		)
 
 	def run(self):
 		mainlogger.info(f'Fileannotator starting')
-		working = False
 		while True:
+			order = self.ordersqueue.get()
 			try:
-				if not working:
-					order = self.ordersqueue.get()
-					working = True
-					streamid = order[0]
-					infilepath = pathlib.Path(order[1])
-					infilename = infilepath.name
-					mainlogger.info(f'Starting inference on {infilename} from stream {streamid}')
-					outfilepath = Settings.annotatedvideodir.joinpath(str(streamid))
-					outfilepath.mkdir(parents=True,exist_ok=True)
-					outfilename = str(outfilepath.joinpath(infilename))
-					fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-					out = cv2.VideoWriter(outfilename, fourcc, UserSettings.record_fps, self.streaminfos[streamid]['dimensions'])
-					cap = cv2.VideoCapture(order[1])
-				if working:
-					while cap.isOpened():
-						check, frame = cap.read()
-						if check:
-							if self.sendqueue.qsize() <= 100:
-								self.sendqueue.put((frame, streamid))
-							else:
-								break
-						else:
-							mainlogger.debug(f'All video frames placed on queue')
-							self.sendqueue.put((None, 'Done'))
-							cap.release()
-					qsize = self.receivequeue.qsize()
-					for i in range(qsize):
-						try:
-							packet = self.receivequeue.get_nowait()
-						except:
-							break
-						if packet[1] == 'Done':
-							out.release()
-							working = False
-							mainlogger.info(f'Inference on {infilename} from stream {streamid} done')
-						else:
-							out.write(packet[0])
-					time.sleep(0.1)
+				self.annotatefile(order[0], pathlib.Path(order[1]))
 			except:
 				mainlogger.exception(f'Problem with fileannotator restarting in 10')
 				self.ordersqueue.put(order)
-				working = False
 				time.sleep(10)
 
+	def annotatefile(self, streamid, infilepath: pathlib.Path):
+		infilename = infilepath.name
+		mainlogger.info(f'Starting inference on {infilename} from stream {streamid}')
+		started = time.time()
+		job = next(self.jobs)
+		annotationbuffer = self.annotationbuffer
+		height, width = annotationbuffer.itemshape[:2]
+		cap = cv2.VideoCapture(str(infilepath))
+		fps = cap.get(cv2.CAP_PROP_FPS) or UserSettings.record_fps
+		# Keyframes in the order they were read as [sequence number, frame index]
+		keyframes: deque[list] = deque()
+		results: dict[int, sv.Detections] = {}
+		rows: list[sv.Detections] = []
+		frameindices: list[int] = []
+		pending = 0
+		numframes = 0
+		try:
+			while cap.grab():
+				if numframes % self.annotate_every == 0:
+					check, frame = cap.retrieve()
+					if not check:
+						break
+					if frame.shape[:2] != (height, width):
+						frame = cv2.resize(frame, (width, height))
+					# Wait for the detector to free a slot in the ring
+					while pending >= annotationbuffer.max_items:
+						pending -= self.receive(job, results)
+					seq = annotationbuffer.append(frame)
+					self.sendqueue.put((job, streamid, seq))
+					pending += 1
+					keyframes.append([seq, numframes])
+					self.addrows(keyframes, results, rows, frameindices, numframes)
+				numframes += 1
+		finally:
+			cap.release()
+		mainlogger.debug(f'All keyframes of {infilename} placed on queue')
+		self.sendqueue.put((job, streamid, None))
+		while self.receive(job, results) is not None:
+			pass
+		self.addrows(keyframes, results, rows, frameindices, numframes, final=True)
+		save_detection_track(infilepath, rows, frameindices, fps)
+		mainlogger.info(f'Inference on {infilename} from stream {streamid} done, {numframes} frames with '
+						f'{-(-numframes // self.annotate_every)} inferences in {time.time() - started:0.1f} seconds')
+
+	def receive(self, job, results: dict) -> int | None:
+		# Waits for the next result of the job, returns the number of keyframes it completed or None when the job is
+		# done
+		while True:
+			packetjob, seq, detections = self.receivequeue.get()
+			if packetjob != job:
+				continue
+			if seq is None:
+				return None
+			# A keyframe the detector could not read anymore gets no boxes
+			results[seq] = nodetections() if detections is None else detections
+			return 1
+
+	def addrows(self, keyframes: deque, results: dict, rows: list, frameindices: list, numframes, final=False):
+		# Adds the detections of every frame up to the next keyframe once its own and the next keyframe's detections
+		# are known, the frames after the last keyframe of a clip keep its boxes
+		while keyframes and keyframes[0][0] in results:
+			if len(keyframes) > 1 and keyframes[1][0] not in results or len(keyframes) == 1 and not final:
+				break
+			seq, frameindex = keyframes.popleft()
+			start = results.pop(seq)
+			if start.tracker_id is None:
+				start.tracker_id = np.array([next(self.trackids) for i in range(len(start))], dtype=int)
+			end = results[keyframes[0][0]] if keyframes else start
+			nextindex = keyframes[0][1] if keyframes else numframes
+			pairs = pair_detections(start, end)
+			if end is not start:
+				end.tracker_id = np.array([next(self.trackids) for i in range(len(end))], dtype=int)
+				end.tracker_id[pairs[1]] = start.tracker_id[pairs[0]]
+			for index in range(frameindex, nextindex):
+				detections = interpolate_detections(start, end, (index - frameindex) / (nextindex - frameindex), pairs)
+				if len(detections):
+					rows.append(detections)
+					frameindices.append(index)
+
 class SnapshotProcessor(mp.Process):
-	def __init__(self, snapshotqueue: mp.Queue):
+	def __init__(self, snapshotqueue: SharedFrameQueue):
 		super().__init__()
 		self.snapshotqueue = snapshotqueue
+		self.encoder: SnapshotEncoder | None = None
 
 	def run(self):
 		mainlogger.info(f'Starting snapshot process')
+		self.encoder = SnapshotEncoder()
 		while True:
+			# The frame is a view over a slot of the queue, the slot is given back once the frame is encoded
+			lease = self.snapshotqueue.get()
+			streamid, frame, caption = lease.item
 			try:
-				item = self.snapshotqueue.get()
-				streamid = item[0]
-				frame = item[1]
-				caption = item[2]
-				snapshot_dir = Settings.snapshot_dir.joinpath(f'{streamid}')
-				snapshot_dir.mkdir(parents=True, exist_ok=True)
-				datetimestr = datetime.now().strftime("%Y%m%d_%H%M%S")
-				if caption == None: caption = datetimestr
-				snapshot_filename = str(snapshot_dir.joinpath(f'{datetimestr}.png'))
-				cv2.imwrite(snapshot_filename,frame)
-				# Send the photo to telegram
-				send_photo_telegram(snapshot_filename, Settings.telegram_alarmlist, Settings.fractal_token, caption)
+				future = self.encoder.encode(frame)
 			except:
-				mainlogger.warning(f'Problem in snapshot processor restarting in 10')
-				self.snapshotqueue.put(item)
-				time.sleep(10)
\ No newline at end of file
+				mainlogger.exception(f'Problem in snapshot processor')
+				lease.release()
+				continue
+			future.add_done_callback(functools.partial(self.deliver, lease, streamid, caption))
+
+	def deliver(self, lease: SharedFrameLease, streamid, caption, future):
+		# Runs on the encoder thread, the Telegram send starts before the snapshot is written to disk
+		lease.release()
+		try:
+			encoded = future.result()
+			datetimestr = datetime.now().strftime("%Y%m%d_%H%M%S")
+			if caption == None: caption = datetimestr
+			send_photo_telegram(encoded, Settings.telegram_alarmlist, Settings.fractal_token, caption)
+			snapshot_dir = Settings.snapshot_dir.joinpath(f'{streamid}')
+			snapshot_dir.mkdir(parents=True, exist_ok=True)
+			snapshot_dir.joinpath(f'{datetimestr}.{self.encoder.extension}').write_bytes(encoded)
+		except:
+			mainlogger.exception(f'Problem delivering the snapshot of stream {streamid}')
@@ -1,11 +1,20 @@
 import collections
 import datetime
 import multiprocessing as mp
+import os
+import queue
+import time
 from threading import RLock
 from multiprocessing.shared_memory import SharedMemory
 
+import cv2
 import numpy as np
 
+try:
+	from turbojpeg import TurboJPEG
+except ImportError:
+	TurboJPEG = None
+
 
 class SharedFrameDeque:
 	def  __init__(self, max_items, itemshape: tuple, datatype):
@@ -67,7 +76,7 @@ class SharedFrameDeque:
 			else:
 				self.head.value = (self.head.value - 1 + self.max_items) % self.max_items
 				self.tail.value = self.head.value
-			self.memory.buf[self.memhead:self.memhead + self.itemsize] = item
+			self.memory.buf[self.memhead:self.memhead + self.itemsize] = item.tobytes()
 			return
 
 	def getbyarrayindex(self, arrayindex) -> np.ndarray:
@@ -122,12 +131,512 @@ class SharedFrameDeque:
 		self.memory.close()
 		self.memory.unlink()
 
-class MotionDetectorSharedMemory:
-	def __init__(self, max_items):
-		self.max_items = max_items
-		self.frameid = mp.Value('I', 0)
-		self.sharedmemory = 1
+class SharedFrameRing:
+	"""
+	Single writer, many reader ring of frames in shared memory without any process shared locks.
+
+	The head and tail counters live in the header of the shared memory segment together with a seqlock counter and
+	the frame sequence number and capture timestamp of every slot. Frames are addressed by their sequence number, the
+	n-th appended frame has sequence number n. The writer makes a slot's seqlock counter odd while it copies a frame in and even again when
+	done, readers check that the counter is even and unchanged after reading to detect a slot being overwritten.
+	Every process that reads keeps its own cursor, nothing is ever removed by a reader.
+
+	There are no memory barriers, the counters are plain aligned 64 bit loads and stores, so on weakly ordered CPUs like
+	ARM the frame bytes and the counter can become visible in a different order. The seqlock relies on the single writer
+	holding a slot only for the memcpy of one frame, which happens max_items frames after the reader got its view, and
+	on readers checking isvalid again after they are done with the frame. A reader racing the writer is max_items
+	frames behind and is caught by that re-check in practice, it is not a guarantee.
+	"""
+	# Header layout in uint64 words: head, tail, (seqlock, frame sequence) for every slot, then a float64 timestamp
+	# for every slot
+	HEAD = 0
+	TAIL = 1
+	SLOTS = 2
+	ALIGN = 64
+
+	def __init__(self, max_items, itemshape: tuple, datatype):
+		self.max_items: int = int(max_items)
+		self.itemshape: tuple = itemshape
+		self.datatype: np.dtype = datatype
+		self.itemsize: int = int(np.prod(itemshape) * datatype().itemsize)
+		headerwords = self.SLOTS + 3 * self.max_items
+		self.headersize: int = -(-headerwords * 8 // self.ALIGN) * self.ALIGN
+		self.memsize: int = self.headersize + self.max_items * self.itemsize
+		self.memory: SharedMemory = SharedMemory(create=True, size=self.memsize)
+		self.creatorpid: int = os.getpid()
+		self.header: np.ndarray = np.ndarray((headerwords,), dtype=np.uint64, buffer=self.memory.buf)
+		self.header[:] = 0
+		self.slotlocks: np.ndarray = self.header[self.SLOTS:self.SLOTS + 2 * self.max_items:2]
+		self.slotseqs: np.ndarray = self.header[self.SLOTS + 1:self.SLOTS + 2 * self.max_items:2]
+		self.slottimes: np.ndarray = self.header[self.SLOTS + 2 * self.max_items:].view(np.float64)
+		self.frames: np.ndarray = np.ndarray(
+			(self.max_items, *self.itemshape), dtype=self.datatype, buffer=self.memory.buf, offset=self.headersize
+		)
+
+	@property
+	def head(self) -> int:
+		# Sequence number of the oldest frame still held
+		return int(self.header[self.HEAD])
+
+	@property
+	def tail(self) -> int:
+		# Sequence number the next frame will get
+		return int(self.header[self.TAIL])
+
+	@property
+	def latestseq(self) -> int:
+		return self.tail - 1
+
+	def append(self, item: np.ndarray, timestamp: float | None = None) -> int:
+		# Only one process may ever append to a ring, timestamp is the capture time and defaults to now
+		if item.dtype != self.datatype:
+			raise ValueError('Wrong item datatype')
+		if item.shape != self.itemshape:
+			raise ValueError('Wrong item shape')
+		seq = self.tail
+		slot = seq % self.max_items
+		if seq - self.head >= self.max_items:
+			self.header[self.HEAD] = seq - self.max_items + 1
+		self.slotlocks[slot] += 1
+		np.copyto(self.frames[slot], item)
+		self.slotseqs[slot] = seq
+		self.slottimes[slot] = time.time() if timestamp is None else timestamp
+		self.slotlocks[slot] += 1
+		self.header[self.TAIL] = seq + 1
+		return seq
+
+	def getview(self, seq: int) -> tuple[np.ndarray, int]:
+		"""
+		Returns a read-only view of frame seq straight over the shared memory together with a token for isvalid.
+		The view only holds the frame while isvalid(seq, token) is True.
+		"""
+		if not self.head <= seq < self.tail:
+			raise IndexError(f'Frame {seq} is not in the ring, it holds {self.head} to {self.tail - 1}')
+		slot = seq % self.max_items
+		token = int(self.slotlocks[slot])
+		view = self.frames[slot]
+		view.flags.writeable = False
+		return view, token
+
+	def getlatestview(self) -> tuple[np.ndarray, int, int] | None:
+		# Retries until a complete frame was seen, the writer only holds a slot for a single memcpy. None while the ring
+		# is still empty
+		while True:
+			seq = self.latestseq
+			if seq < 0:
+				return None
+			view, token = self.getview(seq)
+			if self.isvalid(seq, token):
+				return view, seq, token
+
+	def gettimestamp(self, seq: int) -> float:
+		if not self.head <= seq < self.tail:
+			raise IndexError(f'Frame {seq} is not in the ring, it holds {self.head} to {self.tail - 1}')
+		while True:
+			slot = seq % self.max_items
+			token = int(self.slotlocks[slot])
+			timestamp = float(self.slottimes[slot])
+			if self.isvalid(seq, token):
+				return timestamp
+			if seq < self.head:
+				raise IndexError(f'Frame {seq} was overwritten while reading')
+
+	def isvalid(self, seq: int, token: int) -> bool:
+		slot = seq % self.max_items
+		return token % 2 == 0 and int(self.slotlocks[slot]) == token and int(self.slotseqs[slot]) == seq
+
+	def get(self, seq: int) -> np.ndarray:
+		# Copying read, retried until the copy was not torn by the writer
+		while True:
+			view, token = self.getview(seq)
+			frame = view.copy()
+			if self.isvalid(seq, token):
+				return frame
+			if seq < self.head:
+				raise IndexError(f'Frame {seq} was overwritten while reading')
+
+	def __getitem__(self, key: int) -> np.ndarray:
+		# Negative keys count back from the latest frame, positive keys are sequence numbers
+		if not isinstance(key, int):
+			raise TypeError('Invalid argument type')
+		if key < 0:
+			key = self.tail + key
+		return self.get(key)
+
+	def __len__(self):
+		return self.tail - self.head
+
+	def __del__(self):
+		del self.slotlocks, self.slotseqs, self.slottimes, self.header, self.frames
+		try:
+			self.memory.close()
+		except BufferError:
+			# Views handed out with getview still reference the buffer
+			pass
+		if os.getpid() == self.creatorpid:
+			self.memory.unlink()
+
+class SharedCompressedRing:
+	"""
+	Single writer, many reader ring of JPEG compressed frames in a shared memory arena with variable size slots.
+
+	Meant for the pre record buffer, frames are only decoded when a recording reads them. The index works like
+	SharedFrameRing, every slot additionally stores the offset and length of its frame in the arena. The arena is
+	filled front to back and wraps around, the oldest frames are dropped from the head before their bytes are reused.
+	"""
+	# Header layout in uint64 words: head, tail, arena write position, (seqlock, frame sequence, offset, length) for
+	# every slot, then a float64 timestamp for every slot
+	HEAD = 0
+	TAIL = 1
+	WRITEPOS = 2
+	SLOTS = 3
+	ALIGN = 64
+
+	def __init__(self, max_items, arenasize: int, quality: int = 80):
+		self.max_items: int = int(max_items)
+		self.arenasize: int = int(arenasize)
+		self.quality: int = quality
+		headerwords = self.SLOTS + 5 * self.max_items
+		self.headersize: int = -(-headerwords * 8 // self.ALIGN) * self.ALIGN
+		self.memsize: int = self.headersize + self.arenasize
+		self.memory: SharedMemory = SharedMemory(create=True, size=self.memsize)
+		self.creatorpid: int = os.getpid()
+		self.header: np.ndarray = np.ndarray((headerwords,), dtype=np.uint64, buffer=self.memory.buf)
+		self.header[:] = 0
+		slots = self.header[self.SLOTS:self.SLOTS + 4 * self.max_items].reshape(self.max_items, 4)
+		self.slotlocks: np.ndarray = slots[:, 0]
+		self.slotseqs: np.ndarray = slots[:, 1]
+		self.slotoffsets: np.ndarray = slots[:, 2]
+		self.slotlengths: np.ndarray = slots[:, 3]
+		self.slottimes: np.ndarray = self.header[self.SLOTS + 4 * self.max_items:].view(np.float64)
+		self.arena: np.ndarray = np.ndarray((self.arenasize,), dtype=np.uint8, buffer=self.memory.buf, offset=self.headersize)
+		self.jpeg = TurboJPEG() if TurboJPEG is not None else None
+
+	@property
+	def head(self) -> int:
+		return int(self.header[self.HEAD])
+
+	@property
+	def tail(self) -> int:
+		return int(self.header[self.TAIL])
+
+	@property
+	def latestseq(self) -> int:
+		return self.tail - 1
+
+	def encode(self, item: np.ndarray) -> np.ndarray:
+		if self.jpeg is not None:
+			return np.frombuffer(self.jpeg.encode(item, quality=self.quality), dtype=np.uint8)
+		check, encoded = cv2.imencode('.jpg', item, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+		if not check:
+			raise ValueError('Could not encode frame')
+		return encoded.reshape(-1)
+
+	def decode(self, encoded: np.ndarray) -> np.ndarray:
+		if self.jpeg is not None:
+			return self.jpeg.decode(encoded.tobytes())
+		return cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+
+	def overlaps(self, slot: int, start: int, end: int) -> bool:
+		offset = int(self.slotoffsets[slot])
+		return offset < end and start < offset + int(self.slotlengths[slot])
+
+	def append(self, item: np.ndarray, timestamp: float | None = None) -> int:
+		# Only one process may ever append to a ring, timestamp is the capture time and defaults to now
+		return self.appendencoded(self.encode(item), timestamp)
+
+	def appendencoded(self, encoded: np.ndarray, timestamp: float | None = None) -> int:
+		# Appends a frame that was already encoded with encode, so the encode can run outside the writer
+		length = encoded.nbytes
+		if length > self.arenasize:
+			raise ValueError(f'Encoded frame of {length} bytes does not fit in an arena of {self.arenasize} bytes')
+		seq = self.tail
+		writepos = int(self.header[self.WRITEPOS])
+		start = writepos if writepos + length <= self.arenasize else 0
+		end = start + length
+		# Drop the oldest frames whose slot or bytes are about to be reused, the frames at the end of the arena are
+		# older than the ones at the start so they go as well when wrapping around
+		head = self.head
+		while head < seq:
+			slot = head % self.max_items
+			if seq - head >= self.max_items or self.overlaps(slot, start, end) or \
+					(start < writepos and self.overlaps(slot, writepos, self.arenasize)):
+				head += 1
+			else:
+				break
+		self.header[self.HEAD] = head
+		slot = seq % self.max_items
+		self.slotlocks[slot] += 1
+		self.arena[start:end] = encoded
+		self.slotseqs[slot] = seq
+		self.slotoffsets[slot] = start
+		self.slotlengths[slot] = length
+		self.slottimes[slot] = time.time() if timestamp is None else timestamp
+		self.slotlocks[slot] += 1
+		self.header[self.WRITEPOS] = end
+		self.header[self.TAIL] = seq + 1
+		return seq
+
+	def getencoded(self, seq: int) -> np.ndarray:
+		# Copies the compressed frame out, retried until the copy was not torn by the writer
+		while True:
+			if not self.head <= seq < self.tail:
+				raise IndexError(f'Frame {seq} is not in the ring, it holds {self.head} to {self.tail - 1}')
+			slot = seq % self.max_items
+			token = int(self.slotlocks[slot])
+			offset = int(self.slotoffsets[slot])
+			encoded = self.arena[offset:offset + int(self.slotlengths[slot])].copy()
+			# The head moves past a frame before its bytes are reused
+			if token % 2 == 0 and int(self.slotlocks[slot]) == token and int(self.slotseqs[slot]) == seq and seq >= self.head:
+				return encoded
+
+	def get(self, seq: int) -> np.ndarray:
+		return self.decode(self.getencoded(seq))
+
+	def getview(self, seq: int) -> tuple[np.ndarray, int]:
+		# Same interface as SharedFrameRing so the recorder can read from either, the frame is decoded on read
+		return self.get(seq), seq
+
+	def isvalid(self, seq: int, token: int) -> bool:
+		# Decoded frames are private copies
+		return True
+
+	def gettimestamp(self, seq: int) -> float:
+		if not self.head <= seq < self.tail:
+			raise IndexError(f'Frame {seq} is not in the ring, it holds {self.head} to {self.tail - 1}')
+		while True:
+			slot = seq % self.max_items
+			token = int(self.slotlocks[slot])
+			timestamp = float(self.slottimes[slot])
+			if token % 2 == 0 and int(self.slotlocks[slot]) == token and int(self.slotseqs[slot]) == seq:
+				return timestamp
+			if seq < self.head:
+				raise IndexError(f'Frame {seq} was overwritten while reading')
+
+	def __getitem__(self, key: int) -> np.ndarray:
+		if not isinstance(key, int):
+			raise TypeError('Invalid argument type')
+		if key < 0:
+			key = self.tail + key
+		return self.get(key)
+
+	def __len__(self):
+		return self.tail - self.head
+
+	def __del__(self):
+		del self.slotlocks, self.slotseqs, self.slotoffsets, self.slotlengths, self.slottimes, self.header, self.arena
+		try:
+			self.memory.close()
+		except BufferError:
+			pass
+		if os.getpid() == self.creatorpid:
+			self.memory.unlink()
+
+class SharedMotionBoxes:
+	"""
+	Latest motion boxes of a stream, written by its motion detector and read by the object detector without locks.
+
+	Uses the same seqlock scheme as SharedFrameRing, the header holds the seqlock counter, the number of boxes, the
+	sequence number of the frame they were found in, the time of that frame and the last time any motion was seen.
+	"""
+	# Header layout in uint64 words: seqlock, count, frame sequence, then float64 frame time and last motion time
+	LOCK = 0
+	COUNT = 1
+	FRAMESEQ = 2
+	TIMESTAMP = 3
+	LASTMOTION = 4
+	HEADERWORDS = 8
+
+	def __init__(self, max_items=32):
+		self.max_items: int = int(max_items)
+		self.memory: SharedMemory = SharedMemory(create=True, size=self.HEADERWORDS * 8 + self.max_items * 4 * 4)
+		self.creatorpid: int = os.getpid()
+		self.header: np.ndarray = np.ndarray((self.HEADERWORDS,), dtype=np.uint64, buffer=self.memory.buf)
+		self.header[:] = 0
+		self.times: np.ndarray = self.header.view(np.float64)
+		self.boxes: np.ndarray = np.ndarray(
+			(self.max_items, 4), dtype=np.int32, buffer=self.memory.buf, offset=self.HEADERWORDS * 8
+		)
+
+	def write(self, boxes: np.ndarray, frameseq: int, timestamp: float):
+		# Only the motion detector of the stream writes, boxes beyond max_items are dropped
+		count = min(len(boxes), self.max_items)
+		self.header[self.LOCK] += 1
+		self.boxes[:count] = boxes[:count]
+		self.header[self.COUNT] = count
+		self.header[self.FRAMESEQ] = frameseq
+		self.times[self.TIMESTAMP] = timestamp
+		if count:
+			self.times[self.LASTMOTION] = timestamp
+		self.header[self.LOCK] += 1
+
+	def read(self) -> tuple[np.ndarray, int, float]:
+		# Returns a copy of the boxes with the sequence number and time of the frame they were found in
+		while True:
+			token = int(self.header[self.LOCK])
+			count = int(self.header[self.COUNT])
+			boxes = self.boxes[:count].copy()
+			frameseq = int(self.header[self.FRAMESEQ])
+			timestamp = float(self.times[self.TIMESTAMP])
+			if token % 2 == 0 and int(self.header[self.LOCK]) == token:
+				return boxes, frameseq, timestamp
+
+	@property
+	def lastmotion(self) -> float:
+		return float(self.times[self.LASTMOTION])
+
+	def __del__(self):
+		del self.header, self.times, self.boxes
+		try:
+			self.memory.close()
+		except BufferError:
+			pass
+		if os.getpid() == self.creatorpid:
+			self.memory.unlink()
+
+
+FrameHandle = collections.namedtuple('FrameHandle', ['slot', 'shape', 'dtype'])
+
+
+class SharedFrameLease:
+	"""
+	An item taken from a SharedFrameQueue, its frames are views straight over their slots. Use it as a context manager
+	or call release when done, the slots are reused afterwards so the views must not be kept.
+	"""
+
+	def __init__(self, framequeue: 'SharedFrameQueue', packed: tuple):
+		self.framequeue = framequeue
+		self.slots: list[int] = [value.slot for value in packed if isinstance(value, FrameHandle)]
+		self.item: tuple = tuple(framequeue.slotview(value) if isinstance(value, FrameHandle) else value
+								 for value in packed)
+
+	def release(self):
+		for slot in self.slots:
+			self.framequeue.release(slot)
+		self.slots = []
+
+	def __enter__(self) -> tuple:
+		return self.item
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.release()
+
+
+class SharedFrameQueue:
+	"""
+	Replacement for an mp.Queue of tuples that hold frames, the frames go through a pool of fixed size slots in shared
+	memory and only a small descriptor per item is pickled.
+
+	put copies every ndarray of an item into a free slot, a producer can also lease a slot, draw straight into it and
+	put its FrameHandle in the item instead. get returns a SharedFrameLease that gives the slots back when it is
+	released. Free slots are handed around as indices in a queue of their own. When all slots are taken, or a frame
+	is bigger than a slot, the frame is pickled along with the descriptor like a plain mp.Queue would, so put never
+	blocks on a slow consumer.
+	"""
+
+	def __init__(self, num_slots: int, slotsize: int):
+		self.num_slots: int = int(num_slots)
+		self.slotsize: int = -(-int(slotsize) // SharedFrameRing.ALIGN) * SharedFrameRing.ALIGN
+		self.memory: SharedMemory = SharedMemory(create=True, size=self.num_slots * self.slotsize)
+		self.creatorpid: int = os.getpid()
+		self.freeslots: mp.Queue = mp.Queue()
+		for slot in range(self.num_slots):
+			self.freeslots.put(slot)
+		self.descriptors: mp.Queue = mp.Queue()
 
+	def slotview(self, handle: FrameHandle) -> np.ndarray:
+		return np.ndarray(handle.shape, dtype=handle.dtype, buffer=self.memory.buf, offset=handle.slot * self.slotsize)
+
+	def lease(self, shape: tuple, dtype) -> tuple[FrameHandle, np.ndarray] | None:
+		# A free slot for a frame of shape and dtype with a writable view over it, None when there is none
+		if int(np.prod(shape)) * np.dtype(dtype).itemsize > self.slotsize:
+			return None
+		try:
+			slot = self.freeslots.get_nowait()
+		except queue.Empty:
+			return None
+		handle = FrameHandle(slot, tuple(shape), np.dtype(dtype).str)
+		return handle, self.slotview(handle)
+
+	def release(self, slot: int):
+		self.freeslots.put(slot)
+
+	def put(self, item: tuple):
+		packed = []
+		for value in item:
+			if isinstance(value, np.ndarray) and (lease := self.lease(value.shape, value.dtype)) is not None:
+				handle, view = lease
+				np.copyto(view, value)
+				value = handle
+			packed.append(value)
+		self.descriptors.put(tuple(packed))
+
+	def get(self, block=True, timeout=None) -> SharedFrameLease:
+		return SharedFrameLease(self, self.descriptors.get(block, timeout))
+
+	def qsize(self) -> int:
+		return self.descriptors.qsize()
+
+	def __del__(self):
+		try:
+			self.memory.close()
+		except BufferError:
+			pass
+		if os.getpid() == self.creatorpid:
+			self.memory.unlink()
+
+
+def _benchmark_reader(buffer, stop, reads):
+	# Reads the latest frame as fast as possible the way the detector and snapshot paths do
+	count = 0
+	while not stop.value:
+		if isinstance(buffer, SharedFrameRing):
+			buffer.getlatestview()
+		else:
+			buffer[-1]
+		count += 1
+	reads.value = count
+
+
+def benchmark_concurrent(buffer, img, num_readers, duration=3.0):
+	buffer.append(img)
+	stop = mp.Value('i', 0)
+	reads = [mp.Value('Q', 0) for i in range(num_readers)]
+	readers = [mp.Process(target=_benchmark_reader, args=(buffer, stop, reads[i])) for i in range(num_readers)]
+	for reader in readers:
+		reader.start()
+	appends = 0
+	start = datetime.datetime.now()
+	while (datetime.datetime.now() - start).total_seconds() < duration:
+		buffer.append(img)
+		appends += 1
+	stop.value = 1
+	for reader in readers:
+		reader.join()
+	elapsed = (datetime.datetime.now() - start).total_seconds()
+	return appends / elapsed, sum(r.value for r in reads) / elapsed
+
+
+def _benchmark_consumer(framequeue, count):
+	# Takes count items off the queue and touches every frame the way the snapshot processor would
+	for i in range(count):
+		if isinstance(framequeue, SharedFrameQueue):
+			with framequeue.get() as item:
+				int(item[1][0, 0, 0])
+		else:
+			item = framequeue.get()
+			int(item[1][0, 0, 0])
+
+
+def benchmark_queue(framequeue, img, count=200):
+	# Items per second through the queue from this process to a consumer process
+	consumer = mp.Process(target=_benchmark_consumer, args=(framequeue, count))
+	consumer.start()
+	start = datetime.datetime.now()
+	for i in range(count):
+		framequeue.put((1, img, 'caption'))
+	consumer.join()
+	return count / (datetime.datetime.now() - start).total_seconds()
 
 
 if __name__ == '__main__':
@@ -181,4 +690,36 @@ if __name__ == '__main__':
 		img = deq.pop()
 	end = datetime.datetime.now()
 	speed = (end - start).total_seconds()/shareddeque_size*1000
-	print(f'Pop speed is {speed:0.2f}ms')
\ No newline at end of file
+	print(f'Pop speed is {speed:0.2f}ms')
+
+	# Compare the locked deque with the lock-free ring under concurrent readers
+	for num_readers in (1, 2, 4, 8):
+		for buffertype in (SharedFrameDeque, SharedFrameRing):
+			buffer = buffertype(shareddeque_size, shape, type)
+			appendrate, readrate = benchmark_concurrent(buffer, img, num_readers)
+			print(f'{buffertype.__name__} with {num_readers} readers: {appendrate:0.0f} appends/s, {readrate:0.0f} reads/s')
+			del buffer
+
+	# Memory and speed of the compressed pre record buffer compared to raw frames
+	noise = np.random.default_rng(0).integers(0, 64, size=shape, dtype=np.uint8)
+	frame = cv2.GaussianBlur(noise, (9, 9), 0)
+	compressed = SharedCompressedRing(shareddeque_size, shareddeque_size * 400_000)
+	start = datetime.datetime.now()
+	for i in range(100):
+		compressed.append(frame)
+	end = datetime.datetime.now()
+	print(f'Compressed append speed is {(end - start).total_seconds() * 10:0.2f}ms')
+	start = datetime.datetime.now()
+	for i in range(100):
+		decoded = compressed[-1]
+	end = datetime.datetime.now()
+	print(f'Compressed decode speed is {(end - start).total_seconds() * 10:0.2f}ms')
+	used = int(np.mean(compressed.slotlengths[:len(compressed)]))
+	print(f'Frame size is {used / 1e6:0.2f}MB compressed, {compressed.arenasize / 1e6 / shareddeque_size:0.2f}MB per frame '
+		  f'reserved, {int(np.prod(shape)) / 1e6:0.2f}MB raw')
+	del compressed
+
+	# Frames through a pickling mp.Queue compared to the shared memory slot pool
+	for framequeue in (mp.Queue(), SharedFrameQueue(8, frame.nbytes)):
+		rate = benchmark_queue(framequeue, frame)
+		print(f'{type(framequeue).__name__}: {rate:0.0f} frames/s, {rate * frame.nbytes / 1e9:0.2f}GB/s')
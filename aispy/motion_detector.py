@@ -1,37 +1,84 @@
+import logging
 import multiprocessing as mp
+import os
+import time
 from datetime import datetime
 
 import numpy as np
-import imutils
-from memory_managers import SharedFrameDeque
+from memory_managers import SharedFrameRing, SharedMotionBoxes
 import supervision as sv
 import cv2
-
-
-class MotionDetector:
-	def __init__(self, streaminfo):
+from settings import UserSettings
+from utils import mainlogger
+
+
+class MotionDetector(mp.Process):
+	"""
+	Finds motion on the detection frames of one stream and publishes the motion boxes to the stream's motionboxes,
+	the object detector uses them to skip or crop inference on streams where nothing moves.
+	"""
+	def __init__(self, streamid, streaminfo):
+		super().__init__()
+		self.streamid = streamid
 		self.streaminfo = streaminfo
-		self.avg_frame = np.zeros((streaminfo['dimensions'][1], streaminfo['dimensions'][0]), np.float32)
+		self.framebuffer: SharedFrameRing = streaminfo['detectbuffer']
+		self.motionboxes: SharedMotionBoxes = streaminfo['motionboxes']
+		# Motion is found on the detection frames, which may come from a lower resolution substream
+		self.height, self.width = self.framebuffer.itemshape[:2]
+		# Motion is processed at a reduced height, the blur and minimum area are scaled along so the sensitivity
+		# does not depend on the processing resolution
+		scale = min(1.0, getattr(UserSettings, 'motion_frame_height', 180) / self.height)
+		self.motion_dimensions = (max(1, round(self.width * scale)), max(1, round(self.height * scale)))
+		self.box_scale = np.array([self.width / self.motion_dimensions[0], self.height / self.motion_dimensions[1]] * 2,
+								  dtype=np.float32)
+		self.avg_frame = np.zeros((self.motion_dimensions[1], self.motion_dimensions[0]), np.float32)
 		self.calibrating = True
-		self.blur_radius = 1
-		self.mask = np.zeros((streaminfo['dimensions'][1], streaminfo['dimensions'][0]), bool)
+		self.blur_size = max(3, int(21 * scale) | 1)
+		self.setmask(np.zeros((self.height, self.width), bool))
+		self.motion_fps = getattr(UserSettings, 'motion_fps', 5)
 		self.motion_threshold = 30
 		self.contour_area = 10
+		self.min_area = self.contour_area * scale * scale
+		self.timings: dict[str, float] = {}
 		self.lightning_threshold = 0.8
 		self.motion_frame_count = 0
 		self.motion_frames_conf = 5
 		self.frame_alpha = 0.01
 
+	def setmask(self, mask: np.ndarray):
+		# The mask is given at detection frame resolution, True pixels are ignored. Kept as a uint8 keep mask at the
+		# motion resolution so it is a single bitwise_and per frame, None when nothing is masked
+		self.mask = mask
+		if not mask.any():
+			self.keepmask = None
+			return
+		keepmask = np.where(mask, 0, 255).astype(np.uint8)
+		self.keepmask = cv2.resize(keepmask, self.motion_dimensions, interpolation=cv2.INTER_NEAREST)
+
+	def timestage(self, stage, start) -> float:
+		# Keeps a running average of the time taken by each stage in milliseconds
+		now = time.perf_counter()
+		self.timings[stage] = self.timings.get(stage, (now - start) * 1000) * 0.95 + (now - start) * 50
+		return now
+
 	def detect(self, frame) -> sv.Detections:
-		grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-		# Improve contrast
-		contrast_improved_frame = grey
+		start = time.perf_counter()
+		# Downscale first, all following stages run on the small frame. Linear is several times faster than area
+		# interpolation at these ratios and the blur removes the aliasing it leaves
+		small = cv2.resize(frame, self.motion_dimensions, interpolation=cv2.INTER_LINEAR)
+		if small.ndim == 3:
+			grey = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+		else:
+			grey = small
+		start = self.timestage('resize', start)
 
 		# Mask the frame
-		contrast_improved_frame[self.mask] = [0]
+		if self.keepmask is not None:
+			grey = cv2.bitwise_and(grey, self.keepmask)
 
 		# Add some blur
-		blurred_frame = cv2.GaussianBlur(contrast_improved_frame, (21, 21), 0)
+		blurred_frame = cv2.GaussianBlur(grey, (self.blur_size, self.blur_size), 0)
+		start = self.timestage('blur', start)
 
 		# compare to average
 		frameDelta = cv2.absdiff(blurred_frame, cv2.convertScaleAbs(self.avg_frame))
@@ -41,30 +88,24 @@ class MotionDetector:
 			frameDelta, self.motion_threshold, 255, cv2.THRESH_BINARY
 		)[1]
 
-		# dilate the thresholded image to fill in holes, then find contours
-		# on thresholded image
+		# dilate the thresholded image to fill in holes
 		thresh_dilated = cv2.dilate(thresh, None, iterations=1)
-		cnts = cv2.findContours(
-			thresh_dilated, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
-		)
-		cnts = imutils.grab_contours(cnts)
-
-		motion_boxes = np.zeros(shape=(len(cnts), 4), dtype=np.uint32)
-		motion_boxes_mask = np.zeros(shape=(len(cnts),), dtype=bool)
-		# loop over the contours
-		total_contour_area = 0
-		for i in range(len(cnts)):
-			c = cnts[i]
-			# if the contour is big enough, count it as motion
-			contour_area = cv2.contourArea(c)
-			total_contour_area += contour_area
-			if contour_area > self.contour_area:
-				motion_boxes_mask[i] = True
-				x, y, w, h = cv2.boundingRect(c)
-				motion_boxes[i] = [int(x), int(y), int((x + w)), int((y + h))]
-
-		motion_boxes = motion_boxes[motion_boxes_mask]
-		pct_motion = total_contour_area / (streaminfo['dimensions'][1]* streaminfo['dimensions'][0])
+		start = self.timestage('threshold', start)
+
+		# Every connected region is a candidate, label 0 is the background
+		num_labels, labels, stats, centroids = cv2.connectedComponentsWithStats(thresh_dilated, connectivity=8)
+		stats = stats[1:]
+		areas = stats[:, cv2.CC_STAT_AREA]
+		total_contour_area = int(areas.sum())
+		stats = stats[areas > self.min_area]
+		# Scale the boxes back to the detection frame
+		motion_boxes = np.empty(shape=(len(stats), 4), dtype=np.float32)
+		motion_boxes[:, :2] = stats[:, :2]
+		motion_boxes[:, 2:] = stats[:, :2] + stats[:, 2:4]
+		motion_boxes = (motion_boxes * self.box_scale).round().astype(np.int32)
+		start = self.timestage('components', start)
+
+		pct_motion = total_contour_area / (self.motion_dimensions[0] * self.motion_dimensions[1])
 
 		# once the motion is less than 5% and the number of contours is < 4, assume its calibrated
 		if pct_motion < 0.05 and len(motion_boxes) <= 4:
@@ -91,39 +132,58 @@ class MotionDetector:
 				0.2 if self.calibrating else self.frame_alpha,
 			)
 			self.motion_frame_count = 0
+		self.timestage('average', start)
 
 		return sv.Detections(
 			xyxy=motion_boxes
 		)
 
 	def run(self):
+		mainlogger.info(f'Motion detector for stream {self.streamid} starting with pid {os.getpid()}')
+		lastseq = -1
 		while True:
-			start = datetime.now()
-			# Get new frame
-			frame = self.streaminfo['framebuffer'][-1]
-			detections = self.detect(frame)
-			self.streaminfo['motionlist'][0] = detections
-			end = datetime.now()
-			delta = (end - start).total_seconds()
-			print(f'Detection took {delta} seconds')
-
-
+			try:
+				start = datetime.now()
+				# Only look at frames that were not seen yet
+				latest = self.framebuffer.getlatestview() if self.framebuffer.latestseq != lastseq else None
+				if latest is not None:
+					frame, lastseq, token = latest
+					detections = self.detect(frame)
+					# The frame is a view, the boxes only count if the writer did not reuse its slot while detecting
+					if self.framebuffer.isvalid(lastseq, token):
+						self.motionboxes.write(detections.xyxy, lastseq, self.framebuffer.gettimestamp(lastseq))
+					if mainlogger.isEnabledFor(logging.DEBUG):
+						mainlogger.debug(f'Motion on stream {self.streamid}: ' +
+										 ' '.join(f'{stage} {ms:0.2f} ms' for stage, ms in self.timings.items()))
+				time_left = 1 / self.motion_fps - (datetime.now() - start).total_seconds()
+				if time_left > 0:
+					time.sleep(time_left)
+			except:
+				mainlogger.exception(f'Problem in motion detector for stream {self.streamid} restarting in 10 seconds')
+				time.sleep(10)
 
 
 if __name__ == '__main__':
 	shape = (1080, 1920, 3)
 	type = np.uint8
 	img = np.full(shape=(1080, 1920, 3), fill_value=128, dtype=type)
-	motionman = mp.Manager()
 	streaminfo = {}
-	streaminfo['framebuffer'] = SharedFrameDeque(
+	streaminfo['detectbuffer'] = SharedFrameRing(
 				max_items=10,
 				itemshape=shape,
 				datatype=type
 			)
-	streaminfo['framebuffer'].append(img)
-	streaminfo['motionlist'] = motionman.list()
-	streaminfo['motionlist'].append(None)
-
-	md = MotionDetector(streaminfo)
-	md.run()
\ No newline at end of file
+	streaminfo['detectbuffer'].append(img)
+	streaminfo['motionboxes'] = SharedMotionBoxes()
+
+	md = MotionDetector(1, streaminfo)
+	# Move a square over the frame so there is motion to find
+	for i in range(200):
+		frame = img.copy()
+		x = 100 + (i * 8) % 1600
+		frame[400:600, x:x + 200] = 255
+		start = datetime.now()
+		detections = md.detect(frame)
+		end = datetime.now()
+	print(f'Detection took {(end - start).total_seconds()} seconds, found {detections.xyxy.tolist()}')
+	print(' '.join(f'{stage} {ms:0.2f} ms' for stage, ms in md.timings.items()))
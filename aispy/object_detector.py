@@ -1,31 +1,47 @@
+import logging
 import os
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import numpy as np
 import supervision as sv
 from supervision.draw.utils import draw_polygon
 import multiprocessing as mp
+from concurrent.futures import Future
 from settings import UserSettings, Settings
 from utils import mainlogger
-from detector import create_detector
-from detector.detector_api import DetectorAPI
+from detector.detector_pool import DetectorPool
+from detection_scheduler import DetectionScheduler
+from memory_managers import SharedFrameQueue, SharedFrameRing
 from detector.detectors.rknn import RknnDetectorConfig
+from detector.detectors.cpu import CpuDetectorConfig
 
 class ObjectDetector(mp.Process):
 
 	def __init__(self, streaminfo: dict, fileinferencequeue: mp.Queue,
-				 snapshotqueue: mp.Queue, fileannotatorsendqueue: mp.Queue, fileannotatorreceivequeue: mp.Queue,
-				 updatetime: mp.Value, detectorload: mp.Value):
+				 snapshotqueue: SharedFrameQueue, fileannotatorsendqueue: mp.Queue, fileannotatorreceivequeue: mp.Queue,
+				 annotationbuffer: SharedFrameRing, updatetime: mp.Value, detectorload: mp.Value):
 		super().__init__()
 		self.streaminfos = streaminfo
 		self.fileinferencequeue = fileinferencequeue
 		self.snapshotqueue = snapshotqueue
 		self.fileannotatorsendqueue = fileannotatorsendqueue
 		self.fileannotatorreceivequeue = fileannotatorreceivequeue
-		self.avginferencetime = Settings.avg_inference_time
+		self.annotationbuffer = annotationbuffer
+		self.scheduler: DetectionScheduler | None = None
 		self.updatetime = updatetime
 		self.detectorload = detectorload
-		self.model: DetectorAPI | None = None
+		self.model: DetectorPool | None = None
+		# Time of the last frame of each stream that went through inference, used for motion gating
+		self.lastinference: dict[int, float] = {}
+		# Boxes per stream that passed the zoomed in double check, with the class and the time they stay trusted
+		self.verifiedboxes: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+		# Object tracker per stream with the state of its tracks by tracker id: the rounds it was seen in, the last
+		# round it was seen, whether it passed the double check (None until it was checked) and the round it was checked
+		self.trackers: dict[int, sv.ByteTrack] = {}
+		self.tracks: dict[int, dict[int, dict]] = {}
+		self.trackrounds: dict[int, int] = {}
+		# Sequence number of the last detect frame of each stream that went through a round
+		self.lastseqs: dict[int, int] = {}
 		self.boxannotator = sv.BoxAnnotator(
 			thickness=2,
 			text_thickness=2,
@@ -36,19 +52,32 @@ class ObjectDetector(mp.Process):
 
 	def run(self):
 		mainlogger.info(f'Starting detect process with pid {os.getpid()}')
-		self.model = create_detector(RknnDetectorConfig(type_key='rknn'))
+		self.model = DetectorPool(self.detector_configs())
 		while True:
 			try:
 				mainlogger.info(f'Starting detect process')
+				self.scheduler = DetectionScheduler(self.streaminfos)
 				while True:
-					loopstarttime = datetime.now()
-					# Get one frame from each camera for processing, This happens as per the settings
-					mainlogger.debug(f'Checking all streams for objects')
+					loopstarttime = datetime.now().timestamp()
+					backlog = self.fileannotatorsendqueue.qsize() > 0
+					rechecks, live = self.scheduler.plan(loopstarttime, backlog)
+					# Get a frame from each stream that is due, rechecks always look at the whole frame
 					framebuff: list[tuple] = []
-					for streamid in self.streaminfos.keys():
-						if streamid == 0:
+					frameids: dict[int, tuple[int, int]] = {}
+					for streamid in rechecks + live:
+						latest = self.getframe(streamid, 'detectbuffer')
+						if latest is None:
 							continue
-						framebuff.append((streamid, self.streaminfos[streamid]['framebuffer'][-1], None))
+						frame, seq, token = latest
+						if streamid in rechecks and seq == self.lastseqs.get(streamid):
+							# Inferring the same frame again proves nothing, wait for the next one
+							wait = getattr(UserSettings, 'recheck_wait', timedelta(milliseconds=50)).total_seconds()
+							self.scheduler.recheck(streamid, loopstarttime + wait)
+							continue
+						region = None if streamid in rechecks else self.motionregion(streamid, frame)
+						if streamid in rechecks or region is not None:
+							framebuff.append((streamid, frame, region))
+							frameids[streamid] = (seq, token)
 					# # Workaround for stream 4
 					# id = 4
 					# fr = self.streaminfos[id]['framebuffer'][-1]
@@ -58,89 +87,337 @@ class ObjectDetector(mp.Process):
 					# # mainlogger.info(f'{cutframe.shape}')
 					# # self.snapshotqueue.put((4,cutframe,f'Test'))
 					# framebuff.append((id, cutframe, None))
-					mainlogger.debug(f'Got frames from {len(framebuff)} streams')
-
-					while framebuff:
-						item = framebuff.pop()
-						streamid = item[0]
-						frame = item[1]
-						motion_detections = item[2]
-						if self.streaminfos[0]['armed'].value and self.streaminfos[streamid]['armed'].value:
-							annotated_frame, num_detections = self.doinference(frame, streamid, motion_detections=motion_detections)
-						else:
-							annotated_frame, num_detections = frame, 0
-						recordcounter = self.streaminfos[streamid]['recordcounter']
-						if num_detections >= 1:
-							recordcounter += 1
-						else:
-							recordcounter -= 1
-						recordcounter = max(0, recordcounter)
-						recordcounter = min(recordcounter, UserSettings.detections_for_event*2)
-						self.streaminfos[streamid]['recordcounter'] = recordcounter
-						if recordcounter:
-							mainlogger.debug(f'recordcounter {recordcounter}')
-						# Re-check items with a recordcounter of between 1 and UserSettings.detections_for_event to make sure if recording should happen
-						if 0 < recordcounter < UserSettings.detections_for_event and self.streaminfos[streamid]['recordflag'].value != 1:
-							if motion_detections is None:
-								framebuff.append((streamid, self.streaminfos[streamid]['framebuffer'][-1], motion_detections))
-							else:
-								# Append from the motion detector
-								pass
-						# Set the recordflag if needed
-						if recordcounter >= UserSettings.detections_for_event and self.streaminfos[streamid]['recordflag'].value != 1:
-							self.streaminfos[streamid]['recordflag'].value = 1
-							mainlogger.info(f'Item found on Stream {streamid} setting recordflag')
-							self.streaminfos[0]['alarm'].value = 1
-							self.snapshotqueue.put((streamid, annotated_frame, f'Alarm Active on stream {streamid}'))
-						# Clear the recordflag when the counter is decreasing and at 1 while recording
-						if recordcounter == 1 and num_detections == 0 and self.streaminfos[streamid]['recordflag'].value == 1:
-							self.streaminfos[streamid]['recordflag'].value = 0
-							mainlogger.info(f'No more items on Stream {streamid}, clearing recordflag')
-							if self.streaminfos[0]['armed'].value and self.streaminfos[streamid]['armed'].value:
-								self.snapshotqueue.put((streamid, annotated_frame, f'Alarm Cleared on stream {streamid}'))
-
-					# After all frames have been processed do other detection work if there is time left
-					now = datetime.now()
-					time_left = loopstarttime + UserSettings.check_detection_time - now
-					time_left = time_left.total_seconds()
-					# Magic value obtained by trial and error
-					inferencestodo = int(time_left * 0.65 // self.avginferencetime)
-					mainlogger.debug(f'Doing {inferencestodo} inferences on video')
-					for i in range(inferencestodo):
-						if self.fileannotatorsendqueue.qsize() > 0:
-							try:
-								packet = self.fileannotatorsendqueue.get_nowait()
-							except:
-								break
-							if packet[1] == 'Done':
-								mainlogger.debug(f'Received done packet from fileannotator')
-								self.fileannotatorreceivequeue.put((None, 'Done'))
-							else:
-								inf_res = self.doinference(*packet)
-								self.fileannotatorreceivequeue.put(inf_res)
-					now = datetime.now()
-					time_left = loopstarttime + UserSettings.check_detection_time - now
-					time_left = time_left.total_seconds()
-					# Update the updatetime
-					self.updatetime.value = now.timestamp()
-					self.detectorload.value = (self.detectorload.value*19 + (1-time_left/UserSettings.check_detection_time.total_seconds()))/20
-
-					# Sleep if no more work is available
+					if framebuff:
+						mainlogger.debug('Checking %d streams for objects', len(framebuff))
+						inferred = self.detect_round(framebuff, frameids)
+						self.scheduler.record(inferred, datetime.now().timestamp() - loopstarttime)
+
+					# File annotation gets the time until the next stream is due
+					if backlog:
+						self.annotate_backlog(self.scheduler.backlogitems(datetime.now().timestamp()))
+					if mainlogger.isEnabledFor(logging.DEBUG):
+						mainlogger.debug(f'Detector pipeline {self.model.metrics()}')
+						mainlogger.debug(f'Detection rates {self.scheduler.stats()}')
+
+					# Sleep until the next stream is due unless there is file annotation waiting
+					now = datetime.now().timestamp()
+					time_left = 0.0 if self.fileannotatorsendqueue.qsize() > 0 else self.scheduler.idletime(now)
+					time_left = min(time_left, self.scheduler.cycle)
+					# Update the updatetime and the share of the time the detector is busy
+					self.updatetime.value = now
+					busy = now - loopstarttime
+					self.detectorload.value = (self.detectorload.value*19 + busy / max(busy + time_left, 1e-6))/20
 					if time_left > 0:
-						mainlogger.debug(f'Sleeping for {time_left} seconds')
+						mainlogger.debug('Sleeping for %s seconds', time_left)
 						time.sleep(time_left)
 			except:
 				mainlogger.exception(f'Problem in detector restarting in 10 seconds')
 				time.sleep(10)
 
+	def detect_round(self, batch, frameids) -> list[int]:
+		"""
+		Infers the frames of batch, which are (streamid, frame, region) tuples, as one batch and updates the object
+		tracks, record flags and alarms of their streams. The frames are views of the detectbuffers, frameids holds the
+		(seq, token) of the frame of every stream and results of frames the writer overwrote meanwhile are dropped. Only
+		detections of new tracks are double checked, events are started by tracks that passed the double check and lived
+		for detections_for_event rounds. Streams that need a recheck are handed to the scheduler. Returns the ids of the
+		streams that were inferred, disarmed streams and torn frames are not.
+		"""
+		batch_detections = self.detect_streams(batch)
+		torn = set()
+		tracked_items = []
+		mainframes = {}
+		for item, detections in zip(batch, batch_detections):
+			streamid = item[0]
+			frame = item[1]
+			framebuffer = self.streaminfos[streamid]['detectbuffer']
+			seq, token = frameids[streamid]
+			if detections is not None and not framebuffer.isvalid(seq, token):
+				mainlogger.debug('Frame %d of stream %d was overwritten during inference, dropping its detections',
+								 seq, streamid)
+				torn.add(streamid)
+				continue
+			# Verification and snapshots use the main stream when detecting on a substream
+			mainframe = frame
+			if framebuffer is not self.streaminfos[streamid]['framebuffer']:
+				latest = self.getframe(streamid)
+				if latest is None:
+					continue
+				mainframe, seq, token = latest
+				framebuffer = self.streaminfos[streamid]['framebuffer']
+			mainframes[streamid] = (framebuffer, seq, token)
+			if self.streaminfos[0]['armed'].value and self.streaminfos[streamid]['armed'].value:
+				zone_detections = self.detect_zone(frame, streamid, double_check=False,
+												   detections=detections)
+			else:
+				zone_detections = sv.Detections.empty()
+			# A frame that was inferred before, by a stalled stream, does not count as another sighting
+			fresh = frameids[streamid][0] != self.lastseqs.get(streamid)
+			self.lastseqs[streamid] = frameids[streamid][0]
+			tracked_items.append((streamid, mainframe, self.track(streamid, zone_detections, fresh)))
+		# The double checks of the new tracks of all streams are done as one batch as well
+		new_items = [(streamid, mainframe, tracked[self.newtracks(streamid, tracked)])
+					 for streamid, mainframe, tracked in tracked_items]
+		for (streamid, mainframe, new_detections), verified in zip(new_items, self.verify_zones(new_items)):
+			framebuffer, seq, token = mainframes[streamid]
+			if not framebuffer.isvalid(seq, token):
+				# Torn crops, the tracks stay unchecked and are double checked again next round
+				continue
+			for tracker_id in new_detections.tracker_id:
+				self.tracks[streamid][tracker_id]['verified'] = tracker_id in verified.tracker_id
+				self.tracks[streamid][tracker_id]['checked'] = self.trackrounds[streamid]
+		for streamid, mainframe, tracked in tracked_items:
+			zone_detections = tracked[self.confirmedtracks(streamid, tracked)]
+			# The longest lived confirmed track drives the event, tracks that were not seen for track_lost_rounds are gone
+			lost_rounds = getattr(UserSettings, 'track_lost_rounds', UserSettings.detections_for_event)
+			alive = [track for track in self.tracks[streamid].values()
+					 if track['verified'] and self.trackrounds[streamid] - track['last'] < lost_rounds]
+			recordcounter = max((track['hits'] for track in alive), default=0)
+			recordcounter = min(recordcounter, UserSettings.detections_for_event*2)
+			self.streaminfos[streamid]['recordcounter'] = recordcounter
+			if recordcounter:
+				mainlogger.debug('recordcounter %d', recordcounter)
+			# Re-check streams with a confirmed track younger than UserSettings.detections_for_event to make sure if recording should happen
+			if 0 < recordcounter < UserSettings.detections_for_event and self.streaminfos[streamid]['recordflag'].value != 1:
+				self.scheduler.recheck(streamid)
+			# Set the recordflag if needed
+			if recordcounter >= UserSettings.detections_for_event and self.streaminfos[streamid]['recordflag'].value != 1:
+				self.streaminfos[streamid]['recordflag'].value = 1
+				mainlogger.info(f'Item found on Stream {streamid} setting recordflag')
+				self.streaminfos[0]['alarm'].value = 1
+				self.snapshot(streamid, self.snapshotframe(*mainframes[streamid][:2]), zone_detections,
+							  f'Alarm Active on stream {streamid}')
+			# Clear the recordflag once all confirmed tracks are lost while recording
+			if not alive and self.streaminfos[streamid]['recordflag'].value == 1:
+				self.streaminfos[streamid]['recordflag'].value = 0
+				mainlogger.info(f'No more items on Stream {streamid}, clearing recordflag')
+				if self.streaminfos[0]['armed'].value and self.streaminfos[streamid]['armed'].value:
+					self.snapshot(streamid, self.snapshotframe(*mainframes[streamid][:2]), zone_detections,
+								  f'Alarm Cleared on stream {streamid}')
+		return [item[0] for item, detections in zip(batch, batch_detections)
+				if detections is not None and item[0] not in torn]
+
+	def track(self, streamid, zone_detections, fresh=True) -> sv.Detections:
+		"""
+		Updates the tracker of a stream with the zone detections of a round. Returns the detections of the active tracks
+		with their tracker_id, a new object gets its track the second round it is seen. Hits are only counted for fresh
+		frames, the first round on a frame.
+		"""
+		if streamid not in self.trackers:
+			# New tracks need a score of track_thresh + 0.1, which makes it the confidence threshold of the stream
+			lost_rounds = getattr(UserSettings, 'track_lost_rounds', UserSettings.detections_for_event)
+			self.trackers[streamid] = sv.ByteTrack(
+				track_thresh=max(self.streaminfos[streamid]['confidence_threshold'] - 0.1, 0.0),
+				track_buffer=lost_rounds,
+				match_thresh=0.8,
+				frame_rate=30
+			)
+			self.tracks[streamid] = {}
+			self.trackrounds[streamid] = 0
+		self.trackrounds[streamid] += 1
+		currentround = self.trackrounds[streamid]
+		tracked = self.trackers[streamid].update_with_detections(zone_detections)
+		tracks = self.tracks[streamid]
+		for tracker_id in tracked.tracker_id:
+			track = tracks.setdefault(tracker_id, {'hits': 0, 'last': currentround, 'verified': None, 'checked': 0})
+			track['hits'] += fresh
+			track['last'] = currentround
+		# Forget tracks the tracker has dropped
+		lost_rounds = getattr(UserSettings, 'track_lost_rounds', UserSettings.detections_for_event)
+		for tracker_id in [tracker_id for tracker_id, track in tracks.items() if currentround - track['last'] > lost_rounds]:
+			del tracks[tracker_id]
+		return tracked
+
+	def newtracks(self, streamid, tracked) -> np.ndarray:
+		# Detections of tracks that were not double checked yet, and of tracks that failed it verify_retry_rounds ago so
+		# an object that was badly visible when its track started can still raise an alarm
+		retry = getattr(UserSettings, 'verify_retry_rounds', UserSettings.detections_for_event)
+		currentround = self.trackrounds[streamid]
+		tracks = [self.tracks[streamid][tracker_id] for tracker_id in tracked.tracker_id]
+		return np.array([track['verified'] is None
+						 or (track['verified'] is False and currentround - track['checked'] >= retry)
+						 for track in tracks], dtype=bool)
+
+	def confirmedtracks(self, streamid, tracked) -> np.ndarray:
+		# Detections of tracks that passed the double check
+		return np.array([self.tracks[streamid][tracker_id]['verified'] is True for tracker_id in tracked.tracker_id],
+						dtype=bool)
+
+	def annotate_backlog(self, inferencestodo):
+		"""
+		Infers keyframes of the file annotator, packets are (job, streamid, seq) with seq the keyframe's sequence
+		number in the annotationbuffer of the file annotator, or None when the job is done. Only the detections in the
+		detect area go back, with their class names, the file annotator draws them itself. Keyframes are not zoomed in
+		on, the clip was recorded because the live detections already passed the double check.
+		"""
+		mainlogger.debug('Doing up to %d inferences on video', inferencestodo)
+		packets = []
+		while len(packets) < inferencestodo and self.fileannotatorsendqueue.qsize() > 0:
+			try:
+				packets.append(self.fileannotatorsendqueue.get_nowait())
+			except:
+				break
+		# Queue the inferences of all packets up front so the detector pipelines prepare and infer the next
+		# frames while this process verifies the current one
+		starttime = datetime.now().timestamp()
+		frames = [self.annotationframe(seq) for job, streamid, seq in packets]
+		futures = [None if frame is None else self.submitdetect(frame[0], packet[1])
+				   for packet, frame in zip(packets, frames)]
+		for (job, streamid, seq), frame, future in zip(packets, frames, futures):
+			if seq is None:
+				mainlogger.debug(f'Received done packet from fileannotator')
+				self.fileannotatorreceivequeue.put((job, None, None))
+			elif frame is None:
+				self.fileannotatorreceivequeue.put((job, seq, None))
+			else:
+				detections = future.result()
+				view, token = frame
+				if not self.annotationbuffer.isvalid(seq, token):
+					# The keyframe was overwritten during inference, the detections may not belong to it
+					mainlogger.debug('Keyframe %d was overwritten during inference, dropping its detections', seq)
+					self.fileannotatorreceivequeue.put((job, seq, None))
+					continue
+				zone_detections = self.detect_zone(view, streamid, double_check=False, detections=detections)
+				zone_detections.data['class_name'] = np.array(
+					[self.model.model_names[class_id] for class_id in zone_detections.class_id], dtype=str
+				)
+				self.fileannotatorreceivequeue.put((job, seq, zone_detections))
+		self.scheduler.recordbacklog(sum(future is not None for future in futures), datetime.now().timestamp() - starttime)
+
+	def annotationframe(self, seq) -> tuple[np.ndarray, int] | None:
+		# View of a keyframe with its isvalid token. The file annotator only overwrites a keyframe after its result came
+		# back, unless it gave up on the job, so the token is checked once the keyframe was inferred
+		if seq is None or seq < self.annotationbuffer.head:
+			return None
+		return self.annotationbuffer.getview(seq)
+
+	def detector_configs(self) -> list:
+		# One detector per NPU core, live streams, double checks and file annotation all share the pool. Hosts without
+		# an NPU use the cpu detector, one instance that spreads every inference over all cores
+		detector_type = getattr(Settings, 'detector_type', 'rknn')
+		if detector_type == 'cpu':
+			return [CpuDetectorConfig(type_key='cpu', num_threads=getattr(Settings, 'detector_threads', 0))]
+		core_masks = getattr(Settings, 'detector_core_masks', [1, 2, 4])
+		return [RknnDetectorConfig(type_key='rknn', core_mask=core_mask) for core_mask in core_masks]
+
+	def getframe(self, streamid, buffername='framebuffer') -> tuple[np.ndarray, int, int] | None:
+		# Read-only view of the latest frame with its seq and isvalid token, no copy. Whoever uses the view checks
+		# isvalid once done with it and drops what it got out of a torn frame
+		return self.streaminfos[streamid][buffername].getlatestview()
+
+	def snapshotframe(self, framebuffer, seq) -> np.ndarray:
+		# Alarm snapshots are rare enough to copy, the frame of the round unless the writer reused its slot already,
+		# then the latest frame
+		try:
+			return framebuffer.get(seq)
+		except IndexError:
+			return framebuffer.get(framebuffer.latestseq)
 
-	def doinference(self, frame, streamid, double_check=True, motion_detections=None) -> tuple:
+	def detect_streams(self, items) -> list[sv.Detections | None]:
+		"""
+		Runs one batched inference over the frames of all armed streams in items, which are (streamid, frame, region)
+		tuples. Only the region (x1, y1, x2, y2) of a frame is inferred, None infers the whole frame. The batch is
+		inferred with the loosest threshold and classes of its streams and filtered per stream afterwards. Returns the
+		detections in frame coordinates for every item, None for items that were not inferred.
+		"""
+		results: list[sv.Detections | None] = [None] * len(items)
+		selected = [i for i, (streamid, frame, region) in enumerate(items)
+					if self.streaminfos[0]['armed'].value and self.streaminfos[streamid]['armed'].value]
+		if not selected:
+			return results
 		starttime = datetime.now().timestamp()
+		streamids = [items[i][0] for i in selected]
+		confidence, classes = self.batchsettings(streamids)
+		images = []
+		for i in selected:
+			streamid, frame, region = items[i]
+			if region is not None:
+				x1, y1, x2, y2 = region
+				frame = frame[y1:y2, x1:x2]
+			images.append(frame)
+			self.lastinference[streamid] = starttime
+		batch_detections = self.model.detect_batch(images, classes=classes, conf=confidence,
+												   nms=True, iou=0.5, verbose=False)
+		for i, streamid, detections in zip(selected, streamids, batch_detections):
+			region = items[i][2]
+			if region is not None:
+				detections.xyxy = detections.xyxy + np.array([region[0], region[1]] * 2, dtype=detections.xyxy.dtype)
+			results[i] = self.streamfilter(detections, streamid)
+		return results
+
+	def batchsettings(self, streamids) -> tuple[float, list | None]:
+		# The loosest confidence threshold and the union of the classes of the streams in a batch
+		confidence = min(self.streaminfos[streamid]['confidence_threshold'] for streamid in streamids)
+		streamclasses = [self.streaminfos[streamid]['detection_classes'] for streamid in streamids]
+		classes = None if not all(streamclasses) else sorted(set().union(*streamclasses))
+		return confidence, classes
+
+	def streamfilter(self, detections, streamid) -> sv.Detections:
+		# Drops the detections of a batch that do not meet the threshold and classes of the stream
+		keep = detections.confidence >= self.streaminfos[streamid]['confidence_threshold']
+		if self.streaminfos[streamid]['detection_classes']:
+			keep &= np.isin(detections.class_id, self.streaminfos[streamid]['detection_classes'])
+		return detections[keep]
+
+	def motionregion(self, streamid, frame) -> tuple | None:
+		"""
+		Decides how much of a detection frame needs inference based on the stream's motion boxes. Returns None
+		when the stream can be skipped this round, otherwise the (x1, y1, x2, y2) region of the frame to infer.
+		Streams without motion gating and streams that are busy with an event always infer the whole frame, idle
+		streams are still fully inferred every motion_keepalive so objects that stopped moving are seen.
+		"""
+		streaminfo = self.streaminfos[streamid]
+		if not streaminfo.get('motion_gating') or streaminfo['recordcounter'] or streaminfo['recordflag'].value == 1:
+			return (0, 0, frame.shape[1], frame.shape[0])
+		now = datetime.now().timestamp()
+		keepalive = getattr(UserSettings, 'motion_keepalive', timedelta(seconds=10)).total_seconds()
+		if now - self.lastinference.get(streamid, 0) > keepalive:
+			return (0, 0, frame.shape[1], frame.shape[0])
+		motionboxes = streaminfo['motionboxes']
+		if motionboxes.lastmotion < self.lastinference[streamid]:
+			return None
+		boxes, frameseq, timestamp = motionboxes.read()
+		if not len(boxes):
+			return (0, 0, frame.shape[1], frame.shape[0])
+		# Infer the area around all moving objects, with a margin so objects partly outside the boxes are still found
+		x1, y1 = boxes[:, :2].min(axis=0)
+		x2, y2 = boxes[:, 2:].max(axis=0)
+		margin = max(x2 - x1, y2 - y1) * 0.3 + 32
+		x1 = int(max(x1 - margin, 0))
+		y1 = int(max(y1 - margin, 0))
+		x2 = int(min(x2 + margin, frame.shape[1]))
+		y2 = int(min(y2 + margin, frame.shape[0]))
+		# Cropping saves nothing when the motion covers most of the frame
+		if (x2 - x1) * (y2 - y1) > 0.6 * frame.shape[0] * frame.shape[1]:
+			return (0, 0, frame.shape[1], frame.shape[0])
+		return (x1, y1, x2, y2)
+
+	def submitdetect(self, frame, streamid) -> Future:
+		# Starts the inference of a frame with the settings of its stream, the result is collected later
+		return self.model.submit('detect', frame, classes=self.streaminfos[streamid]['detection_classes'],
+								 conf=self.streaminfos[streamid]['confidence_threshold'], nms=True, iou=0.5,
+								 verbose=False)
+
+	def detect_zone(self, frame, streamid, double_check=True, motion_detections=None, verifyframe=None,
+					detections=None) -> sv.Detections:
+		"""
+		Detects objects in the detect area of a stream. The frame may come from a lower resolution substream, the
+		detections are returned in the coordinates of the main stream and verifyframe is the main stream frame used
+		for the zoomed in double check. Detections already inferred for the frame in a batch can be passed in.
+		"""
+		confidence = self.streaminfos[streamid]['confidence_threshold']
+		classes = self.streaminfos[streamid]['detection_classes']
+		if verifyframe is None:
+			verifyframe = frame
 		if motion_detections is None:
-			confidence = self.streaminfos[streamid]['confidence_threshold']
-			classes = self.streaminfos[streamid]['detection_classes']
-			detections = self.model.detect(frame, classes=classes, conf=confidence,
-										nms=True, iou=0.5, verbose=False)
+			if detections is None:
+				detections = self.model.detect(frame, classes=classes, conf=confidence,
+											nms=True, iou=0.5, verbose=False)
+			width, height = self.streaminfos[streamid]['dimensions']
+			if frame.shape[:2] != (height, width):
+				detections.xyxy = detections.xyxy * np.array(
+					[width / frame.shape[1], height / frame.shape[0]] * 2, dtype=detections.xyxy.dtype
+				)
 		else:
 			detections = motion_detections
 		zone = sv.PolygonZone(self.streaminfos[streamid]['detectarea'],
@@ -148,30 +425,126 @@ class ObjectDetector(mp.Process):
 		zone_detections = detections[zone.trigger(detections=detections)]
 		# Zoom in and recheck if an object is found
 		if zone_detections and double_check:
-			verified = []
-			for detection in zone_detections:
-				x1, y1, x2, y2 = detection[0].astype(int)
-				dx = x2 - x1
-				dy = y2 - y1
-				newx1 = int(max((x1 - dx*0.3), 0))
-				newx2 = int(min((x2 + dx*0.3), self.streaminfos[streamid]['dimensions'][0]))
-				newy1 = int(max((y1 - dy*0.3), 0))
-				newy2 = int(min((y2 + dy*0.3), self.streaminfos[streamid]['dimensions'][1]))
-				newframe: np.ndarray = frame[newy1:newy2,newx1:newx2]
-				new_detections = self.model.detect(newframe, classes=classes, conf=confidence,
-									nms=True, iou=0.5, verbose=False)
-				# new_detections = sv.Detections.from_ultralytics(newresult)
-				num_detections = len(new_detections.xyxy)
-				if num_detections:
-					verified.append(True)
-				else:
-					verified.append(False)
+			zone_detections = self.verify_zones([(streamid, verifyframe, zone_detections)], cache=False)[0]
+		return zone_detections
+
+	def cropregions(self, xyxy, dimensions) -> list[list[int]]:
+		# Regions around the boxes with a 30% margin, overlapping regions are merged so every area is inferred once
+		width, height = dimensions
+		size = xyxy[:, 2:] - xyxy[:, :2]
+		regions = np.concatenate((xyxy[:, :2] - size * 0.3, xyxy[:, 2:] + size * 0.3), axis=1)
+		regions = np.clip(regions, 0, [width, height, width, height]).astype(int).tolist()
+		merged = True
+		while merged:
+			merged = False
+			for i in range(len(regions)):
+				for j in range(i + 1, len(regions)):
+					a, b = regions[i], regions[j]
+					if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+						regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+						del regions[j]
+						merged = True
+						break
+				if merged:
+					break
+		return regions
+
+	def verify_zones(self, items, cache=True) -> list[sv.Detections]:
+		"""
+		Zooms in on the zone detections of items, which are (streamid, frame, zone_detections) tuples with the frame in
+		main stream coordinates. The crops of all items go through the model as one batch and a detection is confirmed
+		when the zoomed in inference finds a box of the same class over it. With cache, for live frames, detections
+		matching a box confirmed in the last verify_cache_cycles detection cycles are trusted without zooming in again
+		and new confirmations are added to the cache. Returns the confirmed detections of every item.
+		"""
+		now = datetime.now().timestamp()
+		cachetime = getattr(UserSettings, 'verify_cache_cycles', 3) * UserSettings.check_detection_time.total_seconds()
+		confirmed = []
+		expiries = []
+		crops = []
+		owners = []
+		for i, (streamid, frame, zone_detections) in enumerate(items):
+			confirmed.append(np.zeros(len(zone_detections), dtype=bool))
+			# Boxes confirmed by zooming in are trusted for cachetime, boxes trusted from the cache keep their expiry
+			expiries.append(np.full(len(zone_detections), now + cachetime))
+			if not zone_detections:
+				continue
+			# Trust boxes that match a recently confirmed box of the same class
+			if cache and streamid in self.verifiedboxes:
+				cachedboxes, cachedclasses, expires = self.verifiedboxes[streamid]
+				alive = expires > now
+				if alive.any():
+					iou = sv.box_iou_batch(zone_detections.xyxy, cachedboxes[alive])
+					sameclass = zone_detections.class_id[:, None] == cachedclasses[alive][None, :]
+					matches = (iou >= 0.5) & sameclass
+					confirmed[i] = matches.any(axis=1)
+					expiries[i][confirmed[i]] = np.where(matches, expires[alive][None, :], 0).max(axis=1)[confirmed[i]]
+			pending = ~confirmed[i]
+			if not pending.any():
+				continue
+			for x1, y1, x2, y2 in self.cropregions(zone_detections.xyxy[pending], self.streaminfos[streamid]['dimensions']):
+				crops.append(frame[y1:y2, x1:x2])
+				owners.append((i, (x1, y1)))
+		if crops:
+			confidence, classes = self.batchsettings({items[i][0] for i, offset in owners})
+			crop_detections = self.model.detect_batch(crops, classes=classes, conf=confidence, nms=True, iou=0.5,
+													  verbose=False)
+			for (i, offset), detections in zip(owners, crop_detections):
+				streamid, frame, zone_detections = items[i]
+				detections = self.streamfilter(detections, streamid)
+				if not detections:
+					continue
+				detections.xyxy = detections.xyxy + np.array(offset * 2, dtype=detections.xyxy.dtype)
+				iou = sv.box_iou_batch(zone_detections.xyxy, detections.xyxy)
+				sameclass = zone_detections.class_id[:, None] == detections.class_id[None, :]
+				confirmed[i] |= ((iou >= 0.3) & sameclass).any(axis=1)
+		results = []
+		for (streamid, frame, zone_detections), verified, expiry in zip(items, confirmed, expiries):
 			zone_detections = zone_detections[verified]
-		zone_annotated_frame = draw_polygon(frame, zone.polygon, color=sv.Color.GREEN)
+			if cache and zone_detections:
+				self.cacheverified(streamid, zone_detections, expiry[verified], now)
+			results.append(zone_detections)
+		return results
+
+	def cacheverified(self, streamid, zone_detections, expiry, now):
+		# Adds confirmed boxes to the cache of a stream, they replace the live cached boxes they match
+		boxes, classes = zone_detections.xyxy.copy(), zone_detections.class_id.copy()
+		if streamid in self.verifiedboxes:
+			cachedboxes, cachedclasses, expires = self.verifiedboxes[streamid]
+			keep = expires > now
+			if keep.any():
+				iou = sv.box_iou_batch(cachedboxes, boxes)
+				keep &= ~((iou >= 0.5) & (cachedclasses[:, None] == classes[None, :])).any(axis=1)
+			boxes = np.concatenate((cachedboxes[keep], boxes))
+			classes = np.concatenate((cachedclasses[keep], classes))
+			expiry = np.concatenate((expires[keep], expiry))
+		self.verifiedboxes[streamid] = (boxes, classes, expiry)
+
+	def snapshot(self, streamid, frame, zone_detections, caption):
+		# Draw straight into a slot of the snapshot queue, or on a copy that gets pickled when all slots are taken
+		lease = self.snapshotqueue.lease(frame.shape, frame.dtype)
+		if lease is None:
+			self.snapshotqueue.put((streamid, self.annotate(frame, streamid, zone_detections), caption))
+			return
+		handle, view = lease
+		try:
+			self.annotate(frame, streamid, zone_detections, out=view)
+			self.snapshotqueue.put((streamid, handle, caption))
+		except:
+			# The slot goes back to the pool, nobody will get the handle
+			self.snapshotqueue.release(handle.slot)
+			raise
+
+	def annotate(self, frame, streamid, zone_detections, out=None) -> np.ndarray:
+		# Frames from the framebuffer are read-only views so draw on a copy, or into out, only done when the result is
+		# used
+		if out is None:
+			out = frame.copy()
+		else:
+			np.copyto(out, frame)
+		zone = sv.PolygonZone(self.streaminfos[streamid]['detectarea'],
+							  self.streaminfos[streamid]['dimensions'])
+		zone_annotated_frame = draw_polygon(out, zone.polygon, color=sv.Color.GREEN)
 		labels = [f'{self.model.model_names[class_id]} {conf: 0.2f}'
-				  for class_id, conf in zip(zone_detections.class_id, detections.confidence)]
-		annotated_frame = self.boxannotator.annotate(zone_annotated_frame, detections=zone_detections, labels=labels)
-		num_detections = len(labels)
-		inferencetime = datetime.now().timestamp() - starttime
-		self.avginferencetime = (self.avginferencetime * 19 + inferencetime) / 20
-		return (annotated_frame, num_detections)
+				  for class_id, conf in zip(zone_detections.class_id, zone_detections.confidence)]
+		return self.boxannotator.annotate(zone_annotated_frame, detections=zone_detections, labels=labels)
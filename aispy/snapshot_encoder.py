@@ -0,0 +1,84 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from settings import UserSettings
+
+try:
+	from turbojpeg import TurboJPEG
+except ImportError:
+	TurboJPEG = None
+
+
+class SnapshotEncoder:
+	"""
+	Encodes snapshots on a thread pool, the encoders release the GIL so the caller and its event loop keep going.
+
+	The format is snapshot_format, jpeg or webp, at snapshot_quality. JPEG uses libjpeg-turbo when it is installed.
+	latest keeps the encoded latest frame of every stream for snapshot_cache_ttl seconds, so snapshot requests that
+	come in together, for one stream or for all of them, share one encode.
+	"""
+	extensions = {'jpeg': 'jpg', 'webp': 'webp'}
+
+	def __init__(self, fmt: str | None = None, quality: int | None = None, ttl: float | None = None,
+				 threads: int | None = None):
+		self.format = fmt or getattr(UserSettings, 'snapshot_format', 'jpeg')
+		if self.format not in self.extensions:
+			raise ValueError(f'Unsupported snapshot format {self.format}, use one of {list(self.extensions)}')
+		self.quality = quality or getattr(UserSettings, 'snapshot_quality', 85)
+		self.ttl = getattr(UserSettings, 'snapshot_cache_ttl', 1.0) if ttl is None else ttl
+		self.pool = ThreadPoolExecutor(max_workers=threads or getattr(UserSettings, 'snapshot_encode_threads', 2),
+									   thread_name_prefix='snapshot-encoder')
+		self.jpeg = TurboJPEG() if TurboJPEG is not None and self.format == 'jpeg' else None
+		self.lock = threading.Lock()
+		# Per stream the sequence number of the cached frame, when the entry expires and the future of its encode
+		self.cache: dict[int, tuple[int, float, Future]] = {}
+
+	@property
+	def extension(self) -> str:
+		return self.extensions[self.format]
+
+	def encodenow(self, frame: np.ndarray) -> bytes:
+		if self.jpeg is not None:
+			return self.jpeg.encode(frame, quality=self.quality)
+		if self.format == 'webp':
+			check, encoded = cv2.imencode('.webp', frame, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+		else:
+			check, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+		if not check:
+			raise ValueError(f'Could not encode a {frame.shape} frame as {self.format}')
+		return encoded.tobytes()
+
+	def encode(self, frame: np.ndarray) -> Future:
+		# The frame must stay unchanged until the future is done
+		return self.pool.submit(self.encodenow, frame)
+
+	def latest(self, streamid, framebuffer) -> Future | None:
+		"""
+		The encoded latest frame of a stream, None while the stream has no frame yet. Reuses the cached encode while it
+		is younger than the TTL or while the stream has no newer frame.
+		"""
+		with self.lock:
+			now = time.monotonic()
+			cached = self.cache.get(streamid)
+			if cached is not None and failed(cached[2]):
+				cached = None
+			if cached is not None and cached[1] > now:
+				return cached[2]
+			seq = framebuffer.latestseq
+			if seq < 0:
+				return None
+			if cached is not None and cached[0] == seq:
+				future = cached[2]
+			else:
+				# Encode a copy, the writer reuses the slot of the frame
+				future = self.encode(framebuffer.get(seq))
+			self.cache[streamid] = (seq, now + self.ttl, future)
+			return future
+
+
+def failed(future: Future) -> bool:
+	return future.done() and future.exception() is not None
@@ -1,9 +1,13 @@
 import os
+import pathlib
+import shutil
+import subprocess
 import time
 from datetime import datetime
 from settings import UserSettings, Settings
 from utils import mainlogger
-from memory_managers import SharedFrameDeque
+from memory_managers import SharedFrameRing, SharedCompressedRing
+from capture import CaptureBackend, create_capture
 import cv2
 import multiprocessing as mp
 import threading
@@ -15,54 +19,141 @@ class Stream(mp.Process):
 		self.streamid = id
 		self.streaminfo = stream_info
 		self.fileannotatorqueue = fileannotatorqueue
-		self.framebuffer: SharedFrameDeque = self.streaminfo['framebuffer']
-		self.video = None
+		self.framebuffer: SharedFrameRing = self.streaminfo['framebuffer']
+		self.detectbuffer: SharedFrameRing = self.streaminfo['detectbuffer']
+		# Holds the pre record frames, either the framebuffer itself or a compressed ring
+		self.recordbuffer: SharedFrameRing | SharedCompressedRing = self.streaminfo['recordbuffer']
+		self.video: CaptureBackend | None = None
 		self.recorddir = Settings.videodir.joinpath(str(self.streamid))
 		self.recorddir.mkdir(parents=True, exist_ok=True)
 		self.out: cv2.VideoWriter | None = None
 
 	def run(self):
 		mainlogger.info(f'Stream {self.streamid} starting with pid {os.getpid()}')
-		recorder_worker = threading.Thread(target=self.recorder)
+		if self.streaminfo['record_mode'] == 'passthrough':
+			passthroughrecorder = PassthroughRecorder(self.streamid, self.streaminfo, self.recorddir, self.fileannotatorqueue)
+			recorder_worker = threading.Thread(target=passthroughrecorder.run)
+		else:
+			recorder_worker = threading.Thread(target=self.recorder)
 		recorder_worker.start()
+		# A compressed pre record buffer is filled from the framebuffer, so the capture loop only copies frames
+		if isinstance(self.recordbuffer, SharedCompressedRing):
+			encoder_worker = threading.Thread(target=self.prerecordencoder)
+			encoder_worker.start()
+		# A low resolution substream feeds the detector when configured, the main stream is only used for recording
+		if self.detectbuffer is not self.framebuffer:
+			detect_worker = threading.Thread(
+				target=self.capture,
+				args=(self.streaminfo['detect_url'], self.streaminfo['detect_dimensions'], self.detectbuffer, None)
+			)
+			detect_worker.start()
+		self.capture(self.streaminfo['url'], self.streaminfo['dimensions'], self.framebuffer, UserSettings.record_fps)
+
+	def capture(self, url, dimensions, framebuffer: SharedFrameRing, fps: float | None):
+		backend = self.streaminfo.get('capture', getattr(UserSettings, 'capture_backend', 'opencv'))
+		video = None
 		while True:
 			try:
-				mainlogger.info(f'Starting capture on stream {self.streamid}')
-				self.video = cv2.VideoCapture(self.streaminfo['url'])
+				mainlogger.info(f'Starting {backend} capture on stream {self.streamid}')
+				# Cameras with lite_aspect_ratio send the main stream at half the width
+				double_width = framebuffer is self.framebuffer and bool(self.streaminfo.get('lite_aspect_ratio'))
+				video = create_capture(backend, url, dimensions, hwaccel=self.streaminfo.get('hwaccel'),
+									   double_width=double_width)
+				if framebuffer is self.framebuffer:
+					self.video = video
+				video.open()
 				now = datetime.now().timestamp()
 				missed_frames = 0
 				while True:
-					check, frame = self.video.read()
-					if self.streaminfo['lite_aspect_ratio']:
-						frame = frame.repeat(2,1)
+					check, frame = video.read()
 					if check == False:
 						mainlogger.warning('Video Not Found. Please Enter a Valid Path (Full path of Video Should be Provided).')
+						video.release()
 						return
-					# Place the correct number of frames on the buffer
 					prev = now
 					now = datetime.now().timestamp()
+					if fps is None:
+						framebuffer.append(frame, now)
+						continue
+					# Only place frames that are due at the record fps on the buffer, each one once with its capture
+					# time, the recorder repeats frames when the capture is slower than the record fps
 					dt = now-prev
-					missed_frames += dt/(1/UserSettings.record_fps)
+					missed_frames += dt/(1/fps)
 					frames_to_place = int(missed_frames//1)
 					missed_frames -= frames_to_place
-					for i in range(frames_to_place):
-						self.framebuffer.append(frame)
+					if frames_to_place:
+						framebuffer.append(frame, now)
 			except:
 				mainlogger.warning(f'Exception on stream {self.streamid} restarting in 10 seconds')
+				if video is not None:
+					video.release()
+				time.sleep(10)
+
+	def prerecordencoder(self):
+		"""
+		Compresses every frame of the framebuffer into the compressed pre record ring with its capture time. Runs next
+		to the capture loop, the encoders release the GIL. Frames that were overwritten in the framebuffer before they
+		were encoded are skipped.
+		"""
+		mainlogger.info(f'Pre record encoder thread started for {self.streamid}')
+		frameperiod = 1 / UserSettings.record_fps
+		nextseq = 0
+		while True:
+			try:
+				while True:
+					if nextseq > self.framebuffer.latestseq:
+						time.sleep(frameperiod / 2)
+						continue
+					if nextseq < self.framebuffer.head:
+						skipped = self.framebuffer.head - nextseq
+						mainlogger.debug(f'Pre record encoder on {self.streamid} skipped {skipped} frames')
+						nextseq = self.framebuffer.head
+					view, token = self.framebuffer.getview(nextseq)
+					timestamp = self.framebuffer.gettimestamp(nextseq)
+					encoded = self.recordbuffer.encode(view)
+					# A frame overwritten while it was encoded is torn, the next one is newer anyway
+					if self.framebuffer.isvalid(nextseq, token):
+						self.recordbuffer.appendencoded(encoded, timestamp)
+					nextseq += 1
+			except:
+				mainlogger.exception(f'Error on stream {self.streamid} pre record encoder restarting in 10')
 				time.sleep(10)
 
 	def recorder(self):
 		mainlogger.info(f'Recorder thread started for {self.streamid}')
 		recording = False
+		frameperiod = 1 / UserSettings.record_fps
+		# Sequence number of the frame being recorded, the ring is never consumed so the recorder keeps its own cursor
+		nextseq = 0
+		# Capture time of the next frame written to the output, frames are repeated or skipped to hit the record fps
+		outtime = None
+		# Sequence number of the frame last read, repeated frames are not read and decoded again
+		frameseq = None
 		while True:
 			try:
 				while True:
 					while self.streaminfo['recordflag'].value == 1:
-						if len(self.framebuffer) > 0:
-							frame = self.framebuffer.popleft()
-						else:
+						# Start from the oldest frame still in the ring to include the pre record time. When the frames
+						# were overwritten before they were recorded continue from the oldest one left, at its time
+						# instead of repeating it until the output time catches up
+						if nextseq < self.recordbuffer.head:
+							nextseq = self.recordbuffer.head
+							outtime = None
+						if nextseq > self.recordbuffer.latestseq:
 							time.sleep(2)
 							continue
+						if outtime is None:
+							outtime = self.recordbuffer.gettimestamp(nextseq)
+						# Use the newest frame captured at or before the output time
+						while nextseq < self.recordbuffer.latestseq and self.recordbuffer.gettimestamp(nextseq + 1) <= outtime:
+							nextseq += 1
+						# Wait for the output time when recording live, a newer frame may still arrive before it
+						if nextseq == self.recordbuffer.latestseq and outtime > datetime.now().timestamp():
+							time.sleep(min(outtime - datetime.now().timestamp(), frameperiod))
+							continue
+						if nextseq != frameseq:
+							frame, token = self.recordbuffer.getview(nextseq)
+							frameseq = nextseq
 						# Init the recording if it is not yet
 						if self.out is None:
 							recording = True
@@ -73,6 +164,9 @@ class Stream(mp.Process):
 							# fourcc = cv2.VideoWriter_fourcc(*'H264')
 							self.out = cv2.VideoWriter(filename, fourcc, UserSettings.record_fps, self.streaminfo['dimensions'])
 						self.out.write(frame)
+						if not self.recordbuffer.isvalid(nextseq, token):
+							mainlogger.debug(f'Frame on {self.streamid} was overwritten while it was being recorded')
+						outtime += frameperiod
 						if datetime.now() >= now + UserSettings.max_clip_length:
 							recording = False
 							mainlogger.info(f'Recording segment on {self.streamid} done')
@@ -80,8 +174,11 @@ class Stream(mp.Process):
 								self.out.release()
 								self.out = None
 							self.fileannotatorqueue.put((self.streamid, filename))
+					outtime = None
 					if recording:
 						recording = False
+						# Do not record the last frame again in the next recording
+						nextseq += 1
 						mainlogger.info(f'Recording on {self.streamid} done')
 						if self.out is not None:
 							self.out.release()
@@ -92,3 +189,149 @@ class Stream(mp.Process):
 				mainlogger.warning(f'Error on stream {self.streamid} recorder restarting in 10')
 				time.sleep(10)
 
+
+class PassthroughRecorder:
+	"""
+	Records a stream by remuxing the compressed packets of the camera into mp4 clips without decoding or encoding.
+
+	An ffmpeg process copies the stream into short mpegts segments in a cache directory. Segments are cut on
+	keyframes, so the last few segments form a keyframe aligned ring of compressed packets that holds the pre record
+	time. A recording concatenates its segments into an mp4 clip with the concat demuxer.
+	"""
+	def __init__(self, streamid, streaminfo, recorddir: pathlib.Path, fileannotatorqueue):
+		self.streamid = streamid
+		self.streaminfo = streaminfo
+		self.recorddir = recorddir
+		self.fileannotatorqueue = fileannotatorqueue
+		self.segment_time: int = getattr(UserSettings, 'segment_time', 2)
+		self.cachedir = pathlib.Path(getattr(Settings, 'segment_cache_dir', '/dev/shm/aispy/segments')).joinpath(str(streamid))
+		self.process: subprocess.Popen | None = None
+		# Start times of the segments in the cache, worked out while their predecessor is still there
+		self.starts: dict[pathlib.Path, datetime] = {}
+
+	def startsegmenter(self):
+		self.cachedir.mkdir(parents=True, exist_ok=True)
+		for segment in self.cachedir.glob('*.ts'):
+			segment.unlink()
+		self.starts.clear()
+		url = str(self.streaminfo['url'])
+		cmd = [shutil.which('ffmpeg') or 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+		if url.startswith('rtsp://'):
+			cmd += ['-rtsp_transport', 'tcp']
+		cmd += ['-i', url, '-map', '0:v', '-c', 'copy']
+		cmd += ['-f', 'segment', '-segment_time', str(self.segment_time), '-segment_format', 'mpegts']
+		# Segments are named after the start of the segmenter in milliseconds and their index, so names never collide
+		# and sort in recording order
+		runstart = int(datetime.now().timestamp() * 1000)
+		cmd += ['-reset_timestamps', '1', str(self.cachedir.joinpath(f'{runstart}_%06d.ts'))]
+		mainlogger.info(f'Starting passthrough segmenter on {self.streamid}')
+		self.process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+	def segments(self) -> tuple[list[pathlib.Path], pathlib.Path | None]:
+		# Returns the completed segments and the one ffmpeg is still writing
+		segments = sorted(self.cachedir.glob('*.ts'))
+		if not segments:
+			return [], None
+		return segments[:-1], segments[-1]
+
+	def segmentstart(self, segment: pathlib.Path) -> datetime:
+		# A segment starts when ffmpeg last wrote its predecessor, the first segment of a run when the segmenter started
+		if segment not in self.starts:
+			runstart, index = segment.stem.split('_')
+			previous = segment.with_name(f'{runstart}_{int(index) - 1:06d}.ts')
+			if int(index) > 0 and previous.exists():
+				self.starts[segment] = datetime.fromtimestamp(previous.stat().st_mtime)
+			else:
+				self.starts[segment] = datetime.fromtimestamp(int(runstart) / 1000 + int(index) * self.segment_time)
+		return self.starts[segment]
+
+	def prerecord(self, segments: list[pathlib.Path], now: datetime) -> list[pathlib.Path]:
+		# The segments covering the pre record time, starting from the keyframe at or before the start of the window
+		windowstart = now - UserSettings.pre_record_time
+		first = 0
+		for i, segment in enumerate(segments):
+			if self.segmentstart(segment) <= windowstart:
+				first = i
+		return segments[first:]
+
+	def writeclip(self, clip: list[pathlib.Path]) -> bool:
+		"""
+		Concatenates the segments of a clip into an mp4 in the record dir and queues it for annotation. When ffmpeg
+		fails the segments are moved to a directory next to where the clip would be, so the recording is not lost.
+		"""
+		clipname = self.segmentstart(clip[0]).strftime("%Y%m%d_%H%M%S")
+		filename = str(self.recorddir.joinpath(f'{clipname}.mp4'))
+		listfile = self.cachedir.joinpath('concat.txt')
+		listfile.write_text(''.join(f"file '{segment}'\n" for segment in clip))
+		cmd = [shutil.which('ffmpeg') or 'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y']
+		cmd += ['-f', 'concat', '-safe', '0', '-i', str(listfile), '-c', 'copy', '-movflags', '+faststart', filename]
+		try:
+			result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+			error = result.stderr.decode(errors='replace').strip() if result.returncode else None
+		except OSError as e:
+			error = str(e)
+		if error is None:
+			mainlogger.info(f'Recording segment on {self.streamid} done')
+			self.fileannotatorqueue.put((self.streamid, filename))
+			return True
+		segmentdir = self.recorddir.joinpath(f'{clipname}_segments')
+		segmentdir.mkdir(parents=True, exist_ok=True)
+		for segment in clip:
+			if segment.exists():
+				shutil.move(segment, segmentdir.joinpath(segment.name))
+		mainlogger.error(f'Concatenating the recording on {self.streamid} failed, kept its segments in {segmentdir}: {error}')
+		return False
+
+	def run(self):
+		mainlogger.info(f'Passthrough recorder thread started for {self.streamid}')
+		clip: list[pathlib.Path] = []
+		clipstart: datetime | None = None
+		# Newest segment that was added to a clip
+		lastclipped: pathlib.Path | None = None
+		# The segment being written when the recordflag cleared, the clip is closed once it is complete
+		lastsegment: pathlib.Path | None = None
+		while True:
+			try:
+				if self.process is None or self.process.poll() is not None:
+					self.startsegmenter()
+				completed, inprogress = self.segments()
+				now = datetime.now()
+				if self.streaminfo['recordflag'].value == 1:
+					lastsegment = None
+					if clipstart is None:
+						mainlogger.info(f'Recording on {self.streamid} started')
+						clipstart = now
+						clip = [segment for segment in self.prerecord(completed, now) if lastclipped is None or segment > lastclipped]
+					clip += [segment for segment in completed if lastclipped is None or segment > lastclipped]
+					lastclipped = max(clip, default=lastclipped)
+					if clip and now >= clipstart + UserSettings.max_clip_length:
+						self.writeclip(clip)
+						clipstart = now
+						clip = []
+				elif clipstart is not None:
+					if lastsegment is None:
+						lastsegment = inprogress
+					clip += [segment for segment in completed if lastclipped is None or segment > lastclipped]
+					lastclipped = max(clip, default=lastclipped)
+					if lastsegment is None or lastsegment in completed:
+						mainlogger.info(f'Recording on {self.streamid} done')
+						if clip:
+							self.writeclip(clip)
+						clipstart = None
+						clip = []
+						lastsegment = None
+				# Drop the segments that are neither part of a clip nor of the pre record ring
+				keep = set(clip) | set(self.prerecord(completed, now))
+				for segment in completed:
+					if segment not in keep:
+						segment.unlink(missing_ok=True)
+						self.starts.pop(segment, None)
+				time.sleep(1)
+			except:
+				mainlogger.exception(f'Error on stream {self.streamid} passthrough recorder restarting in 10')
+				if self.process is not None:
+					self.process.kill()
+					self.process = None
+				clipstart = None
+				clip = []
+				time.sleep(10)
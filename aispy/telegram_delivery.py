@@ -0,0 +1,141 @@
+import asyncio
+import os
+import pathlib
+import threading
+import time
+from concurrent.futures import Future
+
+import telegram
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+from utils import mainlogger
+
+
+class TelegramDelivery:
+	"""
+	Sends messages and photos to a list of chats concurrently over one pooled HTTP connection, from the asyncio loop of
+	whoever awaits it.
+
+	A photo is uploaded once, the other chats get the file_id Telegram returned for it, so alert latency no longer
+	grows with the number of recipients. Requests are spaced by at least 1 / max_rate seconds, the overall limit of a
+	bot, and a RetryAfter from Telegram pauses all requests for the time it asks. Message edits are coalesced, edit_text
+	returns at once and only the latest text of a message is sent, at most one edit per message per edit_interval.
+	"""
+
+	def __init__(self, token, connection_pool_size=8, max_rate=25.0, edit_interval=1.0, base_url=None,
+				 loop: asyncio.AbstractEventLoop | None = None):
+		kwargs = {'base_url': base_url} if base_url else {}
+		self.bot = telegram.Bot(token, request=HTTPXRequest(connection_pool_size=connection_pool_size), **kwargs)
+		self.min_spacing = 1 / max_rate
+		self.edit_interval = edit_interval
+		self.nextrequest = 0.0
+		self.initialized = False
+		# The loop thread of a background delivery, None when the caller runs its own loop
+		self.loop = loop
+		# Latest wanted (text, reply_markup) per (chat id, message id), the running edit task of a message and the
+		# text it last sent, which is forgotten once the message has no edits waiting
+		self.edits: dict[tuple[int, int], tuple] = {}
+		self.editing: dict[tuple[int, int], asyncio.Task] = {}
+		self.lasttext: dict[tuple[int, int], str] = {}
+
+	async def request(self, method, *args, **kwargs):
+		# Calls a bot method within the rate limit, retrying after the wait Telegram asks for
+		if not self.initialized:
+			# Only marked once it worked so a failed initialization is tried again by the next request
+			await self.bot.initialize()
+			self.initialized = True
+		for attempt in range(3):
+			now = time.monotonic()
+			wait = self.nextrequest - now
+			self.nextrequest = max(now, self.nextrequest) + self.min_spacing
+			if wait > 0:
+				await asyncio.sleep(wait)
+			try:
+				return await method(*args, **kwargs)
+			except RetryAfter as e:
+				mainlogger.warning(f'Telegram asks to wait {e.retry_after}s')
+				self.nextrequest = time.monotonic() + float(e.retry_after)
+		raise TelegramError('Telegram kept asking to retry later')
+
+	async def gather(self, chat_ids, method, **kwargs) -> list:
+		# Same request for every chat at once, failed chats are logged and left out of the result
+		results = await asyncio.gather(*(self.request(method, chat_id=chat_id, **kwargs) for chat_id in chat_ids),
+									   return_exceptions=True)
+		for chat_id, result in zip(chat_ids, results):
+			if isinstance(result, Exception):
+				mainlogger.warning(f'Sending to Telegram chat {chat_id} failed: {result}')
+		return [result for result in results if not isinstance(result, Exception)]
+
+	async def send_message(self, chat_ids, text, reply_markup=None) -> list[telegram.Message]:
+		return await self.gather(chat_ids, self.bot.send_message, text=text, reply_markup=reply_markup)
+
+	async def send_photo(self, chat_ids, photo, caption=None) -> list[telegram.Message]:
+		"""
+		Sends a photo, a path or the encoded bytes, to all chats. The first chat that accepts the upload provides the
+		file_id for the others.
+		"""
+		if isinstance(photo, (str, pathlib.Path)):
+			photo = await asyncio.to_thread(pathlib.Path(photo).read_bytes)
+		chat_ids = list(chat_ids)
+		for i, chat_id in enumerate(chat_ids):
+			try:
+				first = await self.request(self.bot.send_photo, chat_id=chat_id, photo=photo, caption=caption)
+			except TelegramError as e:
+				mainlogger.warning(f'Uploading photo to Telegram chat {chat_id} failed: {e}')
+				continue
+			rest = await self.gather(chat_ids[i + 1:], self.bot.send_photo, photo=first.photo[-1].file_id,
+									 caption=caption)
+			return [first] + rest
+		return []
+
+	def edit_text(self, message: telegram.Message, text, reply_markup=None):
+		# Replaces any edit of the message that was not sent yet, edits of a message are sent one after the other so
+		# the last text asked for is the one that stays
+		key = (message.chat_id, message.message_id)
+		self.edits[key] = (text, reply_markup)
+		if key not in self.editing:
+			# The loop only keeps a weak reference to its tasks
+			self.editing[key] = asyncio.ensure_future(self.editloop(key))
+
+	async def editloop(self, key):
+		try:
+			while key in self.edits:
+				text, reply_markup = self.edits.pop(key)
+				if text == self.lasttext.get(key):
+					continue
+				started = time.monotonic()
+				try:
+					await self.request(self.bot.edit_message_text, text=text, chat_id=key[0], message_id=key[1],
+									   reply_markup=reply_markup)
+					self.lasttext[key] = text
+				except BadRequest as e:
+					# Edits of a deleted message or to the same text are refused, nothing to retry
+					mainlogger.debug('Edit of Telegram message %s refused: %s', key, e)
+				except TelegramError as e:
+					mainlogger.warning(f'Editing Telegram message {key} failed: {e}')
+				await asyncio.sleep(max(self.edit_interval - (time.monotonic() - started), 0))
+		finally:
+			self.editing.pop(key, None)
+			self.lasttext.pop(key, None)
+
+
+# Deliveries with their own loop thread for processes that have no asyncio loop, one per process and token
+_backgrounddeliveries: dict[tuple[int, str], TelegramDelivery] = {}
+_backgroundlock = threading.Lock()
+
+
+def background_delivery(token) -> TelegramDelivery:
+	with _backgroundlock:
+		key = (os.getpid(), token)
+		if key not in _backgrounddeliveries:
+			loop = asyncio.new_event_loop()
+			threading.Thread(target=loop.run_forever, daemon=True).start()
+			_backgrounddeliveries[key] = TelegramDelivery(token, loop=loop)
+		return _backgrounddeliveries[key]
+
+
+def send_photo_telegram(image, chat_ids, token, image_caption="") -> Future:
+	# Sends a photo, a path or the encoded bytes, to all chats without waiting, the future has the sent messages
+	delivery = background_delivery(token)
+	return asyncio.run_coroutine_threadsafe(delivery.send_photo(chat_ids, image, image_caption), delivery.loop)
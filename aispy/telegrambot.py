@@ -16,6 +16,9 @@ from settings import Settings, UserSettings
 from utils import mainlogger
 import logging
 from autoarm import AutoArm
+from mediamanagers import detection_track_path, render_annotated_clip
+from telegram_delivery import TelegramDelivery
+from snapshot_encoder import SnapshotEncoder
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (Application, CallbackQueryHandler, CommandHandler, MessageHandler, ConversationHandler,
                           ContextTypes, filters)
@@ -29,6 +32,9 @@ from telegram.ext import (Application, CallbackQueryHandler, CommandHandler, Mes
 #
 # logger = mainlogger
 
+# Largest file the bot API accepts for an upload
+TELEGRAM_MAX_UPLOAD = 50 * 2**20
+
 
 def restricted_to_admin(func):
     @wraps(func)
@@ -71,6 +77,22 @@ class Telegrambot(mp.Process):
         self.userkeyboard = ReplyKeyboardMarkup([['/start']], is_persistent=True)
         self.adminkeyboard = ReplyKeyboardMarkup([['/start'],['/admin','exit admin']], is_persistent=True)
         self.usetimer = True
+        self._delivery: TelegramDelivery | None = None
+        self._encoder: SnapshotEncoder | None = None
+
+    @property
+    def delivery(self) -> TelegramDelivery:
+        # Created in the bot process, its connection pool belongs to the event loop there
+        if self._delivery is None:
+            self._delivery = TelegramDelivery(Settings.fractal_token)
+        return self._delivery
+
+    @property
+    def encoder(self) -> SnapshotEncoder:
+        # Created in the bot process, threads do not survive the fork
+        if self._encoder is None:
+            self._encoder = SnapshotEncoder()
+        return self._encoder
 
     def create_arm_disarm_keyboard(self):
         buttons_per_row = 2
@@ -115,6 +137,13 @@ class Telegrambot(mp.Process):
         keyboard[-1] += empties
         return keyboard
 
+    def create_send_clip_keyboard(self):
+        # One button per stream, two per row
+        streamids = [streamid for streamid in self.streaminfos.keys() if streamid != 0]
+        buttons = [InlineKeyboardButton(f'Last clip of Stream {streamid}', callback_data=f'send_clip_{streamid}')
+                   for streamid in streamids]
+        return [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+
     @restricted_to_admin
     async def admin_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         keyboard = [
@@ -361,7 +390,8 @@ class Telegrambot(mp.Process):
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         keyboard = [
             [InlineKeyboardButton('Arm/Disarm', callback_data=f'arm_disarm_show')],
-            [InlineKeyboardButton('Snapshots', callback_data=f'take_snapshot_show')]
+            [InlineKeyboardButton('Snapshots', callback_data=f'take_snapshot_show')],
+            [InlineKeyboardButton('Clips', callback_data=f'send_clip_show')]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         if update.effective_user.id in Settings.telegram_adminlist:
@@ -417,14 +447,56 @@ class Telegrambot(mp.Process):
                 streamids = [x for x in self.streaminfos.keys()][1:]
             else:
                 streamids = [streamid]
-            for stream in streamids:
-                img = self.streaminfos[stream]['framebuffer'][-1]
-                # encode
-                is_success, buffer = cv2.imencode(".jpg", img)
-                io_buf = io.BytesIO(buffer)
-                await update.effective_message.reply_photo(io_buf, f'Stream {stream}')
+            # Encoded on the encoder threads, all streams at once and shared with requests in the last second
+            futures = {stream: self.encoder.latest(stream, self.streaminfos[stream]['framebuffer'])
+                       for stream in streamids}
+            encodes = [asyncio.wrap_future(future) for future in futures.values() if future is not None]
+            encoded = iter(await asyncio.gather(*encodes))
+            for stream, future in futures.items():
+                if future is None:
+                    await update.effective_message.reply_text(f'No frame from Stream {stream} yet')
+                else:
+                    await update.effective_message.reply_photo(io.BytesIO(next(encoded)), f'Stream {stream}')
             await self.start_command(update, context)
 
+    @restricted_to_user
+    async def send_clip(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        await query.answer()
+        command = re.match(re.compile('^(send_clip_)(.*)$'), query.data).group(2)
+        if command == 'show':
+            reply_markup = InlineKeyboardMarkup(self.create_send_clip_keyboard())
+            await query.edit_message_text(text='Choose a stream', reply_markup=reply_markup)
+            return
+        streamid = int(command)
+        # The latest clip that was annotated already, its overlays are rendered just for this message
+        clips = [clip for clip in sorted(Settings.videodir.joinpath(str(streamid)).glob('*.mp4'), reverse=True)
+                 if detection_track_path(clip).is_file()]
+        if not clips:
+            await update.effective_message.reply_text(f'No annotated clips of Stream {streamid} yet')
+        else:
+            outpath = Settings.annotatedvideodir.joinpath(str(streamid))
+            outpath.mkdir(parents=True, exist_ok=True)
+            outfilename = outpath.joinpath(clips[0].name)
+            try:
+                rendered = await asyncio.to_thread(render_annotated_clip, clips[0], outfilename,
+                                                   self.streaminfos[streamid])
+                if not rendered:
+                    await update.effective_message.reply_text(
+                        f'Could not render clip {clips[0].stem} of Stream {streamid}'
+                    )
+                elif outfilename.stat().st_size > TELEGRAM_MAX_UPLOAD:
+                    await update.effective_message.reply_text(
+                        f'Clip {clips[0].stem} of Stream {streamid} is {outfilename.stat().st_size / 2**20:0.0f} MB, '
+                        f'bots can only send files up to {TELEGRAM_MAX_UPLOAD // 2**20} MB'
+                    )
+                else:
+                    with open(outfilename, 'rb') as video:
+                        await update.effective_message.reply_video(video, caption=f'Stream {streamid} {clips[0].stem}')
+            finally:
+                outfilename.unlink(missing_ok=True)
+        await self.start_command(update, context)
+
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Displays info on how to use the bot."""
         non_user_reply_str = 'Please contact an admin to get access to this bot'
@@ -442,7 +514,6 @@ class Telegrambot(mp.Process):
         await update.effective_message.reply_text(reply_str, reply_markup=reply_markup)
 
     async def notify_alarm(self):
-        bot = telegram.Bot(Settings.fractal_token)
         keyboard = [
             [InlineKeyboardButton('Cancel Alarm', callback_data=f'alarm_cancel'),
             InlineKeyboardButton('Confirm Alarm', callback_data=f'alarm_confirm')]
@@ -451,20 +522,21 @@ class Telegrambot(mp.Process):
         while True:
             if self.streaminfos[0]['alarm'].value == 1:
                 timer = 30
-                async with bot:
-                    msgs = [await bot.sendMessage(text=f'Alarm will trigger in {timer}s', reply_markup=reply_markup, chat_id=id) for id in Settings.telegram_alarmlist]
+                # All alarm users get the countdown at once, the edits of every second are sent in the background
+                msgs = await self.delivery.send_message(Settings.telegram_alarmlist, f'Alarm will trigger in {timer}s',
+                                                        reply_markup=reply_markup)
+                await asyncio.sleep(1)
+                while (timer > 0) and (self.streaminfos[0]['alarm'].value == 1):
+                    timer -= 1
+                    for msg in msgs:
+                        self.delivery.edit_text(msg, f'Alarm will trigger in {timer}s', reply_markup=reply_markup)
                     await asyncio.sleep(1)
-                    while (timer > 0) and (self.streaminfos[0]['alarm'].value == 1):
-                        timer -= 1
-                        for msg in msgs:
-                            await msg.edit_text(text=f'Alarm will trigger in {timer}s', reply_markup=reply_markup)
-                        await asyncio.sleep(1)
-                    if self.streaminfos[0]['alarm'].value == 1:
-                        for msg in msgs:
-                            await msg.edit_text(text=f'Alarm Triggered Due to Timer Expiration')
-                        # Trigger the alarm
-                        self.streaminfos[0]['alarm'].value = 0
-                        await self.trigger_alarm()
+                if self.streaminfos[0]['alarm'].value == 1:
+                    for msg in msgs:
+                        self.delivery.edit_text(msg, f'Alarm Triggered Due to Timer Expiration')
+                    # Trigger the alarm
+                    self.streaminfos[0]['alarm'].value = 0
+                    await self.trigger_alarm()
             await asyncio.sleep(0.2)
 
     @restricted_to_alarmuser
@@ -482,19 +554,17 @@ class Telegrambot(mp.Process):
             self.streaminfos[0]['alarm'].value = 0
             await self.trigger_alarm()
             reply_str = 'Alarm Confirmed'
-        await query.edit_message_text(text=reply_str, reply_markup=reply_markup)
+        # Through the delivery so it lands after any countdown edit of the message that is still on its way
+        self.delivery.edit_text(update.effective_message, reply_str, reply_markup=reply_markup)
 
     async def trigger_alarm(self):
         mainlogger.info('Triggering Alarm')
         try:
             requests.get(f'http://{UserSettings.alarm_relay_ip}/cm?cmnd=Power%20On')
         except:
-            bot = telegram.Bot(Settings.fractal_token)
-            msgs = [await bot.sendMessage(text=f'Error Triggering Alarm', chat_id=id)
-                    for id in Settings.telegram_alarmlist]
+            await self.delivery.send_message(Settings.telegram_alarmlist, f'Error Triggering Alarm')
 
     async def auto_arm_disarm_timer(self):
-        bot = telegram.Bot(Settings.fractal_token)
         timerlist = UserSettings.auto_arm_disarm_list
         check_if_active_time = 1
         while True:
@@ -504,13 +574,11 @@ class Telegrambot(mp.Process):
                     if action is True:
                         print(f'{timer} triggered')
                         self.streaminfos[0]['armed'].value = 1
-                        msgs = [await bot.sendMessage(text=f'Auto Armed', chat_id=id)
-                                for id in Settings.telegram_notify_arm_disarm_list]
+                        await self.delivery.send_message(Settings.telegram_notify_arm_disarm_list, f'Auto Armed')
                     elif action is False:
                         print(f'{timer} triggered')
                         self.streaminfos[0]['armed'].value = 0
-                        msgs = [await bot.sendMessage(text=f'Auto Disarmed', chat_id=id)
-                                for id in Settings.telegram_notify_arm_disarm_list]
+                        await self.delivery.send_message(Settings.telegram_notify_arm_disarm_list, f'Auto Disarmed')
                 await asyncio.sleep(check_if_active_time)
             else:
                 await asyncio.sleep(check_if_active_time)
@@ -568,6 +636,7 @@ class Telegrambot(mp.Process):
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CallbackQueryHandler(self.arm_disarm, pattern='^arm_disarm_.*$'))
         self.application.add_handler(CallbackQueryHandler(self.take_snapshot, pattern='^take_snapshot_.*$'))
+        self.application.add_handler(CallbackQueryHandler(self.send_clip, pattern='^send_clip_.*$'))
         self.application.add_handler(CallbackQueryHandler(self.alarm_cancel_confirm, pattern='^alarm_.*$'))
         self.application.add_handler(CommandHandler("help", self.help_command))
         self.application.add_handler(MessageHandler(filters.ALL, self.help_command))
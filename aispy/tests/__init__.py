@@ -0,0 +1,12 @@
+import pathlib
+import sys
+
+# The modules of aispy import each other as top level modules
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+# settings.py is written per install and not in the repository, without one the tests run against a minimal stub
+try:
+	import settings  # noqa
+except ModuleNotFoundError:
+	from . import stub_settings
+	sys.modules['settings'] = stub_settings
@@ -0,0 +1,31 @@
+import logging
+import pathlib
+import tempfile
+from datetime import timedelta
+
+# Stand-in for the settings module of an install, which is not part of the repository. Only what the modules under
+# test read at import time and without a getattr default is set, logs and videos go to a temporary directory
+tmpdir = pathlib.Path(tempfile.mkdtemp(prefix='aispy-tests-'))
+
+
+class Settings:
+	log_name = str(tmpdir / 'aispy.log')
+	log_maxbytes = 1_000_000
+	log_maxnum = 1
+	file_loglevel = logging.DEBUG
+	console_loglevel = logging.CRITICAL
+	telegram_loglevel = logging.CRITICAL
+	telegram_chat_id = 0
+	telegram_token = ''
+	videodir = tmpdir / 'videos'
+	db_file = str(tmpdir / 'aispy.db')
+	avg_inference_time = 0.1
+
+
+class UserSettings:
+	streaminfo = {}
+	record_fps = 10
+	pre_record_time = timedelta(seconds=4)
+	max_clip_length = timedelta(seconds=30)
+	check_detection_time = timedelta(seconds=1)
+	detections_for_event = 3
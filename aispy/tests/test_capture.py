@@ -0,0 +1,67 @@
+import pathlib
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from capture import create_capture
+
+
+class CaptureTest(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		# A short clip with a different picture in every frame
+		cls.tmpdir = tempfile.TemporaryDirectory()
+		cls.path = str(pathlib.Path(cls.tmpdir.name).joinpath('clip.avi'))
+		writer = cv2.VideoWriter(cls.path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (64, 48))
+		for i in range(12):
+			frame = np.zeros((48, 64, 3), dtype=np.uint8)
+			frame[:, :, 1] = np.arange(64, dtype=np.uint8)[None, :] * 4
+			frame[:, :, 2] = i * 20
+			writer.write(frame)
+		writer.release()
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.tmpdir.cleanup()
+
+	def decode(self, backend, dimensions=None, pixel_format='bgr24', double_width=False) -> list[np.ndarray]:
+		capture = create_capture(backend, self.path, dimensions, pixel_format=pixel_format, double_width=double_width)
+		capture.open()
+		frames = []
+		try:
+			while True:
+				check, frame = capture.read()
+				if not check:
+					break
+				frames.append(frame.copy())
+		finally:
+			capture.release()
+		return frames
+
+	def check_backend(self, backend):
+		frames = self.decode(backend)
+		self.assertEqual(len(frames), 12)
+		self.assertEqual(frames[0].shape, (48, 64, 3))
+		frames = self.decode(backend, (32, 24), pixel_format='gray')
+		self.assertEqual(len(frames), 12)
+		self.assertEqual(frames[0].shape, (24, 32))
+		# Every column is repeated when the width is doubled
+		frames = self.decode(backend, double_width=True)
+		self.assertEqual(len(frames), 12)
+		self.assertEqual(frames[0].shape, (48, 128, 3))
+		np.testing.assert_array_equal(frames[0][:, ::2], frames[0][:, 1::2])
+
+	def test_opencv(self):
+		self.check_backend('opencv')
+
+	@unittest.skipUnless(shutil.which('ffmpeg'), 'ffmpeg is not installed')
+	def test_ffmpeg(self):
+		self.check_backend('ffmpeg')
+
+
+if __name__ == '__main__':
+	unittest.main()
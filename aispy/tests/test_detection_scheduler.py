@@ -0,0 +1,92 @@
+import unittest
+from datetime import timedelta
+from types import SimpleNamespace
+
+from detection_scheduler import DetectionScheduler
+
+
+def streaminfos(intervals: dict) -> dict:
+	# Armed streams without motion gating or events, with their own detection interval in seconds
+	infos = {0: {}}
+	for streamid, interval in intervals.items():
+		infos[streamid] = {'recordflag': SimpleNamespace(value=0), 'recordcounter': 0, 'motion_gating': False,
+						   'detect_interval': timedelta(seconds=interval),
+						   'detect_interval_active': timedelta(seconds=interval)}
+	return infos
+
+
+class DetectionSchedulerTest(unittest.TestCase):
+
+	def scheduler(self, intervals: dict, cost: float) -> DetectionScheduler:
+		scheduler = DetectionScheduler(streaminfos(intervals), backlog_share=0.2)
+		scheduler.cost = {streamid: cost for streamid in intervals}
+		return scheduler
+
+	def test_postponed_streams_get_a_deadline(self):
+		scheduler = self.scheduler({1: 1, 2: 10, 3: 10}, cost=0.6)
+		rechecks, live = scheduler.plan(0.0)
+		self.assertEqual(live, [1])
+		# The streams that did not fit wait until the detector is done, in their order and before stream 1
+		self.assertEqual(scheduler.nextdue[2], 0.6)
+		self.assertEqual(scheduler.nextdue[3], 0.6)
+		self.assertEqual(scheduler.idletime(0.0), 0.6)
+		self.assertEqual(scheduler.plan(0.6)[1], [2])
+		self.assertEqual(scheduler.shed, 3)
+
+	def test_simulation(self):
+		# Run the scheduler against a fake clock, every inference takes its estimated cost and the detector sleeps for
+		# the idle time in between
+		intervals = {1: 1, 2: 1, 3: 2, 4: 10}
+		scheduler = self.scheduler(intervals, cost=0.3)
+		runs = {streamid: 0 for streamid in intervals}
+		now = 0.0
+		idleplans = 0
+		while now < 100:
+			rechecks, live = scheduler.plan(now)
+			for streamid in live:
+				runs[streamid] += 1
+			if not live and not scheduler.idletime(now):
+				idleplans += 1
+			now += len(live) * 0.3
+			scheduler.record(live, len(live) * 0.3)
+			now += scheduler.idletime(now)
+		# The detector never spins on streams that are due but do not fit
+		self.assertEqual(idleplans, 0)
+		# Asking for 0.3 / 1 + 0.3 / 1 + 0.3 / 2 + 0.3 / 10 = 0.78 of the detector fits, so nobody starves
+		for streamid, interval in intervals.items():
+			self.assertGreaterEqual(runs[streamid], 100 / interval * 0.9, f'stream {streamid}')
+
+	def test_overload_stretches_evenly(self):
+		# Four streams asking for twice the detector time all slow down by the same factor
+		intervals = {1: 1, 2: 1, 3: 1, 4: 1}
+		scheduler = self.scheduler(intervals, cost=0.5)
+		runs = {streamid: 0 for streamid in intervals}
+		now = 0.0
+		while now < 100:
+			rechecks, live = scheduler.plan(now)
+			for streamid in live:
+				runs[streamid] += 1
+			now += len(live) * 0.5
+			now += scheduler.idletime(now)
+		self.assertAlmostEqual(scheduler.stretch, 2.0)
+		self.assertLessEqual(max(runs.values()) - min(runs.values()), 1)
+		self.assertGreaterEqual(min(runs.values()), 45)
+
+	def test_recheck_waits_for_its_frame(self):
+		scheduler = self.scheduler({1: 1, 2: 1}, cost=0.1)
+		scheduler.plan(0.0)
+		scheduler.recheck(1, after=0.05)
+		self.assertAlmostEqual(scheduler.idletime(0.0), 0.05)
+		self.assertEqual(scheduler.plan(0.0)[0], [])
+		self.assertEqual(scheduler.plan(0.05)[0], [1])
+		self.assertAlmostEqual(scheduler.idletime(0.05), 0.95)
+
+	def test_record_charges_only_inferred_streams(self):
+		scheduler = self.scheduler({1: 1, 2: 1}, cost=0.1)
+		scheduler.record([1], 0.5)
+		self.assertAlmostEqual(scheduler.cost[1], (0.1 * 19 + 0.5) / 20)
+		self.assertEqual(scheduler.cost[2], 0.1)
+
+
+if __name__ == '__main__':
+	unittest.main()
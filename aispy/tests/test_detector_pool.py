@@ -0,0 +1,112 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+import supervision as sv
+
+from detector.detector_api import DetectorAPI
+from detector.detector_pool import DetectorPool
+
+
+class FakeDetector(DetectorAPI):
+	# Takes a fixed time per image and records how many requests run on it at the same time
+	type_key = 'fake'
+
+	def __init__(self, detector_config):
+		self.inference_time = detector_config
+		self.model_names = {0: 'person'}
+		self.lock = threading.Lock()
+		self.running = 0
+		self.maxrunning = 0
+
+	def enter(self):
+		with self.lock:
+			self.running += 1
+			self.maxrunning = max(self.maxrunning, self.running)
+
+	def leave(self):
+		with self.lock:
+			self.running -= 1
+
+	def detect(self, image, classes=None, conf=0.2, nms=True, iou=0.5, verbose=True) -> sv.Detections:
+		self.enter()
+		try:
+			if image[0, 0] < 0:
+				raise ValueError('Negative image')
+			time.sleep(self.inference_time)
+			return sv.Detections(xyxy=np.array([[0, 0, image[0, 0], image[0, 0]]], dtype=np.float32))
+		finally:
+			self.leave()
+
+
+class FakePipelinedDetector(FakeDetector):
+	# Counts the requests between preprocessing and the end of their inference, the ones holding an input buffer
+	type_key = 'fakepipelined'
+
+	def preprocess_batch(self, images, buffers=None):
+		self.enter()
+		return np.stack(images)
+
+	def inference_batch(self, batch):
+		time.sleep(self.inference_time)
+		self.leave()
+		return [batch]
+
+	def postprocess_batch(self, outputs, orig_image_sizes, classes, conf, nms, iou):
+		return [sv.Detections(xyxy=np.array([[0, 0, image[0, 0], image[0, 0]]], dtype=np.float32))
+				for image in outputs[0]]
+
+
+def images(count):
+	return [np.full((4, 4), i, dtype=np.float32) for i in range(count)]
+
+
+def values(results):
+	return [int(detections.xyxy[0, 2]) for detections in results]
+
+
+class DetectorPoolTest(unittest.TestCase):
+
+	def test_detect_batch_order(self):
+		pool = DetectorPool([0.002] * 3, factory=FakeDetector)
+		try:
+			self.assertEqual(values(pool.detect_batch(images(20))), list(range(20)))
+			self.assertEqual(values(pool.map(images(10))), list(range(10)))
+		finally:
+			pool.close()
+
+	def test_futures(self):
+		pool = DetectorPool([0.001] * 2, factory=FakeDetector)
+		try:
+			futures = [pool.submit('detect', image) for image in images(8)]
+			self.assertEqual(values(future.result(timeout=5) for future in futures), list(range(8)))
+			failing = pool.submit('detect', np.full((4, 4), -1, dtype=np.float32))
+			with self.assertRaises(ValueError):
+				failing.result(timeout=5)
+			# A failed request does not stop the worker
+			self.assertEqual(values([pool.detect(images(2)[1])]), [1])
+		finally:
+			pool.close()
+
+	def test_one_request_per_unpipelined_detector(self):
+		pool = DetectorPool([0.002] * 2, max_inflight=3, factory=FakeDetector)
+		try:
+			pool.map(images(30))
+			self.assertEqual([detector.maxrunning for detector in pool.detectors], [1, 1])
+		finally:
+			pool.close()
+
+	def test_pipeline_inflight_limit(self):
+		for max_inflight in (1, 2):
+			pool = DetectorPool([0.002], max_inflight=max_inflight, factory=FakePipelinedDetector)
+			try:
+				self.assertEqual(len(pool.pipelines), 1)
+				self.assertEqual(values(pool.map(images(30))), list(range(30)))
+				self.assertLessEqual(pool.detectors[0].maxrunning, max_inflight + 1)
+			finally:
+				pool.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
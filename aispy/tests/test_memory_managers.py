@@ -0,0 +1,71 @@
+import unittest
+
+import numpy as np
+
+from memory_managers import SharedFrameRing
+
+
+def frame(value) -> np.ndarray:
+	return np.full((4, 6, 3), value, dtype=np.uint8)
+
+
+class SharedFrameRingTest(unittest.TestCase):
+
+	def setUp(self):
+		self.ring = SharedFrameRing(max_items=4, itemshape=(4, 6, 3), datatype=np.uint8)
+
+	def tearDown(self):
+		del self.ring
+
+	def test_empty(self):
+		self.assertEqual(len(self.ring), 0)
+		self.assertEqual(self.ring.latestseq, -1)
+		self.assertIsNone(self.ring.getlatestview())
+		with self.assertRaises(IndexError):
+			self.ring.get(0)
+		with self.assertRaises(IndexError):
+			self.ring.gettimestamp(0)
+
+	def test_wraparound(self):
+		for i in range(10):
+			self.assertEqual(self.ring.append(frame(i), timestamp=100.0 + i), i)
+		self.assertEqual((self.ring.head, self.ring.tail, len(self.ring)), (6, 10, 4))
+		for seq in range(6, 10):
+			np.testing.assert_array_equal(self.ring.get(seq), frame(seq))
+			self.assertEqual(self.ring.gettimestamp(seq), 100.0 + seq)
+		np.testing.assert_array_equal(self.ring[-1], frame(9))
+		np.testing.assert_array_equal(self.ring[-4], frame(6))
+		with self.assertRaises(IndexError):
+			self.ring.get(5)
+		view, seq, token = self.ring.getlatestview()
+		self.assertEqual(seq, 9)
+		np.testing.assert_array_equal(view, frame(9))
+		self.assertFalse(view.flags.writeable)
+
+	def test_overwrite_detection(self):
+		self.ring.append(frame(0))
+		view, token = self.ring.getview(0)
+		self.assertTrue(self.ring.isvalid(0, token))
+		# Still valid until the writer comes around to the slot again
+		for i in range(1, 4):
+			self.ring.append(frame(i))
+		self.assertTrue(self.ring.isvalid(0, token))
+		self.ring.append(frame(4))
+		self.assertFalse(self.ring.isvalid(0, token))
+		# The view now shows the newer frame in the same slot, which isvalid reports for its own sequence number
+		np.testing.assert_array_equal(view, frame(4))
+		self.assertFalse(self.ring.isvalid(4, token))
+		self.assertTrue(self.ring.isvalid(4, self.ring.getview(4)[1]))
+
+	def test_slot_being_written(self):
+		self.ring.append(frame(0))
+		view, token = self.ring.getview(0)
+		# An odd counter means the writer is copying into the slot
+		self.ring.slotlocks[0] += 1
+		self.assertFalse(self.ring.isvalid(0, int(self.ring.slotlocks[0])))
+		self.ring.slotlocks[0] += 1
+		self.assertFalse(self.ring.isvalid(0, token))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,67 @@
+import pathlib
+import queue
+import shutil
+import subprocess
+import tempfile
+import unittest
+from datetime import datetime
+
+import cv2
+
+from streams import PassthroughRecorder
+
+
+@unittest.skipUnless(shutil.which('ffmpeg'), 'ffmpeg is not installed')
+class PassthroughRecorderTest(unittest.TestCase):
+
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		tmp = pathlib.Path(self.tmpdir.name)
+		self.queue = queue.Queue()
+		self.recorder = PassthroughRecorder(1, {'url': ''}, tmp.joinpath('records'), self.queue)
+		self.recorder.recorddir.mkdir()
+		self.recorder.cachedir = tmp.joinpath('segments')
+		self.recorder.cachedir.mkdir()
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def makesegments(self, seconds=3) -> list[pathlib.Path]:
+		# Segments the way the segmenter writes them, a keyframe every second so every segment is one second long
+		runstart = int(datetime.now().timestamp() * 1000)
+		cmd = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-f', 'lavfi',
+			   '-i', f'testsrc=size=64x48:rate=10:duration={seconds}', '-c:v', 'mpeg2video', '-g', '10']
+		cmd += ['-f', 'segment', '-segment_time', '1', '-segment_format', 'mpegts', '-reset_timestamps', '1',
+				str(self.recorder.cachedir.joinpath(f'{runstart}_%06d.ts'))]
+		subprocess.run(cmd, check=True)
+		return sorted(self.recorder.cachedir.glob('*.ts'))
+
+	def test_segment_names(self):
+		segments = self.makesegments()
+		self.assertEqual(len(segments), 3)
+		starts = [self.recorder.segmentstart(segment) for segment in segments]
+		self.assertEqual(starts, sorted(starts))
+
+	def test_concat(self):
+		segments = self.makesegments()
+		self.assertTrue(self.recorder.writeclip(segments))
+		streamid, filename = self.queue.get_nowait()
+		self.assertEqual(streamid, 1)
+		video = cv2.VideoCapture(filename)
+		frames = 0
+		while video.read()[0]:
+			frames += 1
+		video.release()
+		self.assertEqual(frames, 30)
+
+	def test_failed_concat_keeps_segments(self):
+		segments = self.makesegments()
+		segments[0].write_bytes(b'not a video')
+		self.assertFalse(self.recorder.writeclip(segments))
+		self.assertTrue(self.queue.empty())
+		kept = list(self.recorder.recorddir.glob('*_segments/*.ts'))
+		self.assertEqual(sorted(segment.name for segment in kept), [segment.name for segment in segments])
+
+
+if __name__ == '__main__':
+	unittest.main()
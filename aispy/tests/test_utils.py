@@ -0,0 +1,105 @@
+import http.server
+import json
+import logging
+import threading
+import time
+import unittest
+import urllib.parse
+
+from utils import TelegramFormatter, TelegramRequestsHandler
+
+
+class StandInTelegram(http.server.BaseHTTPRequestHandler):
+	# Records the messages posted to it, the first ratelimited requests get a 429 with a retry_after
+	def do_POST(self):
+		body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+		self.server.posts.append((time.monotonic(), urllib.parse.parse_qs(body)['text'][0]))
+		if self.server.ratelimited:
+			self.server.ratelimited -= 1
+			self.send_response(429)
+			response = {'ok': False, 'parameters': {'retry_after': self.server.retry_after}}
+		else:
+			self.send_response(200)
+			response = {'ok': True}
+		self.end_headers()
+		self.wfile.write(json.dumps(response).encode())
+
+	def log_message(self, format, *args):
+		pass
+
+
+class TelegramRequestsHandlerTest(unittest.TestCase):
+
+	def setUp(self):
+		self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInTelegram)
+		self.server.posts = []
+		self.server.ratelimited = 0
+		self.server.retry_after = 1
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.logger = logging.getLogger(f'Telegram stand-in {self.id()}')
+		self.logger.propagate = False
+
+	def tearDown(self):
+		for handler in self.logger.handlers[:]:
+			self.logger.removeHandler(handler)
+		self.server.shutdown()
+		self.server.server_close()
+
+	def handler(self, **kwargs) -> TelegramRequestsHandler:
+		handler = TelegramRequestsHandler(0, 'token', api_url=f'http://127.0.0.1:{self.server.server_port}', **kwargs)
+		handler.setFormatter(TelegramFormatter())
+		self.logger.addHandler(handler)
+		return handler
+
+	def waitforposts(self, count, timeout=5.0) -> list[tuple[float, str]]:
+		deadline = time.monotonic() + timeout
+		while len(self.server.posts) < count and time.monotonic() < deadline:
+			time.sleep(0.01)
+		return self.server.posts
+
+	def test_batching_and_coalescing(self):
+		self.handler(batch_interval=0.2, min_send_interval=0.0)
+		for i in range(20):
+			self.logger.warning('Stream 1 lost connection' if i % 2 else f'Frame {i} dropped')
+		posts = self.waitforposts(1)
+		time.sleep(0.3)
+		self.assertEqual(len(posts), 1)
+		text = posts[0][1]
+		self.assertEqual(text.count('Stream 1 lost connection'), 1)
+		self.assertIn('<i>repeated 10 times</i>', text)
+		for i in range(0, 20, 2):
+			self.assertIn(f'Frame {i} dropped', text)
+
+	def test_drop_counting(self):
+		self.handler(max_pending=3, batch_interval=0.2, min_send_interval=0.0)
+		for i in range(10):
+			self.logger.warning(f'Frame {i} dropped')
+		text = self.waitforposts(1)[0][1]
+		self.assertIn('Frame 2 dropped', text)
+		self.assertNotIn('Frame 3 dropped', text)
+		self.assertIn('<i>7 more log messages dropped</i>', text)
+
+	def test_retry_after(self):
+		self.server.ratelimited = 1
+		self.handler(batch_interval=0.1, min_send_interval=0.0)
+		self.logger.warning('Stream 1 lost connection')
+		posts = self.waitforposts(2)
+		self.assertEqual(len(posts), 2)
+		self.assertEqual(posts[0][1], posts[1][1])
+		self.assertGreaterEqual(posts[1][0] - posts[0][0], 0.9)
+
+	def test_batch_splits_and_truncates(self):
+		handler = TelegramRequestsHandler(0, 'token')
+		entries = [(str(i), f'<i>now</i><pre>\n{i} ' + 'x' * 1000 + '</pre>') for i in range(10)]
+		entries.append(('long', '<i>now</i><pre>\n' + '&lt;y&gt; ' * 2000 + '</pre>'))
+		messages = handler.batch(entries + [('long', entries[-1][1])], dropped=0)
+		for message in messages:
+			self.assertLessEqual(len(message), handler.max_message_length)
+			self.assertEqual(message.count('<pre>'), message.count('</pre>'))
+			self.assertEqual(message.count('<i>'), message.count('</i>'))
+		self.assertEqual(sum(message.count('x' * 1000) for message in messages), 10)
+		self.assertTrue(messages[-1].endswith('…</pre><i>repeated 2 times</i>'))
+
+
+if __name__ == '__main__':
+	unittest.main()
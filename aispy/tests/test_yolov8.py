@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+
+from detector.models.yolov8 import class_aware_nms
+
+
+class ClassAwareNmsTest(unittest.TestCase):
+
+	def test_suppresses_overlap_within_class(self):
+		boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [50, 50, 60, 60]], dtype=np.float32)
+		scores = np.array([0.8, 0.9, 0.7], dtype=np.float32)
+		class_ids = np.array([0, 0, 0])
+		np.testing.assert_array_equal(class_aware_nms(boxes, scores, class_ids), [1, 2])
+
+	def test_keeps_overlap_of_different_classes(self):
+		boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11]], dtype=np.float32)
+		scores = np.array([0.8, 0.9], dtype=np.float32)
+		np.testing.assert_array_equal(class_aware_nms(boxes, scores, np.array([0, 1])), [1, 0])
+
+	def test_negative_coordinates(self):
+		# Boxes sticking out of the top left of the frame, shifted by the largest coordinate alone the boxes of
+		# different classes would still overlap
+		boxes = np.array([[-100, -100, 2, 2], [-99, -99, 2, 2], [-98, -98, 3, 3]], dtype=np.float32)
+		scores = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+		np.testing.assert_array_equal(class_aware_nms(boxes, scores, np.array([0, 1, 2])), [0, 1, 2])
+		np.testing.assert_array_equal(class_aware_nms(boxes, scores, np.array([0, 0, 1])), [0, 2])
+
+	def test_single_box(self):
+		np.testing.assert_array_equal(
+			class_aware_nms(np.array([[0, 0, 1, 1]], dtype=np.float32), np.array([0.5]), np.array([0])), [0]
+		)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -1,8 +1,16 @@
 import asyncio
+import atexit
+import collections
 import logging
+import multiprocessing as mp
+import os
+import queue
+import re
+import signal
+import threading
 import time
 from logging import Handler, Formatter
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, RotatingFileHandler
 
 import telegram
 from telegram import InlineKeyboardButton
@@ -17,7 +25,7 @@ def create_rotating_log(path, logsize, lognum, file_level, console_level, telegr
 	logger = logging.getLogger("Main Logger")
 	logger.setLevel(logging.DEBUG)
 	# Create a rotating filehandler
-	filehandler = RotatingFileHandler(path, maxBytes=logsize, backupCount=lognum)
+	filehandler = BatchedRotatingFileHandler(path, maxBytes=logsize, backupCount=lognum)
 	filehandler.setLevel(file_level)
 	# Create a streamhandler to print to console
 	consolehandler = logging.StreamHandler()
@@ -35,24 +43,269 @@ def create_rotating_log(path, logsize, lognum, file_level, console_level, telegr
 	logger.addHandler(filehandler)
 	logger.addHandler(consolehandler)
 	logger.addHandler(telegramhandler)
+	# Records below every handler's level are dropped by the logger itself, before a record is even made
+	logger.setLevel(min(file_level, console_level, telegram_level))
+	# The formatters use none of the thread and process fields, skip looking them up for every record
+	logging.logThreads = False
+	logging.logProcesses = False
+	logging.logMultiprocessing = False
 	return logger
 
+
+def start_log_listener(logger=None) -> 'LogListener':
+	"""
+	Moves the handlers of the logger, by default the main logger, to a LogListener process and replaces them by a
+	LogQueueHandler. Call it in the main process before any other process is started, they inherit the queue
+	handler. Until then every process writes its records itself. The queue holds at most log_queue_size records, so
+	producers drop records instead of piling them up in memory when the listener is gone.
+	"""
+	logger = logger or logging.getLogger("Main Logger")
+	handlers = list(logger.handlers)
+	records = mp.Queue(maxsize=getattr(Settings, 'log_queue_size', 10000))
+	listener = LogListener(records, handlers)
+	listener.start()
+	for handler in handlers:
+		logger.removeHandler(handler)
+	logger.addHandler(LogQueueHandler(records))
+	atexit.register(listener.stop)
+	return listener
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+	# In the log listener flushing is left to it, it flushes once per batch of records instead of once per record
+	batched = False
+
+	def flush(self):
+		if not self.batched:
+			super().flush()
+
+	def flushbatch(self):
+		self.acquire()
+		try:
+			if self.stream:
+				self.stream.flush()
+		finally:
+			self.release()
+
+
+class LogQueueHandler(QueueHandler):
+	"""
+	Puts records on the queue of the log listener. Only what cannot be pickled is resolved in the logging process,
+	the message arguments and the exception, formatting is left to the listener. The record is pickled by the
+	queue's feeder thread, so the caller only pays for the put. Records that do not fit on the full queue are
+	dropped and counted, the count is logged with the next record that fits.
+	"""
+	exceptionformatter = Formatter()
+	dropped = 0
+
+	def enqueue(self, record):
+		try:
+			if self.dropped:
+				note = logging.makeLogRecord({'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+											  'msg': f'{self.dropped} log records dropped, the log listener fell behind'})
+				self.queue.put_nowait(note)
+				self.dropped = 0
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+
+	def prepare(self, record):
+		if record.args:
+			record.msg = record.getMessage()
+			record.args = None
+		if record.exc_info:
+			record.exc_text = self.exceptionformatter.formatException(record.exc_info)
+			record.exc_info = None
+		return record
+
+
+class LogListener(mp.Process):
+	"""
+	The only process that formats and writes log records, for all processes. Takes the records off the queue in
+	batches of up to batch_size and hands them to the handlers, files are flushed once per batch. One process owning
+	the log file also means rotation cannot race.
+	"""
+
+	def __init__(self, records: mp.Queue, handlers: list[Handler], batch_size=256):
+		super().__init__(daemon=True)
+		self.records = records
+		self.handlers = handlers
+		self.batch_size = batch_size
+
+	def run(self):
+		# Keep logging what the other processes report while they shut down on ctrl-c, stop ends the listener
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		for handler in self.handlers:
+			if isinstance(handler, BatchedRotatingFileHandler):
+				handler.batched = True
+		while True:
+			batch = [self.records.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self.records.get_nowait())
+				except queue.Empty:
+					break
+			for record in batch:
+				if record is None:
+					self.flush()
+					for handler in self.handlers:
+						handler.close()
+					return
+				for handler in self.handlers:
+					if record.levelno >= handler.level:
+						handler.handle(record)
+			self.flush()
+
+	def flush(self):
+		for handler in self.handlers:
+			if isinstance(handler, BatchedRotatingFileHandler):
+				handler.flushbatch()
+			else:
+				handler.flush()
+
+	def stop(self):
+		# Lets the listener write what is queued before the main process exits
+		if self.is_alive():
+			try:
+				self.records.put(None, timeout=5)
+			except queue.Full:
+				return
+			self.join(timeout=5)
+
 class TelegramRequestsHandler(Handler):
+	"""
+	Ships log records to a Telegram chat without blocking the process that logs.
+
+	emit only formats the record and appends it to a buffer of at most max_pending entries, records that come in
+	while the buffer is full are dropped and counted, the oldest ones usually explain what went wrong. A background
+	thread of every process that logs sends the buffer as one message per batch_interval at most, split at the
+	Telegram message length, with repeats of the same message coalesced into one entry with a count. Messages are
+	at least min_send_interval apart and a 429 from Telegram pauses sending for the time it asks. The thread keeps one
+	HTTP session open. api_url can point to a local stand-in for testing.
+	"""
+	max_message_length = 4096
 
-	def __init__(self, telegram_id, telegram_token):
+	def __init__(self, telegram_id, telegram_token, api_url='https://api.telegram.org', max_pending=100,
+				 batch_interval=2.0, min_send_interval=3.0, timeout=10.0):
 		super(TelegramRequestsHandler, self).__init__()
 		self.telegram_id = telegram_id
 		self.telgram_token = telegram_token
+		self.url = f'{api_url}/bot{telegram_token}/sendMessage'
+		self.max_pending = max_pending
+		self.batch_interval = batch_interval
+		self.min_send_interval = min_send_interval
+		self.timeout = timeout
+		self.workerpid: int | None = None
+
+	def startworker(self):
+		# Threads do not survive a fork, every process that logs starts its own worker on its first record and
+		# leaves the records it inherited to its parent
+		self.workerpid = os.getpid()
+		self.condition = threading.Condition()
+		self.pending: collections.deque[tuple[str, str]] = collections.deque()
+		self.dropped = 0
+		self.nextsend = 0.0
+		self.session = requests.Session()
+		threading.Thread(target=self.work, daemon=True).start()
 
 	def emit(self, record):
-		log_entry = self.format(record)
+		try:
+			log_entry = self.format(record)
+		except Exception:
+			self.handleError(record)
+			return
+		# Called with the handler lock held, so only one thread starts the worker
+		if self.workerpid != os.getpid():
+			self.startworker()
+		with self.condition:
+			if len(self.pending) >= self.max_pending:
+				self.dropped += 1
+			else:
+				self.pending.append((f'{record.levelno} {record.getMessage()}', log_entry))
+				self.condition.notify()
+
+	def work(self):
+		while True:
+			with self.condition:
+				while not self.pending:
+					self.condition.wait()
+			# Let the rest of a burst of records join the batch
+			time.sleep(max(self.batch_interval, self.nextsend - time.monotonic()))
+			self.sendpending()
+
+	def sendpending(self, attempts=3):
+		with self.condition:
+			entries = list(self.pending)
+			self.pending.clear()
+			dropped, self.dropped = self.dropped, 0
+		for message in self.batch(entries, dropped):
+			self.send(message, attempts)
+
+	def batch(self, entries: list[tuple[str, str]], dropped: int) -> list[str]:
+		# Coalesces repeats, keeping the first entry of each, and packs the entries into as few messages as fit
+		counts = collections.Counter(key for key, entry in entries)
+		firsts = {}
+		for key, entry in entries:
+			firsts.setdefault(key, entry)
+		texts = []
+		for key, entry in firsts.items():
+			repeats = '' if counts[key] == 1 else f'<i>repeated {counts[key]} times</i>'
+			texts.append(self.truncate(entry, self.max_message_length - len(repeats)) + repeats)
+		if dropped:
+			texts.append(f'<i>{dropped} more log messages dropped</i>')
+		messages = []
+		for text in texts:
+			if messages and len(messages[-1]) + 1 + len(text) <= self.max_message_length:
+				messages[-1] += '\n' + text
+			else:
+				messages.append(text)
+		return messages
+
+	@staticmethod
+	def truncate(text: str, length: int) -> str:
+		# Cuts an HTML formatted entry to at most length characters, tags left open by the cut are closed again
+		if len(text) <= length:
+			return text
+		# Room for the ellipsis and the closing tags
+		text = text[:max(length - 64, 0)]
+		# Never end inside a tag or an entity
+		text = re.sub(r'<[^>]*$|&[^;\s]*$', '', text)
+		opentags: list[str] = []
+		for closing, tag in re.findall(r'<(/?)(\w+)[^>]*>', text):
+			if not closing:
+				opentags.append(tag)
+			elif opentags and opentags[-1] == tag:
+				opentags.pop()
+		return text + '…' + ''.join(f'</{tag}>' for tag in reversed(opentags))
+
+	def send(self, message: str, attempts=3):
 		payload = {
 			'chat_id': self.telegram_id,
-			'text': log_entry,
+			'text': message,
 			'parse_mode': 'HTML'
 		}
-		return requests.post("https://api.telegram.org/bot{token}/sendMessage".format(token=self.telgram_token),
-							 data=payload).content
+		for attempt in range(attempts):
+			wait = self.nextsend - time.monotonic()
+			if wait > 0:
+				time.sleep(wait)
+			self.nextsend = time.monotonic() + self.min_send_interval
+			try:
+				response = self.session.post(self.url, data=payload, timeout=self.timeout)
+			except requests.RequestException:
+				# Logging the failure would only come back here, the message is lost
+				return
+			if response.status_code != 429:
+				return
+			retry_after = response.json().get('parameters', {}).get('retry_after', self.min_send_interval)
+			self.nextsend = time.monotonic() + retry_after
+
+	def close(self):
+		# Send what is left when logging shuts down, with at most one attempt per message
+		if self.workerpid == os.getpid():
+			self.nextsend = 0.0
+			self.min_send_interval = 0.0
+			self.sendpending(attempts=1)
+		super(TelegramRequestsHandler, self).close()
 
 class TelegramFormatter(Formatter):
 	def __init__(self):
@@ -73,11 +326,3 @@ mainlogger = create_rotating_log(Settings.log_name,
 								 Settings.telegram_loglevel,
 								 Settings.telegram_chat_id,
 								 Settings.telegram_token)
-
-
-def send_photo_telegram(image_path, chat_ids, token, image_caption=""):
-	for chat_id in chat_ids:
-		data = {"chat_id": chat_id, "caption": image_caption}
-		url = f'https://api.telegram.org/bot{token}/sendPhoto?chat_id={chat_id}'
-		with open(image_path, "rb") as image_file:
-			ret = requests.post(url, data=data, files={"photo": image_file})
\ No newline at end of file
@@ -2,7 +2,10 @@ import multiprocessing as mp
 import threading
 import time
 from object_detector import ObjectDetector
+from motion_detector import MotionDetector
 from mediamanagers import FileAnnotator, SnapshotProcessor
+from memory_managers import SharedFrameQueue
+from settings import UserSettings
 from utils import mainlogger
 
 
@@ -12,12 +15,16 @@ class Watchdog(threading.Thread):
 		super().__init__()
 		self.streaminfos = streaminfo
 		self.fileinferencequeue = fileinferencequeue
-		self.snapshotqueue = mp.Queue()
+		# Snapshots are full main stream frames, so they go through shared memory slots of the largest stream
+		slotsize = max((width * height * 3 for streamid, streaminfo in streaminfo.items() if streamid != 0
+						for width, height in [streaminfo['dimensions']]), default=1)
+		self.snapshotqueue = SharedFrameQueue(getattr(UserSettings, 'snapshot_slots', 4), slotsize)
 		self.fileannotatorsendqueue = mp.Queue()
 		self.fileannotatorreceivequeue = mp.Queue()
 		self.updatetime = mp.Value('d', 0.0)
 		self.detectorload = mp.Value('d', 0.0)
 		self.processes = []
+		self.motiondetectors: dict[int, MotionDetector] = {}
 
 	def start_processes(self):
 		mainlogger.info(f'Watchdog starting processes')
@@ -36,6 +43,7 @@ class Watchdog(threading.Thread):
 			self.snapshotqueue,
 			self.fileannotatorsendqueue,
 			self.fileannotatorreceivequeue,
+			fileanno.annotationbuffer,
 			self.updatetime,
 			self.detectorload
 		)
@@ -43,10 +51,28 @@ class Watchdog(threading.Thread):
 
 		for process in self.processes:
 			process.start()
+		# A motion detector for every stream with motion gated object detection
+		for streamid, streaminfo in self.streaminfos.items():
+			if streamid != 0 and streaminfo['motion_gating']:
+				self.start_motiondetector(streamid)
 
 		while True:
 			# mainlogger.info(f'{self.detectorload.value*100=:.0f}%')
 			time.sleep(5)
+			# Without its motion detector a gated stream is only inferred every motion_keepalive
+			for streamid, motiondetector in list(self.motiondetectors.items()):
+				if not motiondetector.is_alive():
+					mainlogger.warning(f'Motion detector of stream {streamid} died with exit code '
+									   f'{motiondetector.exitcode}, restarting')
+					# Reap the dead process and free its resources so restarts do not leave zombies behind
+					motiondetector.join()
+					motiondetector.close()
+					self.start_motiondetector(streamid)
+
+	def start_motiondetector(self, streamid):
+		motiondetector = MotionDetector(streamid, self.streaminfos[streamid])
+		self.motiondetectors[streamid] = motiondetector
+		motiondetector.start()
 
 	def run(self) -> None:
 		self.start_processes()
\ No newline at end of file